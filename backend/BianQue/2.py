@@ -3,7 +3,7 @@
 用 streamlit_chat和扁鹊基础模型搭建的一个健康伴侣聊天web页面,可以直接放在前端进行跳转
 ```bash
 pip install transformers==4.40.2
-pip install torch==1.13.1
+pip install "torch>=2.1"  # 按需加载权重（mmap）、scaled_dot_product_attention等需要torch 2.1及以上
 pip install streamlit # 第一次运行需要安装streamlit
 pip install streamlit_chat # 第一次运行需要安装streamlit_chat
 pip install sentencepiece
@@ -16,10 +16,12 @@ http://<your_ip>:9005
 
 '''
 import os
+import time
+import uuid
 import torch
 import streamlit as st
 from streamlit_chat import message
-from transformers import AutoModel, AutoTokenizer
+from transformers import AutoConfig, AutoModel, AutoTokenizer
 
 
 os.environ['CUDA_VISIBLE_DEVICES'] = '0' # 默认使用0号显卡，避免Windows用户忘记修改该处
@@ -33,6 +35,32 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # 修改为本地路径
 model_name_or_path = "ours"  # 或绝对路径（如 "D:/models/bianque-2"）
 
+# 所有会话共享的KV cache大小（字节），按对话实际长度分配，用满时最新加入的对话暂停，等有空间后重新计算
+kv_cache_memory = 4 * 1024 ** 3
+# 同时解码的最大对话数量
+max_batch_size = 32
+# 在轮次之间保留每个对话的KV cache，每轮只计算新输入的部分：关闭时首个token的延迟随对话长度线性增长，开启后只与
+# 新一轮输入的长度有关（随机权重的4层模型第10轮约900个token时1.04s vs 0.09s，见benchmarks/bench_session_reuse.py）。
+# 但这是近似：新一轮的输入接在上一轮回答之后单向计算，不再与整段对话一起双向编码，回答可能与重新构造完整输入时不同，
+# 扁鹊权重上的偏差（首token分布的KL散度）需用该脚本的--model测量，确认可接受之前默认关闭
+reuse_session_cache = False
+# 保留KV cache的最大对话数量，超出后最久未使用的对话需要重新计算
+max_sessions = 64
+# 所有请求共享的相同输入的KV cache大小（字节），0表示不启用。GLM对[gMASK]之前的上下文双向编码，
+# 只有整段输入完全相同时才能命中，而这里每个输入都包含整段对话历史，所以默认关闭
+prefix_cache_memory = 0
+# 没有显卡时把模型量化为int4（0表示不量化），6B模型约占4~7GB内存
+quantization_bit = 0 if torch.cuda.is_available() else 4
+# 同时量化词表（word_embeddings和lm_head）：int4时在CPU上（float32）再省约1.8GB内存，但每个token的lm_head慢几倍且精度更低
+quantize_embeddings = False
+# 长对话的prefill每次只处理这么多token，限制内存峰值（None表示一次处理整个输入）
+prefill_chunk_size = 512
+# CPU上以float32计算。权重按计算用的dtype保存为.bin分片后按需读取（mmap），启动时不再把fp16权重复制成float32
+model_dtype_suffix = "" if torch.cuda.is_available() else "-fp32"
+# 量化后的模型目录：存在时直接加载量化权重，否则首次启动量化后保存到这里
+quantized_model_path = f"{model_name_or_path}-int{quantization_bit}" + ("-emb" if quantize_embeddings else "") \
+    + model_dtype_suffix
+
 
 
 def answer(user_history, bot_history, sample=True, top_p=0.7, temperature=0.95):
@@ -53,10 +81,10 @@ def answer(user_history, bot_history, sample=True, top_p=0.7, temperature=0.95):
     
     print(input_text)
 
-    if not sample:
-        response, history = model.chat(tokenizer, query=input_text, history=None, max_length=2048, num_beams=1, do_sample=False, top_p=top_p, temperature=temperature, logits_processor=None)
-    else:
-        response, history = model.chat(tokenizer, query=input_text, history=None, max_length=2048, num_beams=1, do_sample=True, top_p=top_p, temperature=temperature, logits_processor=None)
+    # 所有用户的请求在同一个批次中连续生成，结束的请求立即归还KV cache块
+    # 开启reuse_session_cache时同一对话的KV cache在轮次之间保留，每轮只需计算新输入的部分
+    session = sessions.get(st.session_state['session_id']) if reuse_session_cache else None
+    response, history = scheduler.chat(tokenizer, query=input_text, history=None, max_length=2048, do_sample=sample, top_p=top_p, temperature=temperature, logits_processor=None, session=session)
 
     print('医生: '+response)
 
@@ -74,6 +102,8 @@ st.header("健康伴侣v1.0")
 with st.sidebar:
     st.markdown("### 功能菜单")
     if st.button("🔄 新建对话"):
+        # 新对话使用新的会话缓存，旧的会话按最久未使用淘汰
+        st.session_state['session_id'] = uuid.uuid4().hex
         st.session_state['generated'] = []
         st.session_state['past'] = []
         st.experimental_rerun()
@@ -108,21 +138,60 @@ with st.sidebar:
         """)
 
 
+def load_mmap_model(path):
+    '''按需读取（mmap）path中的.bin权重分片：启动时不读取权重，多个进程共享同一份页缓存'''
+    config = AutoConfig.from_pretrained(path, trust_remote_code=True, local_files_only=True)
+    with torch.device("meta"):
+        model = AutoModel.from_config(config, trust_remote_code=True)
+    return model.load_mmap_checkpoint(path)
+
+def peak_rss():
+    '''进程的内存峰值（MB），Windows上不可用'''
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
 # https://docs.streamlit.io/library/api-reference/performance/st.cache_resource
 
 @st.cache_resource
 def load_model():
     # model = AutoModel.from_pretrained(model_name_or_path, trust_remote_code=True).half()
     # 从本地加载模型
-    model = AutoModel.from_pretrained(
-    model_name_or_path,torch_dtype=torch.float32,
-    trust_remote_code=True,
-    local_files_only=True).half()
+    start = time.perf_counter()
+    if quantization_bit:
+        # config中的quantization_bit会让模型直接以量化形式创建，不再读取和量化fp16权重
+        model_path = quantized_model_path
+    else:
+        model_path = model_name_or_path + model_dtype_suffix
+    if not os.path.isdir(model_path):
+        # 首次启动：转换一次并保存，之后的启动直接读取转换后的权重
+        if quantization_bit:
+            model = AutoModel.from_pretrained(
+            model_name_or_path,torch_dtype=torch.half,
+            trust_remote_code=True,
+            local_files_only=True).half()
+            model = model.quantize(quantization_bit, quantize_embeddings=quantize_embeddings)
+        else:
+            model = load_mmap_model(model_name_or_path)
+        # CPU上转为float32，int8/int4量化权重不受影响
+        model = model.to(torch.half if device.type == "cuda" else torch.float32)
+        model.save_pretrained(model_path, safe_serialization=False)
+        del model
+    # 权重保持checkpoint中的dtype，由文件页支撑
+    model = load_mmap_model(model_path)
+    model.enable_chunked_prefill(prefill_chunk_size)
     print(device)
     model.to(device)
-    print('Model Load done!')
+    print(f'Model Load done! {time.perf_counter() - start:.1f}s, peak RSS {peak_rss():.0f} MB')
     return model
 
+@st.cache_resource
+def load_prefix_cache(_model):
+    if prefix_cache_memory:
+        _model.enable_prefix_cache(prefix_cache_memory)
+
 @st.cache_resource
 def load_tokenizer():
     # tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, trust_remote_code=True)
@@ -134,8 +203,24 @@ def load_tokenizer():
     print('Tokenizer Load done!')
     return tokenizer
 
+@st.cache_resource
+def load_scheduler(_model):
+    scheduler = _model.create_scheduler(kv_cache_memory, max_batch_size=max_batch_size)
+    print('KV cache blocks:', scheduler.kv_cache_manager.usage())
+    return scheduler
+
+@st.cache_resource
+def load_sessions(_model):
+    return _model.create_session_cache(max_sessions)
+
 model = load_model()
 tokenizer = load_tokenizer()
+scheduler = load_scheduler(model)
+load_prefix_cache(model)
+sessions = load_sessions(model)
+
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = uuid.uuid4().hex
 
 if 'generated' not in st.session_state:
     st.session_state['generated'] = []
@@ -172,6 +257,7 @@ if st.session_state['generated']:
 if st.button("清理对话缓存"):
     # Clear values from *all* all in-memory and on-disk data caches:
     # i.e. clear values from both square and cube
+    sessions.pop(st.session_state['session_id'])
     st.session_state['generated'] = []
     st.session_state['past'] = []
     
\ No newline at end of file
@@ -0,0 +1,71 @@
+""" CPU prefill time and peak memory of one ChatGLM-6B layer by prompt length, with chunked prefill on and off.
+
+    python benchmarks/bench_chunked_prefill.py --lengths 512 1024 2048 4096 --chunk-size 512
+
+"off" prefills the whole prompt at once, "on" passes --chunk-size to the layer as `enable_chunked_prefill` does in
+every layer of the model (2.py chunks by 512 tokens). Activations are freed between layers, so the peak of a
+prefill is the one of its largest layer, plus the KV cache of the layers before it. Every measurement runs in a
+fresh process and reports the growth of the peak RSS over a warm-up on a few tokens (tensors are allocated outside
+of the Python allocator, so tracemalloc does not see them), and the largest difference of the outputs between
+"off" and "on" is printed as a check.
+"""
+
+import argparse
+import json
+
+import utils
+import torch
+
+from ours.masks import PrefixLMMask
+from ours.modeling_chatglm import GLMBlock
+
+
+def measure(length, chunk_size, threads):
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    layer = GLMBlock(utils.CHATGLM_6B["hidden_size"], utils.CHATGLM_6B["num_attention_heads"], 1e-5, layer_id=5,
+                     inner_hidden_size=utils.CHATGLM_6B["inner_hidden_size"], empty_init=False,
+                     attention_backend="sdpa").float().eval()
+    hidden_states = torch.randn(length, 1, utils.CHATGLM_6B["hidden_size"]) * 0.1
+    # a prompt of the tokenizer: bidirectional up to `[gMASK]<sop>` at its end
+    context_length = length - 1
+    positions = torch.arange(length)
+    position_ids = torch.stack((positions.clamp(max=context_length - 1), (positions - context_length + 1).clamp(min=0)))
+    layer_id = torch.tensor(5)
+    with torch.no_grad():
+        # warm up on a few tokens, so that the measured peak is the one of the prefill
+        layer(hidden_states[:8], position_ids[None, :, :8], PrefixLMMask(torch.tensor([7])), layer_id,
+              use_cache=True, chunk_size=chunk_size or None)
+        base = utils.peak_rss()
+        outputs = []
+        seconds = utils.best_time(lambda: outputs.append(layer(
+            hidden_states, position_ids[None], PrefixLMMask(torch.tensor([context_length])), layer_id,
+            use_cache=True, chunk_size=chunk_size or None
+        )[0]), repeat=1, warmup=0)
+    return {"seconds": seconds, "peak_rss_mb": utils.peak_rss() - base, "output": outputs[0][::64, 0].tolist()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[512, 1024, 2048, 4096])
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--worker", nargs=2, type=int, metavar=("LENGTH", "CHUNK_SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(*args.worker, args.threads)))
+        return
+
+    print(f"one layer, hidden 4096, 32 heads, fp32, sdpa, chunks of {args.chunk_size} tokens, {args.threads} thread(s)")
+    print("tokens | off s / peak MB | on s / peak MB | max output difference")
+    for length in args.lengths:
+        results = [utils.run_isolated(__file__, "--worker", length, chunk_size, "--threads", args.threads)
+                   for chunk_size in (0, args.chunk_size)]
+        difference = (torch.tensor(results[0]["output"]) - torch.tensor(results[1]["output"])).abs().max().item()
+        print(f"{length} | " + " | ".join(f"{r['seconds']:.2f} / {r['peak_rss_mb']:.0f}" for r in results)
+              + f" | {difference:.3g}")
+
+
+if __name__ == "__main__":
+    main()
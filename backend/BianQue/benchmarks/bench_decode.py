@@ -0,0 +1,54 @@
+""" CPU decode throughput by context length, with the torch.cat cache, the static KV cache and the paged pool.
+
+    python benchmarks/bench_decode.py --contexts 256 1024 2048 --new-tokens 64
+
+Without --model the model is a random-weight ChatGLM of 4 layers and hidden size 1024. Only the decode steps are
+timed: the clock starts once the first token (the prefill) has been produced. The paged cache is a sequence of
+the scheduler's block pool (`create_kv_cache_manager`), which attention reads in place.
+"""
+
+import argparse
+import time
+
+import utils
+import torch
+
+
+def decode_tokens_per_second(model, input_ids, new_tokens, **kwargs):
+    first_token = None
+    steps = model.stream_generate(input_ids, max_length=input_ids.size(1) + new_tokens, do_sample=False,
+                                  eos_token_id=-1, **kwargs)
+    for i, _ in enumerate(steps):
+        if i == 0:
+            first_token = time.perf_counter()
+    return (new_tokens - 1) / (time.perf_counter() - first_token)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="checkpoint directory, a random-weight model by default")
+    parser.add_argument("--contexts", type=int, nargs="+", default=[256, 1024, 2048])
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    model = utils.load_model(args.model, max_sequence_length=max(args.contexts) + args.new_tokens + 1)
+    print(f"{model.config.num_layers} layers, hidden {model.config.hidden_size}, {args.new_tokens} new tokens, "
+          f"{args.threads} thread(s)")
+    print("context | cat tok/s | static tok/s | paged tok/s")
+    with torch.no_grad():
+        for context in args.contexts:
+            input_ids = utils.random_prompt(context)
+            cat = decode_tokens_per_second(model, input_ids, args.new_tokens)
+            static = decode_tokens_per_second(model, input_ids, args.new_tokens, use_static_cache=True)
+            # a pool of one sequence, with a block to spare
+            bytes_per_token = 2 * model.config.num_layers * model.config.hidden_size * model.dtype.itemsize
+            manager = model.create_kv_cache_manager(bytes_per_token * (context + args.new_tokens + 16))
+            paged = decode_tokens_per_second(model, input_ids, args.new_tokens,
+                                             past_key_values=manager.get_cache([manager.add_sequence()]))
+            print(f"{context} | {cat:.1f} | {static:.1f} | {paged:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+""" Per-token overhead of the generation loop: prepare_inputs_for_generation plus _update_model_kwargs_for_generation.
+
+    python benchmarks/bench_generation_overhead.py
+    git worktree add /tmp/before <older commit>
+    BIANQUE_DIR=/tmp/before/backend/BianQue python benchmarks/bench_generation_overhead.py
+
+Only the bookkeeping around the forward pass is timed, at the steps where the sequence reaches each length, so the
+model and its cache are stand-ins: a small random-weight model and empty tensors of the right length as the past.
+"""
+
+import argparse
+import time
+
+import utils
+import torch
+
+from transformers.modeling_outputs import CausalLMOutputWithPast
+
+
+def step_times(model, batch_size, prompt_length, seq_lengths, padded):
+    input_ids = utils.random_prompt(prompt_length, batch_size)
+    model_kwargs = {}
+    if padded:
+        # the dense mask and the position ids of a tokenizer batch whose first row is left-padded
+        input_ids[0, :8] = utils.PAD
+        attention_mask = model.get_masks(input_ids, input_ids.device)
+        attention_mask[0, :, :, :8] = True
+        attention_mask[0, :, :8] = True
+        mask_positions = [prompt_length - 2] * batch_size
+        model_kwargs = dict(attention_mask=attention_mask,
+                            position_ids=model.get_position_ids(input_ids, mask_positions, input_ids.device))
+    if hasattr(model, "_prepare_position_ids_for_generation"):
+        # as generate and stream_generate do before the first step; older checkouts do not have it
+        model_kwargs = model._prepare_position_ids_for_generation(input_ids, model_kwargs)
+
+    times = {}
+    for seq_length in range(prompt_length, max(seq_lengths)):
+        # the past of a decode step: every token but the last one
+        past_key_values = tuple((torch.empty(seq_length - 1, batch_size, 1, 1),) * 2
+                                for _ in range(model.config.num_layers))
+        model_kwargs["past_key_values"] = past_key_values
+        start = time.perf_counter()
+        model.prepare_inputs_for_generation(input_ids, **model_kwargs)
+        outputs = CausalLMOutputWithPast(past_key_values=past_key_values)
+        model_kwargs = model._update_model_kwargs_for_generation(outputs, model_kwargs)
+        elapsed = time.perf_counter() - start
+        input_ids = torch.cat([input_ids, input_ids[:, -1:]], dim=-1)
+        if seq_length + 1 in seq_lengths:
+            times[seq_length + 1] = elapsed
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--seq-lengths", type=int, nargs="+", default=[256, 512, 1024, 2048])
+    parser.add_argument("--prompt-length", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    model = utils.random_model(utils.make_config(hidden_size=64, num_layers=2, num_attention_heads=4,
+                                                 inner_hidden_size=128, max_sequence_length=max(args.seq_lengths)))
+    print(f"{utils.BIANQUE_DIR}, {args.prompt_length}-token prompt, {args.threads} thread(s)")
+    print("batch | mask | " + " | ".join(f"{seq_length} us" for seq_length in args.seq_lengths))
+    for batch_size, padded in [(1, False), (8, True)]:
+        runs = [step_times(model, batch_size, args.prompt_length, args.seq_lengths, padded)
+                for _ in range(args.repeat)]
+        best = [min(run[seq_length] for run in runs) for seq_length in args.seq_lengths]
+        print(f"{batch_size} | {'padded dense' if padded else 'none'} | " +
+              " | ".join(f"{seconds * 1e6:.0f}" for seconds in best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+""" Int8 KV cache: sessions per GiB at ChatGLM-6B shapes, decode latency and accuracy against the full-precision cache.
+
+    python benchmarks/bench_kv_int8.py --vocab ours/ice_text.model
+    python benchmarks/bench_kv_int8.py --model <checkpoint directory>
+
+Sessions per GiB come from the sizes of the scheduler's paged pool, allocated on the meta device. The decode
+latency is the time per token after prompts of --contexts tokens, with the full-precision static cache (written in
+place) and the int8 cache, which dequantizes the whole history at every step; without --model it is measured on a
+random-weight ChatGLM of 4 layers and hidden size 1024. For accuracy,
+held-out dialogues (consecutive lines of --corpus as patient and doctor turns) are answered greedily with the
+full-precision cache. The answers are then fed back token by token with both caches, which gives the top-1
+agreement and the KL divergence of every step. Without --model the model has random weights, so its numbers only
+show that the int8 cache does not change what the model computes; run it on the real weights to judge answers.
+"""
+
+import argparse
+import time
+
+import utils
+import torch
+
+from ours.kv_cache import PagedKVCacheManager, QuantizedKVCache
+from ours.tokenization_chatglm import ChatGLMTokenizer
+
+
+def sessions_per_gib(config, seq_lengths):
+    print("cache | KiB/token | " + " | ".join(f"{seq_length}-token sessions per GiB" for seq_length in seq_lengths))
+    for dtype in (torch.half, torch.int8):
+        manager = PagedKVCacheManager.from_config(config, 1024 ** 3, block_size=16, dtype=dtype, device="meta")
+        tokens = manager.num_blocks * manager.block_size
+        print(f"{str(dtype).split('.')[-1]} | {manager.bytes_per_block / manager.block_size / 1024:.0f} | " +
+              " | ".join(f"{tokens / seq_length:.2f}" for seq_length in seq_lengths))
+
+
+def decode_ms(model, input_ids, new_tokens, **cache_kwargs):
+    """Milliseconds per decode step of a greedy generation, the prefill excluded."""
+    first_token = None
+    steps = model.stream_generate(input_ids, max_length=input_ids.size(1) + new_tokens, do_sample=False,
+                                  eos_token_id=-1, **cache_kwargs)
+    for i, _ in enumerate(steps):
+        if i == 0:
+            first_token = time.perf_counter()
+    return (time.perf_counter() - first_token) / (new_tokens - 1) * 1e3
+
+
+def decode_latency(model, contexts, new_tokens):
+    print(f"decode, {model.config.num_layers} layers, hidden {model.config.hidden_size}, {new_tokens} new tokens")
+    print("context | fp ms/token | int8 ms/token | int8 / fp")
+    for context in contexts:
+        input_ids = utils.random_prompt(context)
+        fp = decode_ms(model, input_ids, new_tokens, use_static_cache=True)
+        int8 = decode_ms(model, input_ids, new_tokens, use_quantized_cache=True)
+        print(f"{context} | {fp:.2f} | {int8:.2f} | {int8 / fp:.2f}")
+
+
+def make_dialogues(model, corpus_files, num_dialogues, turn_chars=60):
+    lines = [line for line in utils.read_corpus(corpus_files) if len(line) > 20]
+    dialogues = []
+    for i in range(0, 2 * num_dialogues, 2):
+        history = [(lines[i][:turn_chars], lines[i + 1][:turn_chars])]
+        dialogues.append(model.build_prompt(lines[i + 2][:turn_chars], history))
+    return dialogues
+
+
+def teacher_forced_logits(model, input_ids, continuation, **cache_kwargs):
+    """The next-token logits of every step while `continuation` is fed to the model one token at a time."""
+    past_key_values, model_kwargs, logits = None, {}, []
+    for step in range(len(continuation) + 1):
+        inputs = model.prepare_inputs_for_generation(input_ids, past_key_values=past_key_values, **cache_kwargs,
+                                                     **model_kwargs)
+        outputs = model(**inputs, return_dict=True)
+        past_key_values = outputs.past_key_values
+        model_kwargs = model._update_model_kwargs_for_generation(outputs, {"position_ids": inputs["position_ids"]})
+        model_kwargs.pop("past_key_values")
+        logits.append(outputs.logits[:, -1].float())
+        if step < len(continuation):
+            input_ids = torch.cat([input_ids, input_ids.new_tensor([[continuation[step]]])], dim=-1)
+    return torch.cat(logits), past_key_values
+
+
+def accuracy(model, tokenizer, dialogues, new_tokens):
+    agree = steps = identical = 0
+    kl_sum = 0.0
+    for prompt in dialogues:
+        input_ids = tokenizer([prompt], return_tensors="pt")["input_ids"]
+        kwargs = dict(max_length=input_ids.size(1) + new_tokens, do_sample=False)
+        reference = model.generate(input_ids, **kwargs)
+        identical += torch.equal(reference, model.generate(input_ids, use_quantized_cache=True, **kwargs))
+        continuation = reference[0, input_ids.size(1):].tolist()
+        expected, _ = teacher_forced_logits(model, input_ids, continuation)
+        actual, past_key_values = teacher_forced_logits(model, input_ids, continuation, use_quantized_cache=True)
+        assert isinstance(past_key_values, QuantizedKVCache)
+        kl = torch.nn.functional.kl_div(actual.double().log_softmax(-1), expected.double().log_softmax(-1),
+                                        log_target=True, reduction="none").sum(-1)
+        kl_sum += kl.sum().item()
+        steps += kl.numel()
+        agree += (expected.argmax(-1) == actual.argmax(-1)).sum().item()
+    print(f"{len(dialogues)} dialogues, {steps} steps: top-1 agreement {agree / steps:.4f}, "
+          f"mean KL {kl_sum / steps:.2e}, identical greedy answers {identical}/{len(dialogues)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="checkpoint directory with its tokenizer, a random-weight model by default")
+    parser.add_argument("--vocab", default=utils.DEFAULT_VOCAB,
+                        help="SentencePiece model of the random-weight model, ours/ice_text.model by default")
+    parser.add_argument("--corpus", nargs="+", help="UTF-8 text files, the Markdown documents of docs/ by default")
+    parser.add_argument("--dialogues", type=int, default=20)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--contexts", type=int, nargs="+", default=[256, 1024, 2048],
+                        help="prompt lengths of the decode latency")
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    sessions_per_gib(utils.make_config(**utils.CHATGLM_6B), [2048, 512])
+    model = utils.load_model(args.model, max_sequence_length=max(args.contexts) + args.new_tokens + 1)
+    with torch.no_grad():
+        decode_latency(model, args.contexts, args.new_tokens)
+
+    if args.model:
+        tokenizer = ChatGLMTokenizer.from_pretrained(args.model)
+    else:
+        tokenizer = ChatGLMTokenizer(args.vocab)
+        config = utils.make_config(
+            vocab_size=tokenizer.vocab_size, hidden_size=64, num_layers=4, num_attention_heads=4,
+            inner_hidden_size=256, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+            mask_token_id=tokenizer.convert_tokens_to_ids("[MASK]"), gmask_token_id=tokenizer.gmask_token_id,
+            pad_token_id=tokenizer.pad_token_id
+        )
+        model = utils.random_model(config, std=0.08)
+    with torch.no_grad():
+        accuracy(model, tokenizer, make_dialogues(model, args.corpus, args.dialogues), args.new_tokens)
+
+
+if __name__ == "__main__":
+    main()
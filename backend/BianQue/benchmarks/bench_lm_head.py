@@ -0,0 +1,57 @@
+""" CPU prefill time and peak memory by prompt length, computing the logits of every token or of the last one only.
+
+    python benchmarks/bench_lm_head.py --lengths 256 512 1024 2048
+
+"full" is a prefill that projects every position on the vocabulary (`num_logits_to_keep=0`, a `[b, s, 130528]`
+fp32 tensor), "last" the one of `generate`, which only keeps the logits it samples from (`num_logits_to_keep=1`).
+Without --model the model is a random-weight ChatGLM of 4 layers and hidden size 1024; the size of the logits does
+not depend on the hidden size, only the time of the projection does. Every measurement runs in a fresh process and
+reports the growth of the peak RSS over a warm-up on a few tokens, from where the peak is reset to the current RSS.
+"""
+
+import argparse
+import json
+
+import utils
+import torch
+
+KEEP = {"full": 0, "last": 1}
+
+
+def measure(model_path, keep, length, threads):
+    torch.set_num_threads(threads)
+    model = utils.load_model(model_path, max_sequence_length=max(length, 2048))
+    with torch.no_grad():
+        # warm up on a few tokens, so that the measured peak is the one of the prefill
+        model(**model.prepare_inputs_for_generation(utils.random_prompt(8), num_logits_to_keep=KEEP[keep]))
+        inputs = model.prepare_inputs_for_generation(utils.random_prompt(length), num_logits_to_keep=KEEP[keep])
+        # loading the weights peaks higher than a short prefill
+        utils.reset_peak_rss()
+        base = utils.peak_rss()
+        seconds = utils.best_time(lambda: model(**inputs), repeat=1, warmup=0)
+    return {"seconds": seconds, "peak_rss_mb": utils.peak_rss() - base}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="checkpoint directory, a random-weight model by default")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[256, 512, 1024, 2048])
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--worker", nargs=2, metavar=("LOGITS", "LENGTH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(args.model, args.worker[0], int(args.worker[1]), args.threads)))
+        return
+
+    model_args = ["--model", args.model] if args.model else []
+    print(f"{args.model or 'random-weight model, 4 layers, hidden 1024'}, fp32, {args.threads} thread(s)")
+    print("tokens | " + " | ".join(f"{keep} logits s / peak MB" for keep in KEEP))
+    for length in args.lengths:
+        results = [utils.run_isolated(__file__, "--worker", keep, length, "--threads", args.threads, *model_args)
+                   for keep in KEEP]
+        print(f"{length} | " + " | ".join(f"{r['seconds']:.2f} / {r['peak_rss_mb']:.0f}" for r in results))
+
+
+if __name__ == "__main__":
+    main()
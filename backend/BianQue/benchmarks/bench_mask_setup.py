@@ -0,0 +1,84 @@
+""" Batched prefill setup time: attention masks and position ids of a batch of prompts.
+
+    python benchmarks/bench_mask_setup.py --seq-lengths 512 2048 --batch-sizes 1 4 16 64
+
+"legacy" is the per-row Python code that get_masks and get_position_ids replaced, "dense" the tensorised `[b, 1, s, s]`
+bool mask and "compact" the PrefixLMMask the model builds for itself. All three produce the same masks and positions.
+"""
+
+import argparse
+
+import utils
+import torch
+
+
+def legacy_setup(model, input_ids):
+    """get_masks, the MASK/gMASK scan of forward and get_position_ids before they were tensorised."""
+    batch_size, seq_length = input_ids.shape
+    context_lengths = [seq.tolist().index(model.config.bos_token_id) for seq in input_ids]
+    attention_mask = torch.ones((batch_size, seq_length, seq_length))
+    attention_mask.tril_()
+    for i, context_length in enumerate(context_lengths):
+        attention_mask[i, :, :context_length] = 1
+    attention_mask.unsqueeze_(1)
+    attention_mask = (attention_mask < 0.5).bool()
+
+    mask_positions = []
+    for seq in input_ids.tolist():
+        mask_token = utils.GMASK if utils.GMASK in seq else utils.MASK
+        mask_positions.append(seq.index(mask_token))
+
+    context_lengths = [seq.tolist().index(model.config.bos_token_id) for seq in input_ids]
+    position_ids = torch.arange(seq_length, dtype=torch.long).unsqueeze(0).repeat(batch_size, 1)
+    for i, context_length in enumerate(context_lengths):
+        position_ids[i, context_length:] = mask_positions[i]
+    block_position_ids = [torch.cat((
+        torch.zeros(context_length, dtype=torch.long),
+        torch.arange(seq_length - context_length, dtype=torch.long) + 1
+    )) for context_length in context_lengths]
+    block_position_ids = torch.stack(block_position_ids, dim=0)
+    return attention_mask, torch.stack((position_ids, block_position_ids), dim=1)
+
+
+def setup(model, input_ids, compact):
+    if compact:
+        attention_mask = model.get_compact_masks(input_ids, input_ids.device)
+    else:
+        attention_mask = model.get_masks(input_ids, input_ids.device)
+    return attention_mask, model.get_prompt_position_ids(input_ids, input_ids.device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--seq-lengths", type=int, nargs="+", default=[512, 2048])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    # only the config of the model is used
+    model = utils.random_model(utils.make_config(hidden_size=64, num_layers=1, num_attention_heads=4,
+                                                 inner_hidden_size=128))
+    print(f"{args.threads} thread(s)")
+    print("seq | batch | legacy ms | dense ms | compact ms | legacy float mask MB")
+    for seq_length in args.seq_lengths:
+        for batch_size in args.batch_sizes:
+            input_ids = utils.random_prompt(seq_length, batch_size)
+            # answers of different lengths after the prompts put <sop> at a different index in every row
+            for i in range(batch_size):
+                input_ids[i] = input_ids[i].roll(-(i * 7 % (seq_length // 2)))
+            expected_mask, expected_positions = legacy_setup(model, input_ids)
+            dense_mask, positions = setup(model, input_ids, compact=False)
+            compact_mask, _ = setup(model, input_ids, compact=True)
+            assert torch.equal(dense_mask, expected_mask) and torch.equal(positions, expected_positions)
+            assert torch.equal(compact_mask.to_dense(seq_length, seq_length), expected_mask)
+
+            legacy = utils.best_time(lambda: legacy_setup(model, input_ids))
+            dense = utils.best_time(lambda: setup(model, input_ids, compact=False))
+            compact = utils.best_time(lambda: setup(model, input_ids, compact=True))
+            print(f"{seq_length} | {batch_size} | {legacy * 1e3:.2f} | {dense * 1e3:.2f} | {compact * 1e3:.2f} | "
+                  f"{batch_size * seq_length * seq_length * 4 / 2 ** 20:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+""" CPU prefill time and peak memory of one ChatGLM-6B attention layer, eager vs sdpa backend.
+
+    python benchmarks/bench_prefill_attention.py --lengths 512 1024 2048
+
+Every measurement runs in a fresh process. Half of the prompt is bidirectional context and the rest attends
+causally after `<sop>`, so both parts of the GLM mask are exercised.
+"""
+
+import argparse
+import json
+
+import utils
+import torch
+
+from ours.masks import PrefixLMMask
+from ours.modeling_chatglm import SelfAttention
+
+
+def measure(backend, length, mask_format, threads):
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    attention = SelfAttention(utils.CHATGLM_6B["hidden_size"], utils.CHATGLM_6B["num_attention_heads"], layer_id=5,
+                              empty_init=False, attention_backend=backend).float().eval()
+    hidden_states = torch.randn(length, 1, utils.CHATGLM_6B["hidden_size"]) * 0.1
+    context_length = length // 2
+    attention_mask = PrefixLMMask(torch.tensor([context_length]))
+    if mask_format == "dense":
+        attention_mask = attention_mask.to_dense(length, length)
+    positions = torch.arange(length)
+    position_ids = torch.stack((positions.clamp(max=context_length - 1), (positions - context_length + 1).clamp(min=0)))
+    with torch.no_grad():
+        # warm up on a few tokens, so that the measured peak is the one of the prefill
+        attention(hidden_states[:8], position_ids[None, :, :8], PrefixLMMask(torch.tensor([4])), 5)
+        base = utils.peak_rss()
+        seconds = utils.best_time(lambda: attention(hidden_states, position_ids[None], attention_mask, 5),
+                                  repeat=1, warmup=0)
+    return {"seconds": seconds, "peak_rss_mb": utils.peak_rss() - base}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--backends", nargs="+", default=["eager", "sdpa"])
+    parser.add_argument("--mask", choices=["compact", "dense"], default="compact",
+                        help="PrefixLMMask as the model builds it, or the [b, 1, s, s] bool mask of get_masks")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--worker", nargs=2, metavar=("BACKEND", "LENGTH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(args.worker[0], int(args.worker[1]), args.mask, args.threads)))
+        return
+
+    print(f"one attention layer, hidden 4096, 32 heads, fp32, {args.threads} thread(s), {args.mask} mask")
+    print("tokens | " + " | ".join(f"{backend} s / peak MB" for backend in args.backends))
+    for length in args.lengths:
+        results = [utils.run_isolated(__file__, "--worker", backend, length, "--mask", args.mask,
+                                      "--threads", args.threads) for backend in args.backends]
+        print(f"{length} | " + " | ".join(f"{r['seconds']:.2f} / {r['peak_rss_mb']:.0f}" for r in results))
+
+
+if __name__ == "__main__":
+    main()
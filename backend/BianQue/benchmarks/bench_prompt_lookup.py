@@ -0,0 +1,76 @@
+""" Prompt lookup decoding vs plain greedy decoding in a multi-turn conversation: wall-clock time and acceptance.
+
+    python benchmarks/bench_prompt_lookup.py --vocab ours/ice_text.model --turns 10
+    python benchmarks/bench_prompt_lookup.py --model <checkpoint directory> --num-tokens 10
+
+Consecutive lines of --corpus are the patient turns of one conversation. Every turn is answered greedily by `chat`
+twice, plainly and with `prompt_lookup_num_tokens=--num-tokens`, on the same history (the plain answers), and the
+answers are checked to be the same. Prompt lookup drafts what followed the last n-gram earlier in the conversation,
+so it pays off when answers repeat the history. A random-weight model (without --model) answers by repeating one
+token, which is always drafted right: its speedup is the upper bound of --num-tokens accepted drafts per step, the
+acceptance rate of real conversations needs a real checkpoint.
+"""
+
+import argparse
+import time
+
+import utils
+import torch
+
+from ours.tokenization_chatglm import ChatGLMTokenizer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="checkpoint directory with its tokenizer, a random-weight model by default")
+    parser.add_argument("--vocab", default=utils.DEFAULT_VOCAB,
+                        help="SentencePiece model of the random-weight model, ours/ice_text.model by default")
+    parser.add_argument("--corpus", nargs="+", help="UTF-8 text files, the Markdown documents of docs/ by default")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--new-tokens", type=int, default=64, help="maximum number of tokens of an answer")
+    parser.add_argument("--num-tokens", type=int, default=10, help="maximum number of drafted tokens per step")
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    if args.model:
+        tokenizer = ChatGLMTokenizer.from_pretrained(args.model)
+        model = utils.load_model(args.model)
+    else:
+        tokenizer = ChatGLMTokenizer(args.vocab)
+        config = utils.make_config(
+            vocab_size=tokenizer.vocab_size, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+            mask_token_id=tokenizer.convert_tokens_to_ids("[MASK]"), gmask_token_id=tokenizer.gmask_token_id,
+            pad_token_id=tokenizer.pad_token_id
+        )
+        model = utils.random_model(config, std=0.08)
+    queries = [line[:80] for line in utils.read_corpus(args.corpus) if len(line) > 20][:args.turns]
+
+    print(f"{model.config.num_layers} layers, hidden {model.config.hidden_size}, {len(queries)} turns, "
+          f"{args.num_tokens} drafted tokens per step, {args.threads} thread(s)")
+    print("turn | prompt tokens | answer tokens | greedy s | prompt lookup s | speedup | same answer")
+    history, greedy_seconds, lookup_seconds = [], 0.0, 0.0
+    model.speculative_stats.reset()
+    for turn, query in enumerate(queries):
+        prompt_tokens = len(tokenizer.encode(model.build_prompt(query, history)))
+        kwargs = dict(max_length=prompt_tokens + args.new_tokens, do_sample=False)
+        generated_tokens = model.speculative_stats.generated_tokens
+        start = time.perf_counter()
+        response, new_history = model.chat(tokenizer, query, history, **kwargs)
+        greedy = time.perf_counter() - start
+        start = time.perf_counter()
+        lookup_response, _ = model.chat(tokenizer, query, history, prompt_lookup_num_tokens=args.num_tokens, **kwargs)
+        lookup = time.perf_counter() - start
+        answer_tokens = model.speculative_stats.generated_tokens - generated_tokens
+        print(f"{turn + 1} | {prompt_tokens} | {answer_tokens} | {greedy:.2f} | {lookup:.2f} | "
+              f"{greedy / lookup:.2f}x | {response == lookup_response}")
+        greedy_seconds += greedy
+        lookup_seconds += lookup
+        history = new_history
+    print(f"total: greedy {greedy_seconds:.2f}s, prompt lookup {lookup_seconds:.2f}s, "
+          f"speedup {greedy_seconds / lookup_seconds:.2f}x")
+    print(f"speculative_stats: {model.speculative_stats.as_dict()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+""" Weight quantization schemes: perplexity on held-out dialogues and per-token decode latency on CPU.
+
+    python benchmarks/bench_quantization.py --vocab ours/ice_text.model
+    python benchmarks/bench_quantization.py --model <checkpoint directory> --group-size 128
+
+The schemes are per-row int8 and int4 (one scale per output row), group-wise int4 (one scale per --group-size input
+features) and activation-aware int4 (input scales searched by `search_input_scale` on calibration dialogues), alone
+and with groups. Dialogues are consecutive lines of --corpus as patient and doctor turns: the first --calibration
+ones calibrate, the next --dialogues ones are held out. Perplexity and the KL divergence to the fp32 model are
+measured on the doctor turns; the latency is the time of one decode step after a held-out prompt. Without --model
+the model has random weights, so only the KL divergence means anything; run it on the real weights to compare
+perplexities.
+"""
+
+import argparse
+import math
+
+import utils
+import torch
+
+from ours.tokenization_chatglm import ChatGLMTokenizer
+
+
+def make_dialogues(model, tokenizer, corpus_files, num_dialogues, turn_chars=60):
+    """`(input_ids, labels)` of every dialogue: a patient turn as prompt, the doctor turn after it as labels."""
+    lines = [line for line in utils.read_corpus(corpus_files) if len(line) > 20]
+    dialogues = []
+    for i in range(0, 2 * num_dialogues, 2):
+        prompt_ids = tokenizer([model.build_prompt(lines[i][:turn_chars], [])])["input_ids"][0]
+        answer_ids = tokenizer.encode(lines[i + 1][:turn_chars], add_special_tokens=False) + [tokenizer.eos_token_id]
+        dialogues.append((torch.tensor([prompt_ids + answer_ids]),
+                          torch.tensor([[-100] * len(prompt_ids) + answer_ids])))
+    return dialogues
+
+
+def answer_log_probs(model, dialogues):
+    """Log-probabilities of the vocabulary at every doctor token, and the perplexity of the doctor turns."""
+    log_probs, nll, num_tokens = [], 0.0, 0
+    for input_ids, labels in dialogues:
+        logits = model(input_ids=input_ids, use_cache=False).logits[0, :-1].double()
+        targets = labels[0, 1:]
+        logits = logits[targets != -100].log_softmax(-1)
+        nll -= logits.gather(1, targets[targets != -100, None]).sum().item()
+        num_tokens += logits.size(0)
+        log_probs.append(logits)
+    return torch.cat(log_probs), math.exp(nll / num_tokens)
+
+
+def decode_ms(model, input_ids, repeat=20):
+    outputs = model(input_ids=input_ids, use_cache=True)
+    # the same step again and again: the legacy cache is not written in place
+    inputs = model.prepare_inputs_for_generation(torch.cat((input_ids, input_ids[:, -1:]), dim=1),
+                                                 past_key_values=outputs.past_key_values)
+    return utils.best_time(lambda: model(**inputs), repeat=repeat, warmup=2) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="checkpoint directory with its tokenizer, a random-weight model by default")
+    parser.add_argument("--vocab", default=utils.DEFAULT_VOCAB,
+                        help="SentencePiece model of the random-weight model, ours/ice_text.model by default")
+    parser.add_argument("--corpus", nargs="+", help="UTF-8 text files, the Markdown documents of docs/ by default")
+    parser.add_argument("--group-size", type=int, default=128)
+    parser.add_argument("--calibration", type=int, default=16, help="number of calibration dialogues")
+    parser.add_argument("--dialogues", type=int, default=32, help="number of held-out dialogues")
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    if args.model:
+        tokenizer = ChatGLMTokenizer.from_pretrained(args.model)
+
+        def load_model():
+            return utils.load_model(args.model)
+    else:
+        tokenizer = ChatGLMTokenizer(args.vocab)
+
+        def load_model():
+            # a new config every time, `quantize` records its scheme in it
+            config = utils.make_config(
+                vocab_size=tokenizer.vocab_size, hidden_size=512, num_layers=4, num_attention_heads=8,
+                inner_hidden_size=2048, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                mask_token_id=tokenizer.convert_tokens_to_ids("[MASK]"), gmask_token_id=tokenizer.gmask_token_id,
+                pad_token_id=tokenizer.pad_token_id
+            )
+            return utils.random_model(config, std=0.08)
+
+    model = load_model()
+    dialogues = make_dialogues(model, tokenizer, args.corpus, args.calibration + args.dialogues)
+    calibration = [input_ids[0] for input_ids, _ in dialogues[:args.calibration]]
+    held_out = dialogues[args.calibration:]
+    group = f"g{args.group_size}"
+    schemes = {
+        "fp32": None,
+        "int8 per-row": dict(bits=8),
+        "int4 per-row": dict(bits=4),
+        f"int4 {group}": dict(bits=4, group_size=args.group_size),
+        "int4 per-row activation-aware": dict(bits=4, calibration_input_ids=calibration),
+        f"int4 {group} activation-aware": dict(bits=4, group_size=args.group_size, calibration_input_ids=calibration),
+    }
+
+    print(f"{model.config.num_layers} layers, hidden {model.config.hidden_size}, {len(held_out)} held-out dialogues, "
+          f"{args.threads} thread(s)")
+    print("scheme | perplexity | KL to fp32 | decode ms/token | layers MB")
+    reference = None
+    with torch.no_grad():
+        for name, kwargs in schemes.items():
+            if kwargs is not None:
+                kwargs = dict(kwargs)
+                # the scales are kept in fp16, the CPU computes in fp32
+                model = load_model().quantize(kwargs.pop("bits"), **kwargs).float()
+            log_probs, perplexity = answer_log_probs(model, held_out)
+            if reference is None:
+                reference = log_probs
+            kl = torch.nn.functional.kl_div(log_probs, reference, log_target=True, reduction="none").sum(-1).mean()
+            layers_mb = sum(tensor.numel() * tensor.element_size()
+                            for tensor in model.transformer.layers.parameters()) / 2 ** 20
+            print(f"{name} | {perplexity:.2f} | {kl.item():.2e} | {decode_ms(model, held_out[0][0]):.2f} | "
+                  f"{layers_mb:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+""" Per-token sampling time on its own: the HF processor/warper pipeline vs the fused TopKTopPSampler.
+
+    python benchmarks/bench_sampler.py --vocab-sizes 150528 130528 --top-k 50 0 --top-p 0.7
+
+The HF pipeline is the one stream_generate used to run: InvalidScoreLogitsProcessor, the temperature, top-k and
+top-p warpers, a softmax over the vocabulary and a multinomial draw. The fused sampler is what `build_sampler`
+makes of the same processors and warpers. The logits are random normal scores of --scale.
+"""
+
+import argparse
+import time
+
+import utils  # noqa: F401, puts the model code on sys.path
+import torch
+
+from transformers import GenerationConfig, GenerationMixin, LogitsProcessorList
+
+from ours.modeling_chatglm import ChatGLMForConditionalGeneration, InvalidScoreLogitsProcessor
+
+
+def median_time(fn, logits, repeat=200, warmup=10):
+    for _ in range(warmup):
+        fn(logits.clone())
+    times = []
+    for _ in range(repeat):
+        # the processors may work in place
+        scores = logits.clone()
+        start = time.perf_counter()
+        fn(scores)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--vocab-sizes", type=int, nargs="+", default=[150528, 130528])
+    parser.add_argument("--top-k", type=int, nargs="+", default=[50, 0], help="0 turns top-k off")
+    parser.add_argument("--top-p", type=float, default=0.7)
+    parser.add_argument("--temperature", type=float, default=0.95)
+    parser.add_argument("--scale", type=float, default=4.0, help="standard deviation of the random logits")
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    input_ids = torch.zeros(1, 10, dtype=torch.long)
+    print(f"temperature {args.temperature}, top_p {args.top_p}, {args.threads} thread(s)")
+    print("vocab | top_k | HF us/token | fused us/token | speed-up")
+    for vocab_size in args.vocab_sizes:
+        torch.manual_seed(0)
+        logits = torch.randn(1, vocab_size) * args.scale
+        for top_k in args.top_k:
+            generation_config = GenerationConfig(do_sample=True, temperature=args.temperature, top_p=args.top_p,
+                                                 top_k=top_k)
+            logits_processor = LogitsProcessorList([InvalidScoreLogitsProcessor()])
+            logits_warper = GenerationMixin._get_logits_warper(None, generation_config)
+            # build_sampler does not use the model
+            rest, sampler = ChatGLMForConditionalGeneration.build_sampler(None, logits_processor, logits_warper)
+
+            def hf_step(scores):
+                scores = logits_warper(input_ids, logits_processor(input_ids, scores))
+                return torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+
+            def fused_step(scores):
+                return sampler(input_ids, rest(input_ids, scores))
+
+            hf, fused = median_time(hf_step, logits), median_time(fused_step, logits)
+            print(f"{vocab_size} | {top_k or 'off'} | {hf * 1e6:.0f} | {fused * 1e6:.0f} | {hf / fused:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
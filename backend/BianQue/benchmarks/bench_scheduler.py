@@ -0,0 +1,75 @@
+""" Continuous-batching throughput by number of concurrent chats, on a KV cache pool of fixed size.
+
+    python benchmarks/bench_scheduler.py --concurrency 1 4 8 16 32 --kv-cache-memory 256
+
+Every chat is a random prompt of --prompt-length tokens answered with --new-tokens tokens, all submitted at once to
+one scheduler with --max-length as generation limit. The pool of --kv-cache-memory MiB holds far fewer sequences
+of --max-length tokens than there are chats, so the running batch only grows past that because blocks are taken
+as the sequences grow; when the pool runs dry, sequences are preempted and prefilled again later. Without --model
+the model is a random-weight ChatGLM of 4 layers and hidden size 1024.
+"""
+
+import argparse
+import threading
+import time
+
+import utils
+import torch
+
+
+def serve(model, concurrency, prompt_length, new_tokens, max_length, kv_cache_memory):
+    scheduler = model.create_scheduler(kv_cache_memory, max_batch_size=concurrency)
+    finished = {}
+
+    def consume(i, request):
+        for _ in request:
+            pass
+        finished[i] = time.perf_counter()
+
+    start = time.perf_counter()
+    requests = [scheduler.submit(utils.random_prompt(prompt_length, seed=i), max_length=max_length,
+                                 max_new_tokens=new_tokens, do_sample=False, eos_token_id=-1)
+                for i in range(concurrency)]
+    threads = [threading.Thread(target=consume, args=item) for item in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    peak_batch = 0
+    while any(thread.is_alive() for thread in threads):
+        peak_batch = max(peak_batch, len(scheduler.running))
+        time.sleep(0.005)
+    seconds = time.perf_counter() - start
+    scheduler.shutdown()
+    latency = sum(end - start for end in finished.values()) / concurrency
+    return concurrency * new_tokens / seconds, latency, peak_batch, scheduler.num_preemptions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="checkpoint directory, a random-weight model by default")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--prompt-length", type=int, default=256)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--max-length", type=int, default=2048)
+    parser.add_argument("--kv-cache-memory", type=int, default=256, help="size of the KV cache pool, in MiB")
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    model = utils.load_model(args.model)
+    kv_cache_memory = args.kv_cache_memory * 2 ** 20
+    manager = model.create_kv_cache_manager(kv_cache_memory)
+    capacity = manager.num_blocks * manager.block_size
+    del manager
+    print(f"{model.config.num_layers} layers, hidden {model.config.hidden_size}, pool of {capacity} tokens "
+          f"({capacity // args.max_length} sequences of max_length {args.max_length}), prompts of "
+          f"{args.prompt_length} tokens, {args.new_tokens} new tokens, {args.threads} thread(s)")
+    print("chats | tok/s | mean latency s | peak batch | preemptions")
+    for concurrency in args.concurrency:
+        tokens_per_second, latency, peak_batch, preemptions = serve(
+            model, concurrency, args.prompt_length, args.new_tokens, args.max_length, kv_cache_memory
+        )
+        print(f"{concurrency} | {tokens_per_second:.1f} | {latency:.2f} | {peak_batch} | {preemptions}")
+
+
+if __name__ == "__main__":
+    main()
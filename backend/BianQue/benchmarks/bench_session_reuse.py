@@ -0,0 +1,100 @@
+""" Time to first token of every turn of a conversation served like 2.py, with and without session cache reuse.
+
+    python benchmarks/bench_session_reuse.py --vocab ours/ice_text.model --turns 10
+    python benchmarks/bench_session_reuse.py --model <checkpoint directory>
+
+Consecutive lines of --corpus are the patient turns of one conversation, prompted like `answer` in 2.py (the whole
+conversation as the query, no history) and answered greedily by a scheduler. Every turn is answered with the
+session of the conversation (`reuse_session_cache = True`), which only prefills the new tokens, and its prompt is
+also submitted without it (the default), for the time to the first token only. Reusing the cache is an
+approximation, as the new turn continues the last answer causally instead of joining the bidirectional context of
+the whole prompt: the KL divergence of the first-token distributions and whether their argmax agree measure what it
+changes. A random-weight model (without --model) only tells the times; run it on the real weights for the rest.
+"""
+
+import argparse
+import time
+
+import utils
+import torch
+from transformers.generation.logits_process import LogitsProcessor, LogitsProcessorList
+
+from ours.tokenization_chatglm import ChatGLMTokenizer
+
+
+class FirstScores(LogitsProcessor):
+    """Keeps the scores of the first generated token."""
+
+    def __init__(self):
+        self.scores = None
+
+    def __call__(self, input_ids, scores):
+        if self.scores is None:
+            self.scores = scores.clone()
+        return scores
+
+
+def first_token(scheduler, tokenizer, input_text, session=None, **kwargs):
+    """The time to the first token of `input_text`, its scores and the whole answer (with a session only)."""
+    first_scores = FirstScores()
+    start = time.perf_counter()
+    stream = scheduler.stream_chat(tokenizer, input_text, logits_processor=LogitsProcessorList([first_scores]),
+                                   do_sample=False, session=session, **kwargs)
+    response, _ = next(stream)
+    seconds = time.perf_counter() - start
+    for response, _ in stream:
+        pass
+    return seconds, first_scores.scores[0].log_softmax(-1), response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", help="checkpoint directory with its tokenizer, a random-weight model by default")
+    parser.add_argument("--vocab", default=utils.DEFAULT_VOCAB,
+                        help="SentencePiece model of the random-weight model, ours/ice_text.model by default")
+    parser.add_argument("--corpus", nargs="+", help="UTF-8 text files, the Markdown documents of docs/ by default")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--new-tokens", type=int, default=64, help="maximum number of tokens of an answer")
+    parser.add_argument("--kv-cache-memory", type=int, default=256, help="size of the KV cache pool, in MiB")
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    if args.model:
+        tokenizer = ChatGLMTokenizer.from_pretrained(args.model)
+        model = utils.load_model(args.model)
+    else:
+        tokenizer = ChatGLMTokenizer(args.vocab)
+        config = utils.make_config(
+            vocab_size=tokenizer.vocab_size, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+            mask_token_id=tokenizer.convert_tokens_to_ids("[MASK]"), gmask_token_id=tokenizer.gmask_token_id,
+            pad_token_id=tokenizer.pad_token_id
+        )
+        # answers a random-weight model of smaller weights decodes to nothing
+        model = utils.random_model(config, std=0.3)
+    scheduler = model.create_scheduler(args.kv_cache_memory * 2 ** 20)
+    session = model.create_session_cache().get("benchmark")
+    queries = [line[:80] for line in utils.read_corpus(args.corpus) if len(line) > 20][:args.turns]
+
+    print(f"{model.config.num_layers} layers, hidden {model.config.hidden_size}, {len(queries)} turns of up to "
+          f"{args.new_tokens} new tokens, {args.threads} thread(s)")
+    print("turn | prompt tokens | TTFT s | TTFT with reuse s | speedup | first-token KL | same first token")
+    context = ""
+    with torch.no_grad():
+        for turn, query in enumerate(queries):
+            # the prompt of `answer` in 2.py
+            input_text = context + ("\n" if context else "") + "病人：" + query + "\n医生："
+            prompt_tokens = len(tokenizer.encode(input_text))
+            fresh, fresh_log_probs, _ = first_token(scheduler, tokenizer, input_text, max_new_tokens=1)
+            reuse, reuse_log_probs, response = first_token(scheduler, tokenizer, input_text, session=session,
+                                                           max_new_tokens=args.new_tokens)
+            kl = torch.nn.functional.kl_div(reuse_log_probs, fresh_log_probs, log_target=True, reduction="sum")
+            same = fresh_log_probs.argmax().item() == reuse_log_probs.argmax().item()
+            print(f"{turn + 1} | {prompt_tokens} | {fresh:.3f} | {reuse:.3f} | {fresh / reuse:.1f}x | "
+                  f"{kl.item():.2e} | {same}")
+            context = input_text + response
+    scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    main()
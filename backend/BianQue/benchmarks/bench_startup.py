@@ -0,0 +1,84 @@
+""" Time-to-ready and peak RSS of loading a checkpoint: from_pretrained in fp32 then .half() vs mmap shards.
+
+    python benchmarks/bench_startup.py --make /tmp/bianque-random   # once, writes random fp16 and fp32 checkpoints
+    python benchmarks/bench_startup.py --model /tmp/bianque-random
+
+"from_pretrained" is the loading of the original 2.py, "mmap" the one of `load_mmap_model` in 2.py on a GPU (fp16
+weights). On CPU the model computes in fp32: "mmap+float" maps the fp16 shards and upcasts them, which copies every
+weight into private memory, while "mmap fp32" maps the fp32 copy that 2.py writes on its first start (--model
+with the suffix -fp32), whose weights stay backed by the files. --model must hold fp16 `.bin` shards
+(`save_pretrained(..., safe_serialization=False)`), which all paths can read. Every load runs in a fresh process,
+and the last-token logits of a short prompt are compared with the ones of from_pretrained afterwards.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import utils
+import torch
+
+from ours.configuration_chatglm import ChatGLMConfig
+from ours.modeling_chatglm import ChatGLMForConditionalGeneration
+
+MODES = ["from_pretrained", "mmap", "mmap+float", "mmap fp32"]
+
+
+def load(mode, model_path):
+    start = time.perf_counter()
+    if mode.startswith("mmap"):
+        if mode == "mmap fp32":
+            model_path += "-fp32"
+        config = ChatGLMConfig.from_pretrained(model_path)
+        with torch.device("meta"):
+            model = ChatGLMForConditionalGeneration(config)
+        model.load_mmap_checkpoint(model_path)
+        if mode == "mmap+float":
+            model = model.float()
+    else:
+        model = ChatGLMForConditionalGeneration.from_pretrained(model_path, torch_dtype=torch.float32).half()
+    seconds = time.perf_counter() - start
+    peak_rss = utils.peak_rss()
+    with torch.no_grad():
+        logits = model.float().eval()(utils.random_prompt(16)).logits[0, -1]
+    return {"seconds": seconds, "peak_rss_mb": peak_rss, "logits": logits.tolist()}
+
+
+def make_checkpoint(path, num_layers, hidden_size):
+    config = utils.make_config(num_layers=num_layers, hidden_size=hidden_size, num_attention_heads=hidden_size // 128,
+                               inner_hidden_size=4 * hidden_size)
+    model = utils.random_model(config).half()
+    model.save_pretrained(path, safe_serialization=False, max_shard_size="500MB")
+    # the fp32 copy 2.py maps on CPU
+    model.float().save_pretrained(path + "-fp32", safe_serialization=False, max_shard_size="500MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--model", help="checkpoint directory with fp16 .bin shards")
+    group.add_argument("--make", metavar="PATH", help="write random-weight fp16 and fp32 checkpoints to PATH(-fp32)")
+    parser.add_argument("--layers", type=int, default=12, help="number of layers of the --make checkpoint")
+    parser.add_argument("--hidden-size", type=int, default=2048, help="hidden size of the --make checkpoint")
+    parser.add_argument("--worker", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.make:
+        make_checkpoint(args.make, args.layers, args.hidden_size)
+        return
+    if args.worker:
+        print(json.dumps(load(args.worker, args.model)))
+        return
+
+    results = {mode: utils.run_isolated(__file__, "--worker", mode, "--model", args.model)
+               for mode in MODES if mode != "mmap fp32" or os.path.isdir(args.model + "-fp32")}
+    expected = torch.tensor(results["from_pretrained"]["logits"])
+    print("load | ready s | peak RSS MB | max logit difference")
+    for mode, result in results.items():
+        difference = (torch.tensor(result["logits"]) - expected).abs().max().item()
+        print(f"{mode} | {result['seconds']:.2f} | {result['peak_rss_mb']:.0f} | {difference:.3g}")
+
+
+if __name__ == "__main__":
+    main()
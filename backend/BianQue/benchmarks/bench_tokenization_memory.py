@@ -0,0 +1,68 @@
+""" Time and memory of padding a batch of long prompts with dense vs compact attention masks.
+
+    python benchmarks/bench_tokenization_memory.py --batch-size 32 --length 2048
+
+The prompts are encoded first, then `tokenizer.pad` builds the masks and position ids of the batch, which is what is
+measured. Their lengths differ, so every prompt but the longest is padded. Each mask format runs in a fresh process.
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import utils
+
+from ours.tokenization_chatglm import ChatGLMTokenizer
+
+
+def encode_prompts(tokenizer, batch_size, length, corpus_files):
+    corpus_ids = tokenizer("".join(utils.read_corpus(corpus_files)), add_special_tokens=False)["input_ids"]
+    corpus_ids = corpus_ids * (length * 2 // len(corpus_ids) + 1)
+    special_ids = tokenizer.convert_tokens_to_ids(["[gMASK]", "<sop>"])
+    # ragged lengths, each prompt ending in [gMASK]<sop>
+    return [corpus_ids[i * 50:i * 50 + length - 2 - i * 7] + special_ids for i in range(batch_size)]
+
+
+def measure(mask_format, vocab_file, batch_size, length, corpus_files):
+    tokenizer = ChatGLMTokenizer(vocab_file, compact_attention_mask=mask_format == "compact")
+    input_ids = encode_prompts(tokenizer, batch_size, length, corpus_files)
+    base = utils.peak_rss()
+    tracemalloc.start()
+    start = time.perf_counter()
+    inputs = tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt")
+    seconds = time.perf_counter() - start
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    attention_mask = inputs["attention_mask"]
+    return {"seconds": seconds, "traced_peak_mb": traced_peak / 2 ** 20, "rss_growth_mb": utils.peak_rss() - base,
+            "mask_shape": list(attention_mask.shape),
+            "mask_mb": attention_mask.element_size() * attention_mask.nelement() / 2 ** 20}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--vocab", default=utils.DEFAULT_VOCAB,
+                        help="SentencePiece model, ours/ice_text.model by default")
+    parser.add_argument("--corpus", nargs="+", help="UTF-8 text files, the Markdown documents of docs/ by default")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--length", type=int, default=2048, help="length of the longest prompt, in tokens")
+    parser.add_argument("--worker", choices=["dense", "compact"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(args.worker, args.vocab, args.batch_size, args.length, args.corpus)))
+        return
+
+    print(f"tokenizer.pad of {args.batch_size} prompts of up to {args.length} tokens")
+    print("mask | seconds | traced peak MB | RSS growth MB | mask shape | mask MB")
+    for mask_format in ("dense", "compact"):
+        corpus_args = ["--corpus", *args.corpus] if args.corpus else []
+        result = utils.run_isolated(__file__, "--worker", mask_format, "--vocab", args.vocab, "--batch-size",
+                                    args.batch_size, "--length", args.length, *corpus_args)
+        print(f"{mask_format} | {result['seconds']:.2f} | {result['traced_peak_mb']:.0f} | "
+              f"{result['rss_growth_mb']:.0f} | {result['mask_shape']} | {result['mask_mb']:.3g}")
+
+
+if __name__ == "__main__":
+    main()
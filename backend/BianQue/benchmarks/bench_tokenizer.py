@@ -0,0 +1,78 @@
+""" ChatGLMTokenizer encode/decode throughput on Chinese health-care text.
+
+    python benchmarks/bench_tokenizer.py
+    python benchmarks/bench_tokenizer.py --baseline /tmp/before/backend/BianQue   # also checks identical output
+
+The texts are the lines of --corpus (by default the Markdown documents of docs/), with runs of spaces, newlines
+and tabs put between them so that the whitespace tokens are exercised. With --baseline the tokenizer of another
+checkout runs on the same texts, and its ids and decoded text are compared with the ones of this checkout.
+"""
+
+import argparse
+import importlib.util
+import os
+
+import utils
+
+
+def load_tokenizer(bianque_dir, vocab_file, name):
+    # tokenization_chatglm.py has no relative imports, so two versions can be loaded side by side
+    path = os.path.join(bianque_dir, "ours", "tokenization_chatglm.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.ChatGLMTokenizer(vocab_file)
+
+
+def make_texts(corpus_files, num_texts):
+    lines = utils.read_corpus(corpus_files)
+    texts = ["  ".join(lines[i:i + 4]) + "\n\t" + lines[(i * 7) % len(lines)] for i in range(len(lines))]
+    return (texts * (num_texts // len(texts) + 1))[:num_texts]
+
+
+def measure(tokenizer, texts):
+    chars = sum(map(len, texts))
+    results = {}
+    seconds = utils.best_time(lambda: [tokenizer(text)["input_ids"] for text in texts], repeat=3)
+    results["encode chars/s"] = chars / seconds
+    seconds = utils.best_time(lambda: tokenizer(texts)["input_ids"], repeat=3)
+    results["batch encode chars/s"] = chars / seconds
+    seconds = utils.best_time(lambda: [tokenizer.sp_tokenizer._encode_whitespaces(text) for text in texts], repeat=3)
+    results["whitespace ms"] = seconds * 1e3
+    ids = tokenizer(texts)["input_ids"]
+    seconds = utils.best_time(lambda: [tokenizer.decode(row) for row in ids], repeat=3)
+    results["decode ms"] = seconds * 1e3
+    seconds = utils.best_time(lambda: tokenizer.batch_decode(ids), repeat=3)
+    results["batch decode ms"] = seconds * 1e3
+    outputs = ([tokenizer(text)["input_ids"] for text in texts], ids, tokenizer.batch_decode(ids))
+    return results, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--vocab", default=utils.DEFAULT_VOCAB,
+                        help="SentencePiece model, ours/ice_text.model by default")
+    parser.add_argument("--corpus", nargs="+", help="UTF-8 text files, the Markdown documents of docs/ by default")
+    parser.add_argument("--texts", type=int, default=512, help="number of texts to encode and decode")
+    parser.add_argument("--baseline", metavar="BIANQUE_DIR", help="backend/BianQue directory of another checkout")
+    args = parser.parse_args()
+
+    texts = make_texts(args.corpus, args.texts)
+    print(f"{len(texts)} texts, {sum(map(len, texts))} chars")
+    checkouts = {"this checkout": utils.BIANQUE_DIR}
+    if args.baseline:
+        checkouts = {"baseline": args.baseline, **checkouts}
+    outputs = {}
+    for label, bianque_dir in checkouts.items():
+        tokenizer = load_tokenizer(bianque_dir, args.vocab, f"tokenization_chatglm_{len(outputs)}")
+        results, outputs[label] = measure(tokenizer, texts)
+        print(f"{label}: " + ", ".join(
+            f"{name} {value / 1e3:.0f}k" if name.endswith("/s") else f"{name} {value:.1f}"
+            for name, value in results.items()
+        ))
+    if args.baseline:
+        print("identical ids and text:", outputs["baseline"] == outputs["this checkout"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+""" Helpers shared by the benchmarks: random-weight models, timers and peak memory of a fresh process. """
+
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+# the model code in ours/ is imported as the `ours` package, like transformers does with trust_remote_code. Set
+# BIANQUE_DIR to the backend/BianQue directory of another checkout (e.g. a `git worktree` of an older commit) to
+# measure its code instead.
+BIANQUE_DIR = os.environ.get("BIANQUE_DIR") or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BIANQUE_DIR)
+
+import torch
+
+from ours.configuration_chatglm import ChatGLMConfig
+from ours.modeling_chatglm import ChatGLMForConditionalGeneration
+
+MASK, GMASK, BOS, EOS, PAD = 130000, 130001, 130004, 130005, 3
+
+DEFAULT_VOCAB = os.path.join(BIANQUE_DIR, "ours", "ice_text.model")
+# Chinese health-care text: the Markdown documents of docs/
+DEFAULT_CORPUS = os.path.join(BIANQUE_DIR, "..", "..", "docs", "**", "*.md")
+
+# ChatGLM-6B, the shape of the released BianQue-2 weights
+CHATGLM_6B = dict(hidden_size=4096, num_layers=28, num_attention_heads=32, inner_hidden_size=16384)
+
+
+def make_config(**kwargs):
+    """A ChatGLM config with the token ids of the released tokenizer, `kwargs` override the shape."""
+    config = dict(vocab_size=130528, hidden_size=1024, num_layers=4, num_attention_heads=8, inner_hidden_size=4096,
+                  max_sequence_length=2048, bos_token_id=BOS, eos_token_id=EOS, mask_token_id=MASK,
+                  gmask_token_id=GMASK, pad_token_id=PAD, use_cache=True)
+    config.update(kwargs)
+    return ChatGLMConfig(**config)
+
+
+def random_model(config, std=0.02, seed=0):
+    """A model of `config` with normal random weights, in fp32 and eval mode."""
+    model = ChatGLMForConditionalGeneration(config, empty_init=False).float().eval()
+    # lm_head shares the word embeddings, as in the released checkpoint
+    model.tie_weights()
+    torch.manual_seed(seed)
+    for param in model.parameters():
+        torch.nn.init.normal_(param, std=std)
+    return model
+
+
+def load_model(model_path=None, **config_kwargs):
+    """The checkpoint at `model_path` in fp32, or a random-weight model of `make_config(**config_kwargs)`."""
+    if model_path:
+        return ChatGLMForConditionalGeneration.from_pretrained(model_path, torch_dtype=torch.float32).eval()
+    return random_model(make_config(**config_kwargs))
+
+
+def random_prompt(length, batch_size=1, seed=1):
+    """`[b, length]` random text tokens followed by `[gMASK]<sop>`, like a prompt of the tokenizer."""
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(20005, 30000, (batch_size, length - 2), generator=generator)
+    return torch.cat((input_ids, torch.tensor([[GMASK, BOS]] * batch_size)), dim=1)
+
+
+def read_corpus(corpus_files=None):
+    """The non-empty lines of `corpus_files`, by default of the documents of `DEFAULT_CORPUS`."""
+    lines = []
+    for corpus_file in corpus_files or sorted(glob.glob(DEFAULT_CORPUS, recursive=True)):
+        with open(corpus_file, encoding="utf-8") as f:
+            lines.extend(line.strip() for line in f if line.strip())
+    return lines
+
+
+def best_time(fn, repeat=5, warmup=1):
+    """The fastest of `repeat` calls of `fn`, in seconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_rss():
+    """Peak resident memory of this process so far, in MiB (Linux reports ru_maxrss in KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    """Lower the peak resident memory to the current one (Linux only), e.g. past the transient copies of a load."""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def run_isolated(script, *args):
+    """
+    Run `script` with `args` in a fresh interpreter and return the JSON object it prints last, so that the peak
+    memory of every measurement starts from a clean process.
+    """
+    output = subprocess.run([sys.executable, script, *map(str, args)], check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
@@ -73,6 +73,10 @@ class ChatGLMConfig(PretrainedConfig):
             inner_hidden_size=16384,
             position_encoding_2d=True,
             quantization_bit=0,
+            quantize_embeddings=False,
+            quantization_group_size=None,
+            quantization_activation_aware=False,
+            quantization_plan=None,
             pre_seq_len=None,
             prefix_projection=False,
             **kwargs
@@ -92,6 +96,10 @@ class ChatGLMConfig(PretrainedConfig):
         self.gmask_token_id = gmask_token_id
         self.position_encoding_2d = position_encoding_2d
         self.quantization_bit = quantization_bit
+        self.quantize_embeddings = quantize_embeddings
+        self.quantization_group_size = quantization_group_size
+        self.quantization_activation_aware = quantization_activation_aware
+        self.quantization_plan = quantization_plan
         self.pre_seq_len = pre_seq_len
         self.prefix_projection = prefix_projection
 
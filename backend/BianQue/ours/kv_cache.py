@@ -0,0 +1,639 @@
+""" Key/value cache containers for ChatGLM generation. """
+
+import threading
+import torch
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+
+def quantize_kv(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetric int8 quantization of `x` with one half-precision scale per vector of its last dimension, i.e. per
+    token and head for keys and values. Returns `(int8 values, scales)`, the scales keep a last dimension of 1.
+    """
+    scale = (x.abs().amax(dim=-1, keepdim=True).float() / 127).half()
+    quantized = (x.float() / scale.float().clamp_(min=1e-8)).round_().clamp_(-127, 127).to(torch.int8)
+    return quantized, scale
+
+
+def dequantize_kv(quantized: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    return quantized.to(dtype) * scale.to(dtype)
+
+
+class KVCacheLayer:
+    """
+    View of a single layer of a [`KVCache`], handed to `attention_fn` as `layer_past`.
+    """
+
+    def __init__(self, cache, layer_id: int):
+        self.cache = cache
+        self.layer_id = layer_id
+
+    def update(self, key_layer: torch.Tensor, value_layer: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.cache.update(self.layer_id, key_layer, value_layer)
+
+
+class KVCache:
+    """
+    Base class of the cache objects that can be passed as `past_key_values` instead of the legacy tuple of
+    `(key, value)` pairs.
+
+    `update(layer_id, key_layer, value_layer)` receives the new keys/values of a layer as
+    `[sq, b, np, hn]` and returns all keys/values seen so far by that layer as `[b * np, sk, hn]`, which is the
+    layout consumed by the batched matmuls in `attention_fn` (a [`PagedKVCache`] returns [`PagedKVLayer`]s instead).
+    """
+
+    num_layers = 0
+
+    def __getitem__(self, layer_id: int) -> KVCacheLayer:
+        return KVCacheLayer(self, layer_id)
+
+    def __len__(self):
+        return self.num_layers
+
+    def update(self, layer_id: int, key_layer: torch.Tensor, value_layer: torch.Tensor):
+        raise NotImplementedError
+
+    def get(self, layer_id: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return all keys/values of a layer as `[b * np, sk, hn]`."""
+        raise NotImplementedError
+
+    def get_seq_length(self, layer_id: int = 0) -> int:
+        raise NotImplementedError
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        raise NotImplementedError
+
+    def crop(self, length: int):
+        """Keep only the first `length` tokens."""
+        raise NotImplementedError
+
+
+class StaticKVCache(KVCache):
+    """
+    Cache preallocated once per sequence up to `max_length` tokens and written in place, so that decoding does not
+    copy the whole cache with `torch.cat` on every step.
+
+    Keys and values are stored as `[b, np, max_length, hn]`; the returned `[b * np, sk, hn]` tensors are views on
+    the preallocated storage.
+    """
+
+    def __init__(
+            self,
+            num_layers: int,
+            batch_size: int,
+            num_attention_heads: int,
+            hidden_size_per_attention_head: int,
+            max_length: int,
+            dtype: torch.dtype = torch.half,
+            device: Optional[torch.device] = None,
+    ):
+        self.num_layers = num_layers
+        self.batch_size = batch_size
+        self.num_attention_heads = num_attention_heads
+        self.max_length = max_length
+        shape = (batch_size, num_attention_heads, max_length, hidden_size_per_attention_head)
+        self.key_cache = [torch.empty(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_cache = [torch.empty(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.seq_lengths = [0] * num_layers
+
+    @classmethod
+    def from_config(cls, config, batch_size: int, max_length: Optional[int] = None, dtype=torch.half, device=None):
+        return cls(
+            num_layers=config.num_layers,
+            batch_size=batch_size,
+            num_attention_heads=config.num_attention_heads,
+            hidden_size_per_attention_head=config.hidden_size // config.num_attention_heads,
+            max_length=max_length if max_length is not None else config.max_sequence_length,
+            dtype=dtype,
+            device=device,
+        )
+
+    def update(self, layer_id, key_layer, value_layer):
+        start = self.seq_lengths[layer_id]
+        end = start + key_layer.size(0)
+        if end > self.max_length:
+            raise ValueError(f"StaticKVCache is full: {end} tokens requested but max_length is {self.max_length}")
+
+        key_cache, value_cache = self.key_cache[layer_id], self.value_cache[layer_id]
+        # [sq, b, np, hn] -> [b, np, sq, hn]
+        key_cache[:, :, start:end].copy_(key_layer.permute(1, 2, 0, 3))
+        value_cache[:, :, start:end].copy_(value_layer.permute(1, 2, 0, 3))
+        self.seq_lengths[layer_id] = end
+
+        # [b, np, sk, hn] -> [b * np, sk, hn]
+        hidden_size = key_cache.size(-1)
+        return key_cache[:, :, :end].view(-1, end, hidden_size), value_cache[:, :, :end].view(-1, end, hidden_size)
+
+    def get(self, layer_id):
+        end = self.seq_lengths[layer_id]
+        key_cache, value_cache = self.key_cache[layer_id], self.value_cache[layer_id]
+        hidden_size = key_cache.size(-1)
+        return key_cache[:, :, :end].view(-1, end, hidden_size), value_cache[:, :, :end].view(-1, end, hidden_size)
+
+    def get_seq_length(self, layer_id=0):
+        return self.seq_lengths[layer_id]
+
+    def crop(self, length):
+        self.seq_lengths = [min(seq_length, length) for seq_length in self.seq_lengths]
+
+    def reorder_cache(self, beam_idx):
+        for layer_id in range(self.num_layers):
+            end = self.seq_lengths[layer_id]
+            for cache in (self.key_cache[layer_id], self.value_cache[layer_id]):
+                index = beam_idx.to(cache.device)
+                cache[:, :, :end].copy_(cache[:, :, :end].index_select(0, index))
+
+
+class QuantizedKVCache(KVCache):
+    """
+    Cache that stores keys and values as int8 with one scale per token and head (see `quantize_kv`), a bit more
+    than half the memory of a half-precision cache. `update` dequantizes the keys/values of one layer at a time to
+    the dtype of the model, so `attention_fn` works on ordinary `[b * np, sk, hn]` tensors.
+
+    This trades time for memory: every decode step dequantizes the whole history of every layer, so it writes and
+    reads a full-precision copy of it besides the int8 one, and is slower than with a full-precision cache by an
+    amount that grows with the context (see the decode latency of `benchmarks/bench_kv_int8.py`). Only the copy of
+    one layer is alive at a time. What is saved is the resident memory of long or many conversations; dequantizing
+    block by block inside the attention would avoid the copy, but needs a fused kernel to be faster.
+
+    Keys and values are stored as `[b, np, capacity, hn]`; the capacity grows by `chunk_size` tokens at a time, so
+    that neither every step copies the cache nor a short conversation holds a preallocated `max_length`.
+    """
+
+    def __init__(self, num_layers: int, chunk_size: int = 64):
+        self.num_layers = num_layers
+        self.chunk_size = chunk_size
+        self.key_cache: List[Optional[torch.Tensor]] = [None] * num_layers
+        self.value_cache: List[Optional[torch.Tensor]] = [None] * num_layers
+        self.key_scales: List[Optional[torch.Tensor]] = [None] * num_layers
+        self.value_scales: List[Optional[torch.Tensor]] = [None] * num_layers
+        self.seq_lengths = [0] * num_layers
+        self.dtype = None
+
+    @classmethod
+    def from_config(cls, config, chunk_size: int = 64):
+        return cls(num_layers=config.num_layers, chunk_size=chunk_size)
+
+    def _reserve(self, layer_id, key_layer, num_tokens):
+        # [sq, b, np, hn]
+        key_cache = self.key_cache[layer_id]
+        if key_cache is not None and key_cache.size(2) >= num_tokens:
+            return
+        _, b, nh, hidden_size = key_layer.shape
+        capacity = -(-num_tokens // self.chunk_size) * self.chunk_size
+        end = self.seq_lengths[layer_id]
+        for name, size in (("key_cache", hidden_size), ("value_cache", hidden_size), ("key_scales", 1),
+                           ("value_scales", 1)):
+            storage = getattr(self, name)
+            dtype = torch.int8 if size == hidden_size else torch.half
+            new = torch.zeros(b, nh, capacity, size, dtype=dtype, device=key_layer.device)
+            if storage[layer_id] is not None:
+                new[:, :, :end] = storage[layer_id][:, :, :end]
+            storage[layer_id] = new
+
+    def update(self, layer_id, key_layer, value_layer):
+        start = self.seq_lengths[layer_id]
+        end = start + key_layer.size(0)
+        self._reserve(layer_id, key_layer, end)
+        self.dtype = key_layer.dtype
+        # [sq, b, np, hn] -> [b, np, sq, hn]
+        for layer, cache, scales in ((key_layer, self.key_cache, self.key_scales),
+                                     (value_layer, self.value_cache, self.value_scales)):
+            quantized, scale = quantize_kv(layer.permute(1, 2, 0, 3))
+            cache[layer_id][:, :, start:end] = quantized
+            scales[layer_id][:, :, start:end] = scale
+        self.seq_lengths[layer_id] = end
+        return self.get(layer_id)
+
+    def get(self, layer_id):
+        end = self.seq_lengths[layer_id]
+        outputs = []
+        for cache, scales in ((self.key_cache, self.key_scales), (self.value_cache, self.value_scales)):
+            layer = dequantize_kv(cache[layer_id][:, :, :end], scales[layer_id][:, :, :end], self.dtype)
+            # [b, np, sk, hn] -> [b * np, sk, hn]
+            outputs.append(layer.view(-1, end, layer.size(-1)))
+        return tuple(outputs)
+
+    def get_seq_length(self, layer_id=0):
+        return self.seq_lengths[layer_id]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(tensor.numel() * tensor.element_size()
+                   for tensors in (self.key_cache, self.value_cache, self.key_scales, self.value_scales)
+                   for tensor in tensors if tensor is not None)
+
+    def crop(self, length):
+        self.seq_lengths = [min(seq_length, length) for seq_length in self.seq_lengths]
+
+    def reorder_cache(self, beam_idx):
+        for tensors in (self.key_cache, self.value_cache, self.key_scales, self.value_scales):
+            for layer_id, tensor in enumerate(tensors):
+                if tensor is not None:
+                    tensors[layer_id] = tensor.index_select(0, beam_idx.to(tensor.device))
+
+
+class PagedKVLayer:
+    """
+    Keys (or values) of one layer of a [`PagedKVCache`] batch as views of the block pool, without gathering them:
+    `runs[i]` are the `[np, tokens, hn]` views of the runs of consecutive blocks holding sequence `i`, in order, and
+    `seq_lengths[i]` its number of tokens. See `paged_attention_fn`.
+    """
+
+    def __init__(self, runs: List[List[torch.Tensor]], seq_lengths: List[int]):
+        self.runs = runs
+        self.seq_lengths = seq_lengths
+
+    @property
+    def max_length(self) -> int:
+        return max(self.seq_lengths)
+
+
+class PagedKVCacheManager:
+    """
+    Fixed pool of key/value blocks of `block_size` tokens shared by all sequences served by one model.
+
+    Every sequence owns a block table (the list of block ids holding its tokens, in order); blocks are taken from
+    the free ones when a sequence grows and returned when the sequence is freed, so memory does not fragment and the
+    number of sequences that fit is known up front. Per layer the pool is stored as
+    `[np, num_blocks, block_size, hn]`, so that consecutive blocks are one `[np, tokens, hn]` view: a sequence takes
+    the block after its last one when it is free, and otherwise starts a new run where there is the most room, which
+    keeps it in a few runs that attention reads in place (see [`PagedKVLayer`]).
+
+    With `dtype=torch.int8` the blocks hold keys and values quantized per token and head (see `quantize_kv`), next
+    to `[np, num_blocks, block_size, 1]` half-precision scales, which are dequantized to `compute_dtype` one run at a
+    time when they are attended to.
+    """
+
+    def __init__(
+            self,
+            num_layers: int,
+            num_blocks: int,
+            block_size: int,
+            num_attention_heads: int,
+            hidden_size_per_attention_head: int,
+            dtype: torch.dtype = torch.half,
+            device: Optional[torch.device] = None,
+            compute_dtype: Optional[torch.dtype] = None,
+    ):
+        self.num_layers = num_layers
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.num_attention_heads = num_attention_heads
+        self.hidden_size_per_attention_head = hidden_size_per_attention_head
+        self.quantized = dtype == torch.int8
+        self.compute_dtype = compute_dtype if compute_dtype is not None else (torch.half if self.quantized else dtype)
+        shape = (num_attention_heads, num_blocks, block_size, hidden_size_per_attention_head)
+        # zero-initialised so that padding read from a partially filled block is always finite
+        self.key_blocks = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_blocks = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        if self.quantized:
+            scale_shape = shape[:-1] + (1,)
+            self.key_scales = [torch.zeros(scale_shape, dtype=torch.half, device=device) for _ in range(num_layers)]
+            self.value_scales = [torch.zeros(scale_shape, dtype=torch.half, device=device) for _ in range(num_layers)]
+
+        self.free_blocks: Set[int] = set(range(num_blocks))
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seq_lengths: Dict[int, int] = {}
+        # sequences being generated, freeing one of them is deferred until it is released
+        self.in_use: Set[int] = set()
+        self._deferred_frees: Set[int] = set()
+        # called with the number of free blocks `reserve` needs when there are fewer, may free some
+        self.reclaim: Optional[Callable[[int], Any]] = None
+        self._next_seq_id = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, max_memory: int, block_size: int = 16, dtype=torch.half, device=None,
+                    compute_dtype=None):
+        """Create a manager whose pool takes at most `max_memory` bytes."""
+        hidden_size_per_attention_head = config.hidden_size // config.num_attention_heads
+        bytes_per_token = hidden_size_per_attention_head * torch.tensor([], dtype=dtype).element_size()
+        if dtype == torch.int8:
+            # one half-precision scale per token and head
+            bytes_per_token += 2
+        bytes_per_block = 2 * config.num_layers * config.num_attention_heads * block_size * bytes_per_token
+        return cls(
+            num_layers=config.num_layers,
+            num_blocks=max(max_memory // bytes_per_block, 1),
+            block_size=block_size,
+            num_attention_heads=config.num_attention_heads,
+            hidden_size_per_attention_head=hidden_size_per_attention_head,
+            dtype=dtype,
+            device=device,
+            compute_dtype=compute_dtype,
+        )
+
+    @property
+    def bytes_per_block(self) -> int:
+        nbytes = self.key_blocks[0].numel() // self.num_blocks * self.key_blocks[0].element_size()
+        if self.quantized:
+            nbytes += self.key_scales[0].numel() // self.num_blocks * self.key_scales[0].element_size()
+        return 2 * self.num_layers * nbytes
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self.free_blocks)
+
+    @property
+    def num_used_blocks(self) -> int:
+        return self.num_blocks - len(self.free_blocks)
+
+    def usage(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "used_blocks": self.num_used_blocks,
+                "free_blocks": self.num_free_blocks,
+                "total_blocks": self.num_blocks,
+                "block_size": self.block_size,
+                "bytes_per_block": self.bytes_per_block,
+                "sequences": len(self.block_tables),
+            }
+
+    def can_allocate(self, num_tokens: int) -> bool:
+        return -(-num_tokens // self.block_size) <= self.num_free_blocks
+
+    def add_sequence(self) -> int:
+        with self._lock:
+            seq_id = self._next_seq_id
+            self._next_seq_id += 1
+            self.block_tables[seq_id] = []
+            self.seq_lengths[seq_id] = 0
+        return seq_id
+
+    def free_sequence(self, seq_id: int):
+        """
+        Return the blocks of `seq_id` to the pool. Safe to call from any thread: a sequence that is being generated
+        (see `acquire`) is only freed once it is released, and freeing a sequence twice does nothing.
+        """
+        with self._lock:
+            if seq_id in self.in_use:
+                self._deferred_frees.add(seq_id)
+            else:
+                self._free(seq_id)
+
+    def _free(self, seq_id):
+        block_table = self.block_tables.pop(seq_id, None)
+        if block_table is not None:
+            self.free_blocks.update(block_table)
+            del self.seq_lengths[seq_id]
+
+    def acquire(self, seq_id: int) -> bool:
+        """Mark `seq_id` as being generated, returns False if it has been freed already."""
+        with self._lock:
+            if seq_id not in self.block_tables or seq_id in self._deferred_frees:
+                return False
+            self.in_use.add(seq_id)
+            return True
+
+    def release(self, seq_id: int) -> bool:
+        """End the generation of `seq_id`, returns False if it was freed meanwhile (its blocks are gone)."""
+        with self._lock:
+            self.in_use.discard(seq_id)
+            if seq_id in self._deferred_frees:
+                self._deferred_frees.discard(seq_id)
+                self._free(seq_id)
+            return seq_id in self.block_tables
+
+    def get_cache(self, seq_ids: List[int]) -> "PagedKVCache":
+        return PagedKVCache(self, seq_ids)
+
+    def reserve(self, seq_id: int, num_tokens: int):
+        """
+        Make sure that the block table of `seq_id` can hold `num_tokens` tokens. When the pool is short, `reclaim`
+        gets a chance to free blocks first.
+        """
+        num_blocks = -(-num_tokens // self.block_size) - len(self.block_tables[seq_id])
+        if num_blocks > len(self.free_blocks) and self.reclaim is not None:
+            self.reclaim(num_blocks)
+        with self._lock:
+            block_table = self.block_tables[seq_id]
+            num_blocks = -(-num_tokens // self.block_size) - len(block_table)
+            if num_blocks > len(self.free_blocks):
+                raise RuntimeError(
+                    f"Out of KV cache blocks: {num_blocks} more needed but only {len(self.free_blocks)} free"
+                )
+            for _ in range(num_blocks):
+                block = block_table[-1] + 1 if block_table else None
+                if block not in self.free_blocks:
+                    block = self._new_run_block()
+                self.free_blocks.remove(block)
+                block_table.append(block)
+
+    def _new_run_block(self):
+        # the longest run of free blocks; behind a used block the new run starts in its middle, which leaves room to
+        # the sequence that may grow into it
+        best_start, best_length, start = 0, 0, None
+        for block in range(self.num_blocks + 1):
+            if block < self.num_blocks and block in self.free_blocks:
+                if start is None:
+                    start = block
+            elif start is not None:
+                if block - start > best_length:
+                    best_start, best_length = start, block - start
+                start = None
+        return best_start if best_start == 0 else best_start + best_length // 2
+
+    def _slots(self, seq_ids, starts, num_tokens, device):
+        # block id and in-block offset of the positions [start, start + num_tokens) of every sequence: [b, sq]
+        positions = torch.tensor(starts, device=device)[:, None] + torch.arange(num_tokens, device=device)
+        block_tables = self._block_table_tensor(seq_ids, positions.max().item() + 1, device)
+        block_ids = block_tables.gather(1, positions // self.block_size)
+        return block_ids, positions % self.block_size
+
+    def _block_table_tensor(self, seq_ids, num_tokens, device):
+        num_blocks = -(-num_tokens // self.block_size)
+        # tables of shorter sequences are padded with their last block, reads past their end are masked out
+        return torch.tensor(
+            [(self.block_tables[seq_id] + self.block_tables[seq_id][-1:] * num_blocks)[:num_blocks]
+             for seq_id in seq_ids],
+            dtype=torch.long,
+            device=device,
+        )
+
+    def write(self, layer_id, seq_ids, starts, key_layer, value_layer):
+        block_ids, offsets = self._slots(seq_ids, starts, key_layer.size(0), self.key_blocks[layer_id].device)
+        # [sq, b, np, hn] -> [np, b, sq, hn], the layout of blocks[:, block_ids, offsets]
+        if self.quantized:
+            for layer, blocks, scales in ((key_layer, self.key_blocks, self.key_scales),
+                                          (value_layer, self.value_blocks, self.value_scales)):
+                quantized, scale = quantize_kv(layer.permute(2, 1, 0, 3))
+                blocks[layer_id][:, block_ids, offsets] = quantized
+                scales[layer_id][:, block_ids, offsets] = scale
+            return
+        for layer, blocks in ((key_layer, self.key_blocks), (value_layer, self.value_blocks)):
+            blocks[layer_id][:, block_ids, offsets] = layer.permute(2, 1, 0, 3).to(blocks[layer_id].dtype)
+
+    def read(self, layer_id, seq_ids, num_tokens):
+        """Gather the first `num_tokens` tokens of every sequence as `[b * np, num_tokens, hn]`, which copies them."""
+        key_blocks, value_blocks = self.key_blocks[layer_id], self.value_blocks[layer_id]
+        block_tables = self._block_table_tensor(seq_ids, num_tokens, key_blocks.device)
+        outputs = []
+        for blocks, scales in ((key_blocks, self.key_scales if self.quantized else None),
+                               (value_blocks, self.value_scales if self.quantized else None)):
+            gathered = blocks[:, block_tables]
+            if scales is not None:
+                gathered = dequantize_kv(gathered, scales[layer_id][:, block_tables], self.compute_dtype)
+            # [np, b, nblk, block_size, hn] -> [b, np, nblk * block_size, hn]
+            gathered = gathered.transpose(0, 1)
+            gathered = gathered.reshape(-1, gathered.size(2) * self.block_size, self.hidden_size_per_attention_head)
+            outputs.append(gathered[:, :num_tokens])
+        return tuple(outputs)
+
+    def views(self, layer_id, seq_ids, seq_lengths) -> Tuple[PagedKVLayer, PagedKVLayer]:
+        """The keys and values of the first `seq_lengths[i]` tokens of every sequence as views of the pool."""
+        outputs = []
+        for blocks, scales in ((self.key_blocks, self.key_scales if self.quantized else None),
+                               (self.value_blocks, self.value_scales if self.quantized else None)):
+            blocks = blocks[layer_id]
+            runs = []
+            for seq_id, seq_length in zip(seq_ids, seq_lengths):
+                block_table = self.block_tables[seq_id][:-(-seq_length // self.block_size)]
+                seq_runs, first, count = [], block_table[0], 0
+                for i, block in enumerate(block_table + [None]):
+                    if block is not None and block == first + count:
+                        count += 1
+                        continue
+                    # [np, count, block_size, hn] -> [np, count * block_size, hn], the last run stops at the end
+                    length = min(count * self.block_size, seq_length - (i - count) * self.block_size)
+                    run = blocks[:, first:first + count].view(blocks.size(0), -1, blocks.size(-1))[:, :length]
+                    if scales is not None:
+                        run_scales = scales[layer_id][:, first:first + count].view(blocks.size(0), -1, 1)[:, :length]
+                        run = dequantize_kv(run, run_scales, self.compute_dtype)
+                    seq_runs.append(run)
+                    first, count = block, 1
+                runs.append(seq_runs)
+            outputs.append(PagedKVLayer(runs, list(seq_lengths)))
+        return tuple(outputs)
+
+
+class PagedKVCache(KVCache):
+    """
+    Cache of a batch of sequences living in the block pool of a [`PagedKVCacheManager`].
+
+    `update` returns the keys/values of every sequence as [`PagedKVLayer`] views of the pool, which
+    `paged_attention_fn` attends to one sequence at a time, so sequences of a batch may have different lengths.
+    `get` gathers them instead, right-padded to the longest sequence.
+    """
+
+    def __init__(self, manager: PagedKVCacheManager, seq_ids: List[int]):
+        self.manager = manager
+        self.seq_ids = list(seq_ids)
+        self.num_layers = manager.num_layers
+        self.starts = [manager.seq_lengths[seq_id] for seq_id in self.seq_ids]
+        self.seq_lengths = [0] * self.num_layers
+
+    def update(self, layer_id, key_layer, value_layer):
+        num_tokens = key_layer.size(0)
+        starts = [start + self.seq_lengths[layer_id] for start in self.starts]
+        if layer_id == 0:
+            for seq_id, start in zip(self.seq_ids, starts):
+                self.manager.reserve(seq_id, start + num_tokens)
+        self.manager.write(layer_id, self.seq_ids, starts, key_layer, value_layer)
+        self.seq_lengths[layer_id] += num_tokens
+        if layer_id == self.num_layers - 1:
+            for seq_id, start in zip(self.seq_ids, starts):
+                self.manager.seq_lengths[seq_id] = start + num_tokens
+        return self.manager.views(layer_id, self.seq_ids, [start + num_tokens for start in starts])
+
+    def get(self, layer_id):
+        return self.manager.read(layer_id, self.seq_ids, self.get_seq_length(layer_id))
+
+    def get_seq_length(self, layer_id=0):
+        return max(self.starts) + self.seq_lengths[layer_id]
+
+    def reorder_cache(self, beam_idx):
+        num_tokens = self.get_seq_length()
+        for layer_id in range(self.num_layers):
+            key_layer, value_layer = self.manager.read(layer_id, self.seq_ids, num_tokens)
+            index = beam_idx.to(key_layer.device)
+            # [b * np, sk, hn] -> [sk, b, np, hn]
+            key_layer, value_layer = (
+                layer.view(len(self.seq_ids), -1, num_tokens, layer.size(-1)).index_select(0, index).permute(2, 0, 1, 3)
+                for layer in (key_layer, value_layer)
+            )
+            self.manager.write(layer_id, self.seq_ids, [0] * len(self.seq_ids), key_layer, value_layer)
+
+    def crop(self, length):
+        # blocks past `length` stay reserved and are overwritten by the next tokens
+        for seq_id in self.seq_ids:
+            self.manager.seq_lengths[seq_id] = min(self.manager.seq_lengths[seq_id], length)
+        self.starts = [self.manager.seq_lengths[seq_id] for seq_id in self.seq_ids]
+        self.seq_lengths = [0] * self.num_layers
+
+    def free(self):
+        for seq_id in self.seq_ids:
+            self.manager.free_sequence(seq_id)
+
+
+class ChatSession:
+    """
+    State of one conversation kept between chat rounds: the ids of every token seen so far, the KV cache of all
+    of them but the last one, and the text they correspond to. The next round only feeds the tokens of the new
+    text (see `ChatGLMForConditionalGeneration.stream_chat`).
+
+    `epoch` counts the resets, so that a round that was running while the session was reset does not store its
+    cache back into it (see `set_cache`).
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.input_ids = None
+        self.past_key_values = None
+        self.epoch = 0
+        self._lock = threading.Lock()
+
+    def update(self, text: str, input_ids: torch.LongTensor, past_key_values):
+        self.text = text
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+
+    def set_cache(self, input_ids: Optional[torch.LongTensor], past_key_values, epoch: int) -> bool:
+        """Store the ids and cache of a round started at `epoch`, returns False if the session was reset since."""
+        with self._lock:
+            if self.epoch != epoch:
+                return False
+            self.input_ids = input_ids
+            self.past_key_values = past_key_values
+            return True
+
+    def reset(self, epoch: Optional[int] = None):
+        """Drop the cache, unless `epoch` is given and the session has been reset since."""
+        with self._lock:
+            if epoch is not None and self.epoch != epoch:
+                return
+            # the epoch moves before the cache is dropped, so that readers of both see a consistent pair
+            self.epoch += 1
+            past_key_values = self.past_key_values
+            self.text = ""
+            self.input_ids = None
+            self.past_key_values = None
+        if isinstance(past_key_values, PagedKVCache):
+            past_key_values.free()
+
+
+class ChatSessionCache:
+    """Session-keyed store of [`ChatSession`]s, the least recently used ones are dropped beyond `max_sessions`."""
+
+    def __init__(self, max_sessions: int = 64):
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id) -> ChatSession:
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                session = ChatSession()
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                _, evicted = self.sessions.popitem(last=False)
+                evicted.reset()
+            return session
+
+    def pop(self, session_id):
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.reset()
@@ -0,0 +1,123 @@
+""" Compact attention masks of ChatGLM, expanded by the attention backends one block of queries at a time. """
+
+import torch
+from typing import Optional
+
+
+class PrefixLMMask:
+    """
+    Compact form of the `[b, 1, sq, sk]` boolean masks of `ChatGLMPreTrainedModel.get_masks`, where True marks the
+    keys a query may not attend to. GLM attends bidirectionally inside the context (the tokens before `<sop>`) and
+    causally after it, so a row of the batch is described by its context length alone:
+
+    - `context_lengths`: `[b]` index of `<sop>` in every row, which every query sees up to;
+    - `padding_lengths`: `[b]` number of left padding tokens, which no query sees and whose own rows are fully masked;
+    - `prefix_length`: number of keys in front of the sequence (the p-tuning prefix), which every query sees;
+    - `query_offset`: key index in the sequence of the first query, by default the queries are the last keys.
+
+    Nothing of size `sq * sk` is kept: `to_dense` builds the rows of a block of queries when they are attended.
+    """
+
+    def __init__(
+            self,
+            context_lengths: torch.Tensor,
+            padding_lengths: Optional[torch.Tensor] = None,
+            prefix_length: int = 0,
+            query_offset: Optional[int] = None,
+    ):
+        self.context_lengths = context_lengths
+        self.padding_lengths = padding_lengths
+        self.prefix_length = prefix_length
+        self.query_offset = query_offset
+        # every layer of a forward pass attends with the same mask
+        self._uniform_context_length = None
+        self._dense = None
+
+    @classmethod
+    def from_dense(cls, attention_mask: torch.Tensor):
+        """
+        The compact form of a `[b, 1, s, s]` mask of `get_masks` or of the tokenizer (which masks left padding). The
+        last query is past every context, so it only masks the padding, and the first query after the padding sees
+        its context (or at least itself).
+        """
+        attention_mask = attention_mask[:, 0]
+        seq_length = attention_mask.size(-1)
+        padding_lengths = attention_mask[:, -1].sum(dim=-1).clamp_(max=seq_length - 1)
+        first_rows = attention_mask.gather(1, padding_lengths[:, None, None].expand(-1, 1, seq_length))[:, 0]
+        context_lengths = padding_lengths + (~first_rows).sum(dim=-1)
+        return cls(context_lengths, padding_lengths)
+
+    @classmethod
+    def from_compact(cls, attention_mask: torch.Tensor):
+        """
+        The mask of the `[b, 1, 2]` rows of `(context length, padding length)` that `ChatGLMTokenizer` returns with
+        `compact_attention_mask=True`.
+        """
+        return cls(attention_mask[:, 0, 0], attention_mask[:, 0, 1])
+
+    @property
+    def device(self):
+        return self.context_lengths.device
+
+    def _replace(self, **kwargs):
+        fields = dict(context_lengths=self.context_lengths, padding_lengths=self.padding_lengths,
+                      prefix_length=self.prefix_length, query_offset=self.query_offset)
+        fields.update(kwargs)
+        return PrefixLMMask(**fields)
+
+    def to(self, device):
+        padding_lengths = self.padding_lengths.to(device) if self.padding_lengths is not None else None
+        return self._replace(context_lengths=self.context_lengths.to(device), padding_lengths=padding_lengths)
+
+    def select(self, index: int):
+        """The mask of row `index` of the batch alone."""
+        padding_lengths = self.padding_lengths[index:index + 1] if self.padding_lengths is not None else None
+        return self._replace(context_lengths=self.context_lengths[index:index + 1], padding_lengths=padding_lengths)
+
+    def with_prefix(self, prefix_length: int):
+        """The same mask behind `prefix_length` keys that every query attends to."""
+        return self._replace(prefix_length=prefix_length)
+
+    def with_query_offset(self, query_offset: int):
+        """The mask of the queries from key `query_offset` of the sequence on, as a block of queries is attended."""
+        return self._replace(query_offset=query_offset)
+
+    def resolve_query_offset(self, query_length: int, key_length: int):
+        if self.query_offset is not None:
+            return self.query_offset
+        return key_length - self.prefix_length - query_length
+
+    def uniform_context_length(self):
+        """The context length shared by every row when there is no padding, else None."""
+        if self._uniform_context_length is None:
+            context_lengths = self.context_lengths.tolist()
+            uniform = min(context_lengths) == max(context_lengths)
+            if self.padding_lengths is not None and self.padding_lengths.any():
+                uniform = False
+            # -1 for a batch without one
+            self._uniform_context_length = context_lengths[0] if uniform else -1
+        if self._uniform_context_length < 0:
+            return None
+        return self._uniform_context_length
+
+    def to_dense(self, query_length: int, key_length: int):
+        """The `[b, 1, query_length, key_length]` boolean mask of the queries (True for the keys not to attend to)."""
+        query_offset = self.resolve_query_offset(query_length, key_length)
+        if self._dense is not None and self._dense[0] == (query_offset, query_length, key_length):
+            return self._dense[1]
+        device = self.device
+        # positions in the sequence, without the prefix
+        queries = torch.arange(query_offset, query_offset + query_length, device=device)[None, :, None]
+        keys = torch.arange(key_length - self.prefix_length, device=device)[None, None, :]
+        context_lengths = self.context_lengths[:, None, None]
+        attention_mask = (keys > queries) & (keys >= context_lengths)
+        if self.padding_lengths is not None:
+            padding_lengths = self.padding_lengths[:, None, None]
+            attention_mask |= (keys < padding_lengths) | (queries < padding_lengths)
+        if self.prefix_length:
+            attention_mask = torch.cat(
+                (attention_mask.new_zeros(*attention_mask.shape[:2], self.prefix_length), attention_mask), dim=-1
+            )
+        attention_mask = attention_mask.unsqueeze(1)
+        self._dense = ((query_offset, query_length, key_length), attention_mask)
+        return attention_mask
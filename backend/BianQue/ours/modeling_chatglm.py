@@ -2,6 +2,9 @@
 
 import math
 import copy
+import functools
+import itertools
+import json
 import os
 import warnings
 import re
@@ -16,6 +19,8 @@ from torch.nn.utils import skip_init
 from typing import Optional, Tuple, Union, List, Callable, Dict, Any
 
 from transformers.utils import (
+    WEIGHTS_INDEX_NAME,
+    WEIGHTS_NAME,
     add_code_sample_docstrings,
     add_start_docstrings,
     add_start_docstrings_to_model_forward,
@@ -31,6 +36,14 @@ from transformers.generation.logits_process import LogitsProcessor
 from transformers.generation.utils import LogitsProcessorList, StoppingCriteriaList, GenerationConfig, ModelOutput
 
 from .configuration_chatglm import ChatGLMConfig
+from .kv_cache import (
+    KVCache, KVCacheLayer, StaticKVCache, QuantizedKVCache, PagedKVCacheManager, PagedKVLayer, ChatSession,
+    ChatSessionCache
+)
+from .masks import PrefixLMMask
+from .prefix_cache import PrefixCache
+from .sampling import TopKTopPSampler
+from .speculative import SpeculativeStats, DraftModelProposer, PromptLookupProposer, speculative_stream
 
 # flags required to enable jit fusion kernels
 
@@ -45,6 +58,9 @@ logger = logging.get_logger(__name__)
 _CHECKPOINT_FOR_DOC = "THUDM/ChatGLM-6B"
 _CONFIG_FOR_DOC = "ChatGLM6BConfig"
 
+# text tokens of the ChatGLM-6B vocabulary, the untrimmed one has 20000 image tokens in front of them
+_NUM_TEXT_TOKENS = 130528
+
 CHATGLM_6B_PRETRAINED_MODEL_ARCHIVE_LIST = [
     "THUDM/chatglm-6b",
     # See all ChatGLM-6B models at https://huggingface.co/models?filter=chatglm
@@ -52,13 +68,74 @@ CHATGLM_6B_PRETRAINED_MODEL_ARCHIVE_LIST = [
 
 
 class InvalidScoreLogitsProcessor(LogitsProcessor):
+    token_id = 5
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
         if torch.isnan(scores).any() or torch.isinf(scores).any():
             scores.zero_()
-            scores[..., 5] = 5e4
+            scores[..., self.token_id] = 5e4
         return scores
 
 
+_TRAINING_TIME_MARKER = "[[训练时间]]"
+_PUNCTUATION_PATTERNS = [
+    (re.compile(r"([\u4e00-\u9fff])%s" % half), r"\1%s" % full, re.compile(r"%s([\u4e00-\u9fff])" % half), r"%s\1" % full)
+    for half, full in [(",", "，"), ("!", "！"), (":", "："), (";", "；"), ("\?", "？")]
+]
+
+
+def normalize_punctuation(text: str) -> str:
+    """Make the ASCII punctuation next to Chinese characters full-width."""
+    for after_pattern, after_repl, before_pattern, before_repl in _PUNCTUATION_PATTERNS:
+        text = after_pattern.sub(after_repl, text)
+        text = before_pattern.sub(before_repl, text)
+    return text
+
+
+class ChatResponseStream:
+    """
+    `ChatGLMForConditionalGeneration.process_response` of a response that is generated token by token: `put` returns
+    the processed text the new ids add to the response, decoded by the `StreamDecoder` of the tokenizer, and `flush`
+    what is left once generation is over. The joined deltas equal `process_response` of the whole decoded response.
+
+    A character of the response only depends on its neighbours, so only the text that can still change is held back:
+    trailing whitespace (stripped if nothing follows), the beginning of a `[[训练时间]]` marker and ASCII punctuation
+    whose next character is not known yet.
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.pending = ""
+        # the last character returned, which the punctuation of the next ones depends on
+        self.last_char = ""
+
+    def _process(self, text, final=False):
+        text = self.pending + text
+        if not self.last_char:
+            text = text.lstrip()
+        text = text.replace(_TRAINING_TIME_MARKER, "2023年")
+        ready = text.rstrip()
+        if not final:
+            for length in range(min(len(_TRAINING_TIME_MARKER) - 1, len(ready)), 0, -1):
+                if ready.endswith(_TRAINING_TIME_MARKER[:length]):
+                    ready = ready[:-length]
+                    break
+            if ready and ready[-1] in ",!:;?":
+                ready = ready[:-1]
+        self.pending = text[len(ready):]
+        if not ready:
+            return ""
+        ready = normalize_punctuation(self.last_char + ready)[len(self.last_char):]
+        self.last_char = ready[-1]
+        return ready
+
+    def put(self, token_ids: List[int]) -> str:
+        return self._process(self.decoder.put(token_ids))
+
+    def flush(self) -> str:
+        return self._process(self.decoder.flush(), final=True)
+
+
 def load_tf_weights_in_chatglm_6b(model, config, tf_checkpoint_path):
     """Load tf checkpoints in a pytorch model."""
     try:
@@ -177,7 +254,8 @@ def gelu(x):
 class RotaryEmbedding(torch.nn.Module):
     def __init__(self, dim, base=10000, precision=torch.half, learnable=False):
         super().__init__()
-        inv_freq = 1. / (base ** (torch.arange(0, dim, 2).float() / dim))
+        # never loaded from checkpoints, so it is built on the CPU even when the model is built on the meta device
+        inv_freq = 1. / (base ** (torch.arange(0, dim, 2, device="cpu").float() / dim))
         inv_freq = inv_freq.half()
         self.learnable = learnable
         if learnable:
@@ -239,6 +317,33 @@ def apply_rotary_pos_emb_index(q, k, cos, sin, position_id):
     return q, k
 
 
+def update_layer_past(key_layer, value_layer, layer_past=None, use_cache=False):
+    """
+    Append the `[sq, b, np, hn]` keys and values of the current step to `layer_past` and return all keys and values as
+    `[b * np, sk, hn]` (as [`PagedKVLayer`]s for a paged cache) with the new cache entry of the layer.
+    """
+    b, nh = key_layer.size(1), key_layer.size(2)
+    if isinstance(layer_past, KVCacheLayer):
+        # the cache is written in place and already laid out as [b * np, sk, hn]
+        key_layer, value_layer = layer_past.update(key_layer, value_layer)
+        present = layer_past if use_cache else None
+    else:
+        if layer_past is not None:
+            past_key, past_value = layer_past[0], layer_past[1]
+            key_layer = torch.cat((past_key, key_layer), dim=0)
+            value_layer = torch.cat((past_value, value_layer), dim=0)
+
+        if use_cache:
+            present = (key_layer, value_layer)
+        else:
+            present = None
+
+        # [sk, b, np, hn] -> [b * np, sk, hn]
+        key_layer = key_layer.view(key_layer.size(0), b * nh, -1).transpose(0, 1)
+        value_layer = value_layer.view(value_layer.size(0), b * nh, -1).transpose(0, 1)
+    return key_layer, value_layer, present
+
+
 def attention_fn(
         self,
         query_layer,
@@ -247,22 +352,10 @@ def attention_fn(
         attention_mask,
         hidden_size_per_partition,
         layer_id,
-        layer_past=None,
         scaling_attention_score=True,
-        use_cache=False,
 ):
-    if layer_past is not None:
-        past_key, past_value = layer_past[0], layer_past[1]
-        key_layer = torch.cat((past_key, key_layer), dim=0)
-        value_layer = torch.cat((past_value, value_layer), dim=0)
-
-    # seqlen, batch, num_attention_heads, hidden_size_per_attention_head
-    seq_len, b, nh, hidden_size = key_layer.shape
-
-    if use_cache:
-        present = (key_layer, value_layer)
-    else:
-        present = None
+    # query_layer: [sq, b, np, hn], key_layer and value_layer: [b * np, sk, hn] (see `update_layer_past`)
+    query_length, b, nh, hidden_size = query_layer.shape
 
     query_key_layer_scaling_coeff = float(layer_id + 1)
     if scaling_attention_score:
@@ -273,12 +366,13 @@ def attention_fn(
     # ===================================
 
     # [b, np, sq, sk]
-    output_size = (query_layer.size(1), query_layer.size(2), query_layer.size(0), key_layer.size(0))
+    output_size = (b, nh, query_length, key_layer.size(1))
+
+    if isinstance(attention_mask, PrefixLMMask):
+        attention_mask = attention_mask.to_dense(query_length, key_layer.size(1))
 
     # [sq, b, np, hn] -> [sq, b * np, hn]
     query_layer = query_layer.view(output_size[2], output_size[0] * output_size[1], -1)
-    # [sk, b, np, hn] -> [sk, b * np, hn]
-    key_layer = key_layer.view(output_size[3], output_size[0] * output_size[1], -1)
 
     matmul_result = torch.zeros(
         1, 1, 1,
@@ -289,7 +383,7 @@ def attention_fn(
     matmul_result = torch.baddbmm(
         matmul_result,
         query_layer.transpose(0, 1),  # [b * np, sq, hn]
-        key_layer.transpose(0, 1).transpose(1, 2),  # [b * np, hn, sk]
+        key_layer.transpose(1, 2),  # [b * np, hn, sk]
         beta=0.0,
         alpha=1.0,
     )
@@ -317,19 +411,16 @@ def attention_fn(
     # =========================
 
     # value_layer -> context layer.
-    # [sk, b, np, hn] --> [b, np, sq, hn]
+    # [b * np, sk, hn] --> [b, np, sq, hn]
 
     # context layer shape: [b, np, sq, hn]
-    output_size = (value_layer.size(1), value_layer.size(2), query_layer.size(0), value_layer.size(3))
-
-    # change view [sk, b * np, hn]
-    value_layer = value_layer.view(value_layer.size(0), output_size[0] * output_size[1], -1)
+    output_size = (b, nh, query_length, value_layer.size(-1))
 
     # change view [b * np, sq, sk]
     attention_probs = attention_probs.view(output_size[0] * output_size[1], output_size[2], -1)
 
     # matmul: [b * np, sq, hn]
-    context_layer = torch.bmm(attention_probs, value_layer.transpose(0, 1))
+    context_layer = torch.bmm(attention_probs, value_layer)
 
     # change view [b, np, sq, hn]
     context_layer = context_layer.view(*output_size)
@@ -341,11 +432,140 @@ def attention_fn(
     new_context_layer_shape = context_layer.size()[:-2] + (hidden_size_per_partition,)
     context_layer = context_layer.view(*new_context_layer_shape)
 
-    outputs = (context_layer, present, attention_probs)
+    outputs = (context_layer, attention_probs)
 
     return outputs
 
 
+def _masked_sdpa(query_layer, key_layer, value_layer, attention_mask, scale):
+    attn_mask = None
+    if attention_mask is not None and attention_mask.any():
+        # True marks the positions to attend to, unlike `attention_mask`. The rows of left padding are fully masked,
+        # which gives NaN here rather than the uniform weights of `attention_fn`: let them attend everywhere instead.
+        attn_mask = ~attention_mask
+        attn_mask = attn_mask | ~attn_mask.any(dim=-1, keepdim=True)
+    return F.scaled_dot_product_attention(query_layer, key_layer, value_layer, attn_mask=attn_mask, scale=scale)
+
+
+def sdpa_attention_fn(
+        self,
+        query_layer,
+        key_layer,
+        value_layer,
+        attention_mask,
+        hidden_size_per_partition,
+        layer_id,
+        scaling_attention_score=True,
+):
+    """
+    `attention_fn` through `torch.nn.functional.scaled_dot_product_attention`, which fuses the score, mask and
+    softmax computation. The query is still divided by `query_key_layer_scaling_coeff` and the scores multiplied back
+    by it as the `scale` of the kernel. Attention probabilities are not returned.
+    """
+    # query_layer: [sq, b, np, hn], key_layer and value_layer: [b * np, sk, hn] (see `update_layer_past`)
+    query_length, b, nh, hidden_size = query_layer.shape
+
+    query_key_layer_scaling_coeff = float(layer_id + 1)
+    if scaling_attention_score:
+        query_layer = query_layer / (math.sqrt(hidden_size) * query_key_layer_scaling_coeff)
+
+    # [sq, b, np, hn] -> [b, np, sq, hn], [b * np, sk, hn] -> [b, np, sk, hn]
+    query_layer = query_layer.permute(1, 2, 0, 3)
+    key_layer = key_layer.view(b, nh, key_layer.size(1), -1)
+    value_layer = value_layer.view(b, nh, value_layer.size(1), -1)
+
+    scale = query_key_layer_scaling_coeff
+    if isinstance(attention_mask, PrefixLMMask):
+        context_length = attention_mask.uniform_context_length()
+        query_offset = attention_mask.resolve_query_offset(query_length, key_layer.size(2))
+        if context_length is not None and query_offset < context_length:
+            # the queries inside the context attend to exactly the context, which needs no mask at all, and only the
+            # rows after it expand the mask
+            split = min(context_length - query_offset, query_length)
+            context_key_length = attention_mask.prefix_length + context_length
+            context_layer = _masked_sdpa(query_layer[:, :, :split], key_layer[:, :, :context_key_length],
+                                         value_layer[:, :, :context_key_length], None, scale)
+            if split < query_length:
+                attention_mask = attention_mask.with_query_offset(query_offset + split).to_dense(
+                    query_length - split, key_layer.size(2))
+                context_layer = torch.cat((context_layer, _masked_sdpa(
+                    query_layer[:, :, split:], key_layer, value_layer, attention_mask, scale)), dim=2)
+        else:
+            attention_mask = attention_mask.to_dense(query_length, key_layer.size(2))
+            context_layer = _masked_sdpa(query_layer, key_layer, value_layer, attention_mask, scale)
+    else:
+        context_layer = _masked_sdpa(query_layer, key_layer, value_layer, attention_mask, scale)
+
+    # [b, np, sq, hn] --> [sq, b, hp]
+    context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
+    context_layer = context_layer.view(query_length, b, hidden_size_per_partition)
+
+    return context_layer, None
+
+
+def _attention_over_runs(query_layer, key_runs, value_runs, attention_mask, hidden_size_per_partition, layer_id):
+    # the math of `attention_fn` for one sequence whose keys/values are split in [np, tokens, hn] runs:
+    # query_layer: [sq, 1, np, hn]
+    query_length, _, nh, hidden_size = query_layer.shape
+    query_key_layer_scaling_coeff = float(layer_id + 1)
+    query_layer = query_layer / (math.sqrt(hidden_size) * query_key_layer_scaling_coeff)
+    # [sq, 1, np, hn] -> [np, sq, hn]
+    query_layer = query_layer[:, 0].transpose(0, 1)
+
+    # [np, sq, sk], the scores are small next to the keys and can be joined
+    attention_scores = torch.cat([torch.matmul(query_layer, key.transpose(1, 2)) for key in key_runs], dim=-1)
+    if isinstance(attention_mask, PrefixLMMask):
+        attention_mask = attention_mask.to_dense(query_length, attention_scores.size(-1))
+    if not (attention_mask == 0).all():
+        attention_scores.masked_fill_(attention_mask[0], -10000.0)
+    dtype = attention_scores.dtype
+    attention_probs = F.softmax(attention_scores.float() * query_key_layer_scaling_coeff, dim=-1).type(dtype)
+
+    # [np, sq, hn]
+    context_layer, start = 0, 0
+    for value in value_runs:
+        context_layer = context_layer + torch.matmul(attention_probs[..., start:start + value.size(1)], value)
+        start += value.size(1)
+    # [np, sq, hn] --> [sq, 1, hp]
+    return context_layer.transpose(0, 1).reshape(query_length, 1, hidden_size_per_partition)
+
+
+def paged_attention_fn(
+        self,
+        query_layer,
+        key_layer,
+        value_layer,
+        attention_mask,
+        hidden_size_per_partition,
+        layer_id,
+        attention_impl=attention_fn,
+):
+    """
+    Attention over the keys/values of a [`PagedKVCache`] (see [`PagedKVLayer`]) without gathering them: every
+    sequence of the batch attends on its own to the views of its runs of blocks. A sequence held by one run goes
+    through `attention_impl` like the keys/values of any other cache; the scores of several runs are joined before the
+    softmax. Attention probabilities are not returned.
+    """
+    context_layers = []
+    for i, (key_runs, value_runs) in enumerate(zip(key_layer.runs, value_layer.runs)):
+        key_length = key_layer.seq_lengths[i]
+        if isinstance(attention_mask, PrefixLMMask):
+            mask = attention_mask.select(i) if attention_mask.context_lengths.size(0) > 1 else attention_mask
+        else:
+            # [b, 1, sq, sk] masks are right-padded to the longest sequence
+            mask = attention_mask[i:i + 1] if attention_mask.size(0) > 1 else attention_mask
+            mask = mask[..., :key_length]
+        if len(key_runs) == 1:
+            context_layer, _ = attention_impl(self, query_layer[:, i:i + 1], key_runs[0], value_runs[0], mask,
+                                              hidden_size_per_partition, layer_id)
+        else:
+            context_layer = _attention_over_runs(query_layer[:, i:i + 1], key_runs, value_runs, mask,
+                                                 hidden_size_per_partition, layer_id)
+        context_layers.append(context_layer)
+    # [sq, b, hp]
+    return torch.cat(context_layers, dim=1), None
+
+
 def default_init(cls, *args, **kwargs):
     return cls(*args, **kwargs)
 
@@ -353,7 +573,7 @@ def default_init(cls, *args, **kwargs):
 class SelfAttention(torch.nn.Module):
     def __init__(self, hidden_size, num_attention_heads,
                  layer_id, hidden_size_per_attention_head=None, bias=True,
-                 params_dtype=torch.float, position_encoding_2d=True, empty_init=True):
+                 params_dtype=torch.float, position_encoding_2d=True, empty_init=True, attention_backend="eager"):
         if empty_init:
             init_method = skip_init
         else:
@@ -361,6 +581,8 @@ class SelfAttention(torch.nn.Module):
         super(SelfAttention, self).__init__()
 
         self.layer_id = layer_id
+        # "eager" (`attention_fn`) or "sdpa" (`sdpa_attention_fn`), see `config._attn_implementation`
+        self.attention_backend = attention_backend
         self.hidden_size = hidden_size
         self.hidden_size_per_partition = hidden_size
         self.num_attention_heads = num_attention_heads
@@ -435,6 +657,7 @@ class SelfAttention(torch.nn.Module):
             layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
             use_cache: bool = False,
             output_attentions: bool = False,
+            chunk_size: Optional[int] = None,
     ):
         """
         hidden_states: [seq_len, batch, hidden_size]
@@ -470,18 +693,47 @@ class SelfAttention(torch.nn.Module):
             # [seq_len, batch, num_attention_heads, hidden_size_per_attention_head]
             query_layer, key_layer = apply_rotary_pos_emb_index(query_layer, key_layer, cos, sin, position_ids)
 
+        key_layer, value_layer, present = update_layer_past(key_layer, value_layer, layer_past, use_cache)
+
+        # the fused kernel does not return the attention probabilities
+        if self.attention_backend == "sdpa" and not output_attentions:
+            attention_impl = sdpa_attention_fn
+        else:
+            attention_impl = attention_fn
+        if isinstance(key_layer, PagedKVLayer):
+            attention_impl = functools.partial(paged_attention_fn, attention_impl=attention_impl)
+            key_length = key_layer.max_length
+        else:
+            key_length = key_layer.size(1)
+
+        # queries attend in slices of `chunk_size`, which bounds the attention scores to [b, np, chunk_size, sk]
+        query_length = query_layer.size(0)
+        if not chunk_size or output_attentions:
+            chunk_size = query_length
+        context_layers = []
+        for start in range(0, query_length, chunk_size):
+            chunk_mask = attention_mask
+            if isinstance(attention_mask, PrefixLMMask):
+                # a single chunk keeps the mask of the forward pass, whose expansion every layer shares
+                if chunk_size < query_length:
+                    chunk_mask = attention_mask.with_query_offset(
+                        attention_mask.resolve_query_offset(query_length, key_length) + start
+                    )
+            elif attention_mask is not None and attention_mask.size(-2) == query_length:
+                chunk_mask = attention_mask[..., start:start + chunk_size, :]
+            # [chunk_size, batch, hidden_size]
+            context_layer, attention_probs = attention_impl(
+                self=self,
+                query_layer=query_layer[start:start + chunk_size],
+                key_layer=key_layer,
+                value_layer=value_layer,
+                attention_mask=chunk_mask,
+                hidden_size_per_partition=self.hidden_size_per_partition,
+                layer_id=layer_id
+            )
+            context_layers.append(context_layer)
         # [seq_len, batch, hidden_size]
-        context_layer, present, attention_probs = attention_fn(
-            self=self,
-            query_layer=query_layer,
-            key_layer=key_layer,
-            value_layer=value_layer,
-            attention_mask=attention_mask,
-            hidden_size_per_partition=self.hidden_size_per_partition,
-            layer_id=layer_id,
-            layer_past=layer_past,
-            use_cache=use_cache
-        )
+        context_layer = torch.cat(context_layers) if len(context_layers) > 1 else context_layers[0]
 
         output = self.dense(context_layer)
 
@@ -565,7 +817,8 @@ class GLMBlock(torch.nn.Module):
             params_dtype=torch.float,
             num_layers=28,
             position_encoding_2d=True,
-            empty_init=True
+            empty_init=True,
+            attention_backend="eager"
     ):
         super(GLMBlock, self).__init__()
         # Set output layer initialization if not provided.
@@ -586,7 +839,8 @@ class GLMBlock(torch.nn.Module):
             bias=use_bias,
             params_dtype=params_dtype,
             position_encoding_2d=self.position_encoding_2d,
-            empty_init=empty_init
+            empty_init=empty_init,
+            attention_backend=attention_backend
         )
 
         # Layernorm on the input data.
@@ -613,10 +867,12 @@ class GLMBlock(torch.nn.Module):
             layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
             use_cache: bool = False,
             output_attentions: bool = False,
+            chunk_size: Optional[int] = None,
     ):
         """
         hidden_states: [seq_len, batch, hidden_size]
         attention_mask: [(1, 1), seq_len, seq_len]
+        chunk_size: if set, the attention queries and the MLP are processed `chunk_size` tokens at a time
         """
 
         # Layer norm at the begining of the transformer layer.
@@ -631,7 +887,8 @@ class GLMBlock(torch.nn.Module):
             layer_id=layer_id,
             layer_past=layer_past,
             use_cache=use_cache,
-            output_attentions=output_attentions
+            output_attentions=output_attentions,
+            chunk_size=chunk_size
         )
 
         attention_output = attention_outputs[0]
@@ -645,7 +902,11 @@ class GLMBlock(torch.nn.Module):
         mlp_input = self.post_attention_layernorm(hidden_states)
 
         # MLP.
-        mlp_output = self.mlp(mlp_input)
+        if chunk_size and mlp_input.size(0) > chunk_size:
+            # [seq_len, batch, inner_hidden_size] would be the largest activation of a long prefill
+            mlp_output = torch.cat([self.mlp(chunk) for chunk in mlp_input.split(chunk_size)])
+        else:
+            mlp_output = self.mlp(mlp_input)
 
         # Second residual connection.
         output = mlp_input * alpha + mlp_output
@@ -669,6 +930,7 @@ class ChatGLMPreTrainedModel(PreTrainedModel):
     config_class = ChatGLMConfig
     base_model_prefix = "transformer"
     _no_split_modules = ["GLMBlock"]
+    _supports_sdpa = True
 
     def __init__(self, *inputs, **kwargs):
         super().__init__(*inputs, **kwargs)
@@ -677,41 +939,67 @@ class ChatGLMPreTrainedModel(PreTrainedModel):
         """Initialize the weights."""
         return
 
+    def get_context_lengths(self, input_ids):
+        """Index of the first `bos_token_id` of every row, the length of its bidirectional context."""
+        is_bos = input_ids == self.config.bos_token_id
+        return torch.where(is_bos.any(dim=-1), is_bos.int().argmax(dim=-1), input_ids.size(-1))
+
+    def get_mask_positions(self, input_ids):
+        """Index of the first gMASK of every row, or of its first MASK if it has none, and whether it is a gMASK."""
+        is_gmask = input_ids == self.config.gmask_token_id
+        is_mask = input_ids == self.config.mask_token_id
+        use_gmasks = is_gmask.any(dim=-1)
+        mask_positions = torch.where(use_gmasks, is_gmask.int().argmax(dim=-1), is_mask.int().argmax(dim=-1))
+        return mask_positions, use_gmasks
+
     def get_masks(self, input_ids, device):
         batch_size, seq_length = input_ids.shape
-        context_lengths = [seq.tolist().index(self.config.bos_token_id) for seq in input_ids]
-        attention_mask = torch.ones((batch_size, seq_length, seq_length), device=device)
-        attention_mask.tril_()
-        for i, context_length in enumerate(context_lengths):
-            attention_mask[i, :, :context_length] = 1
+        context_lengths = self.get_context_lengths(input_ids).to(device)
+        positions = torch.arange(seq_length, device=device)
+        # a key is masked if it comes after the query and after the context of its row
+        attention_mask = (positions[None, None, :] > positions[None, :, None]) & \
+                         (positions[None, None, :] >= context_lengths[:, None, None])
         attention_mask.unsqueeze_(1)
-        attention_mask = (attention_mask < 0.5).bool()
 
         return attention_mask
 
+    def get_compact_masks(self, input_ids, device):
+        """The masks of `get_masks` as a [`PrefixLMMask`], which the attention backends expand block by block."""
+        return PrefixLMMask(self.get_context_lengths(input_ids).to(device))
+
+    @staticmethod
+    def from_compact_masks(attention_mask):
+        """
+        The [`PrefixLMMask`] of the `[b, 1, 2]` masks that `ChatGLMTokenizer` returns with `compact_attention_mask`,
+        any other mask as it is.
+        """
+        if isinstance(attention_mask, torch.Tensor) and attention_mask.dim() == 3:
+            return PrefixLMMask.from_compact(attention_mask)
+        return attention_mask
+
     def get_position_ids(self, input_ids, mask_positions, device, use_gmasks=None):
         batch_size, seq_length = input_ids.shape
         if use_gmasks is None:
-            use_gmasks = [False] * batch_size
-        context_lengths = [seq.tolist().index(self.config.bos_token_id) for seq in input_ids]
+            use_gmasks = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        mask_positions = torch.as_tensor(mask_positions, dtype=torch.long, device=device)[:, None]
+        use_gmasks = torch.as_tensor(use_gmasks, dtype=torch.bool, device=device)[:, None]
+        context_lengths = self.get_context_lengths(input_ids).to(device)[:, None]
+        positions = torch.arange(seq_length, dtype=torch.long, device=device).unsqueeze(0).expand(batch_size, -1)
+        in_context = positions < context_lengths
         if self.position_encoding_2d:
-            position_ids = torch.arange(seq_length, dtype=torch.long, device=device).unsqueeze(0).repeat(batch_size, 1)
-            for i, context_length in enumerate(context_lengths):
-                position_ids[i, context_length:] = mask_positions[i]
-            block_position_ids = [torch.cat((
-                torch.zeros(context_length, dtype=torch.long, device=device),
-                torch.arange(seq_length - context_length, dtype=torch.long, device=device) + 1
-            )) for context_length in context_lengths]
-            block_position_ids = torch.stack(block_position_ids, dim=0)
+            position_ids = torch.where(in_context, positions, mask_positions)
+            block_position_ids = torch.where(in_context, 0, positions - context_lengths + 1)
             position_ids = torch.stack((position_ids, block_position_ids), dim=1)
         else:
-            position_ids = torch.arange(seq_length, dtype=torch.long, device=device).unsqueeze(0).repeat(batch_size, 1)
-            for i, context_length in enumerate(context_lengths):
-                if not use_gmasks[i]:
-                    position_ids[context_length:] = mask_positions[i]
+            position_ids = torch.where(in_context | use_gmasks, positions, mask_positions)
 
         return position_ids
 
+    def get_prompt_position_ids(self, input_ids, device):
+        """`get_position_ids` with the mask positions found in `input_ids`."""
+        mask_positions, use_gmasks = self.get_mask_positions(input_ids)
+        return self.get_position_ids(input_ids, mask_positions=mask_positions, device=device, use_gmasks=use_gmasks)
+
     def _set_gradient_checkpointing(self, module, value=False):
         if isinstance(module, ChatGLMModel):
             module.gradient_checkpointing = value
@@ -744,6 +1032,9 @@ CHATGLM_6B_INPUTS_DOCSTRING = r"""
             - 1 for tokens that are **not masked**,
             - 0 for tokens that are **masked**.
 
+            A mask of shape `(batch_size, 1, 2)` holds the context length and the left padding length of every row,
+            as returned by [`ChatGLMTokenizer`] with `compact_attention_mask=True`.
+
             [What are attention masks?](../glossary#attention-mask)
         token_type_ids (`torch.LongTensor` of shape `({0})`, *optional*):
             Segment token indices to indicate first and second portions of the inputs. Indices are selected in `[0, 1]`:
@@ -824,6 +1115,8 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
             dtype=self.params_dtype
         )
         self.gradient_checkpointing = False
+        self.prefix_cache = None
+        self.prefill_chunk_size = None
 
         def get_layer(layer_id):
             return GLMBlock(
@@ -837,7 +1130,8 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                 use_bias=True,
                 params_dtype=self.params_dtype,
                 position_encoding_2d=self.position_encoding_2d,
-                empty_init=empty_init
+                empty_init=empty_init,
+                attention_backend=config._attn_implementation
             )
 
         self.layers = torch.nn.ModuleList(
@@ -924,40 +1218,50 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
 
         if inputs_embeds is None:
             inputs_embeds = self.word_embeddings(input_ids)
+        attention_mask = self.from_compact_masks(attention_mask)
 
-        if past_key_values is None:
+        prefix_cache_ids = None
+        if past_key_values is None or isinstance(past_key_values, KVCache) and past_key_values.get_seq_length() == 0:
             if self.pre_seq_len is not None:
-                past_key_values = self.get_prompt(batch_size=input_ids.shape[0], device=input_ids.device,
-                                                  dtype=inputs_embeds.dtype)
-            else:
+                prompt = self.get_prompt(batch_size=input_ids.shape[0], device=input_ids.device,
+                                         dtype=inputs_embeds.dtype)
+                if past_key_values is None:
+                    past_key_values = prompt
+                else:
+                    for i, (prefix_key, prefix_value) in enumerate(prompt):
+                        past_key_values.update(i, prefix_key, prefix_value)
+            elif past_key_values is None:
                 past_key_values = tuple([None] * len(self.layers))
 
             if attention_mask is None:
-                attention_mask = self.get_masks(
+                attention_mask = self.get_compact_masks(
                     input_ids,
                     device=input_ids.device
                 )
 
-
             if position_ids is None:
-                MASK, gMASK = self.config.mask_token_id, self.config.gmask_token_id
-                seqs = input_ids.tolist()
-
-                mask_positions, use_gmasks = [], []
-                for seq in seqs:
-                    mask_token = gMASK if gMASK in seq else MASK
-                    use_gmask = mask_token == gMASK
-                    mask_positions.append(seq.index(mask_token))
-                    use_gmasks.append(use_gmask)
-
-                position_ids = self.get_position_ids(
-                    input_ids,
-                    mask_positions=mask_positions,
-                    device=input_ids.device,
-                    use_gmasks=use_gmasks
-                )
-
-        if self.pre_seq_len is not None and attention_mask is not None:
+                position_ids = self.get_prompt_position_ids(input_ids, device=input_ids.device)
+
+            if self.prefix_cache is not None and use_cache and not self.training and self.pre_seq_len is None \
+                    and input_ids is not None and batch_size == 1:
+                prefix_cache_ids = input_ids[0].tolist()
+                prefix_length, prefix = self.prefix_cache.lookup(prefix_cache_ids)
+                if prefix_length:
+                    # start from the deepest cached prefix and only prefill the remainder
+                    inputs_embeds = inputs_embeds[:, prefix_length:]
+                    if not isinstance(attention_mask, PrefixLMMask):
+                        # compact masks place the queries after the cached keys by themselves
+                        attention_mask = attention_mask[:, :, prefix_length:]
+                    position_ids = position_ids[..., prefix_length:]
+                    if isinstance(past_key_values, KVCache):
+                        for i, (prefix_key, prefix_value) in enumerate(prefix):
+                            past_key_values.update(i, prefix_key, prefix_value)
+                    else:
+                        past_key_values = prefix
+
+        if self.pre_seq_len is not None and isinstance(attention_mask, PrefixLMMask):
+            attention_mask = attention_mask.with_prefix(self.pre_seq_len)
+        elif self.pre_seq_len is not None and attention_mask is not None:
             prefix_attention_mask = torch.ones(batch_size, 1, input_ids.size(-1), self.pre_seq_len).to(
                 attention_mask.device)
             prefix_attention_mask = (prefix_attention_mask < 0.5).bool()
@@ -1000,17 +1304,32 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
                     layer_id=torch.tensor(i),
                     layer_past=layer_past,
                     use_cache=use_cache,
-                    output_attentions=output_attentions
+                    output_attentions=output_attentions,
+                    chunk_size=self.prefill_chunk_size
                 )
 
             hidden_states = layer_ret[0]
 
-            if use_cache:
+            if use_cache and not isinstance(past_key_values, KVCache):
                 presents = presents + (layer_ret[1],)
 
             if output_attentions:
                 all_self_attentions = all_self_attentions + (layer_ret[2 if use_cache else 1],)
 
+        if use_cache and isinstance(past_key_values, KVCache):
+            # layers have been written in place
+            presents = past_key_values
+
+        if prefix_cache_ids is not None:
+            if isinstance(presents, KVCache):
+                # [b * np, sk, hn] -> [sk, np, hn]
+                layers = [(key.transpose(0, 1), value.transpose(0, 1))
+                          for key, value in (presents.get(i) for i in range(len(self.layers)))]
+            else:
+                # [sk, b, np, hn] -> [sk, np, hn]
+                layers = [(key[:, 0], value[:, 0]) for key, value in presents]
+            self.prefix_cache.insert(prefix_cache_ids, layers)
+
         # Final layer norm.
         hidden_states = self.final_layernorm(hidden_states)
 
@@ -1029,6 +1348,8 @@ class ChatGLMModel(ChatGLMPreTrainedModel):
 
 
 class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
+    _tied_weights_keys = ["lm_head.weight"]
+
     def __init__(self, config: ChatGLMConfig, empty_init=True):
         super().__init__(config)
         if empty_init:
@@ -1056,9 +1377,14 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         self.config = config
 
         self.quantized = False
+        self.speculative_stats = SpeculativeStats()
 
         if self.config.quantization_bit:
-            self.quantize(self.config.quantization_bit, empty_init=True)
+            self.quantize(self.config.quantization_bit, empty_init=True,
+                          quantize_embeddings=self.config.quantize_embeddings,
+                          group_size=self.config.quantization_group_size,
+                          activation_aware=self.config.quantization_activation_aware,
+                          plan=self.config.quantization_plan)
 
     def get_output_embeddings(self):
         return self.lm_head
@@ -1078,26 +1404,24 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             outputs, standardize_cache_format=standardize_cache_format
         )
 
-        # update attention mask
+        # update attention mask: compact masks stay valid as the sequence grows, dense ones are made compact once
+        # instead of growing by a row and a column per step
         if "attention_mask" in model_kwargs:
-            attention_mask = model_kwargs["attention_mask"]
-            if attention_mask is not None and attention_mask.dtype == torch.bool:
-                attention_mask = torch.cat(
-                    [attention_mask, attention_mask.new_ones((*attention_mask.shape[:3], 1))], dim=3)
-                new_attention_mask = attention_mask[:, :, -1:].clone()
-                new_attention_mask[..., -1] = False
-                model_kwargs["attention_mask"] = torch.cat(
-                    [attention_mask, new_attention_mask], dim=2
-                )
-
-        # update position ids
-        if "position_ids" in model_kwargs:
+            attention_mask = self.from_compact_masks(model_kwargs["attention_mask"])
+            if isinstance(attention_mask, torch.Tensor) and attention_mask.dtype == torch.bool:
+                attention_mask = PrefixLMMask.from_dense(attention_mask)
+            model_kwargs["attention_mask"] = attention_mask
+
+        # update position ids: the mask position stays and the block position moves one ahead. With a cache only the
+        # position of the next token is kept, without one every step feeds the whole sequence again
+        if model_kwargs.get("position_ids") is not None:
             position_ids = model_kwargs["position_ids"]
             new_position_id = position_ids[..., -1:].clone()
-            new_position_id[:, 1, :] += 1
-            model_kwargs["position_ids"] = torch.cat(
-                [position_ids, new_position_id], dim=-1
-            )
+            if self.position_encoding_2d:
+                new_position_id[:, 1, :] += 1
+            if model_kwargs["past_key_values"] is None:
+                new_position_id = torch.cat([position_ids, new_position_id], dim=-1)
+            model_kwargs["position_ids"] = new_position_id
 
         return model_kwargs
 
@@ -1108,67 +1432,84 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             past_key_values: Optional[torch.Tensor] = None,
             attention_mask: Optional[torch.Tensor] = None,
             position_ids: Optional[torch.Tensor] = None,
+            use_static_cache: bool = False,
+            use_quantized_cache: bool = False,
+            num_logits_to_keep: int = 1,
             **kwargs
     ) -> dict:
         batch_size, seq_length = input_ids.shape
-        MASK, gMASK = self.config.mask_token_id, self.config.gmask_token_id
-        seqs = input_ids.tolist()
-        mask_positions, use_gmasks = [], []
-        for seq in seqs:
-            mask_token = gMASK if gMASK in seq else MASK
-            use_gmask = mask_token == gMASK
-            mask_positions.append(seq.index(mask_token))
-            use_gmasks.append(use_gmask)
-
-        # only last token for input_ids if past is not None
-        if past is not None or past_key_values is not None:
+        attention_mask = self.from_compact_masks(attention_mask)
+
+        if past is None:
+            past = past_key_values
+        if past is None and use_quantized_cache:
+            past = QuantizedKVCache.from_config(self.config)
+        elif past is None and use_static_cache:
+            past = StaticKVCache.from_config(self.config, batch_size, dtype=self.dtype, device=input_ids.device)
+
+        # only the tokens that are not in the cache yet if past is not None, i.e. the last one while decoding
+        if past is not None and not (isinstance(past, KVCache) and past.get_seq_length() == 0):
+            past_length = past.get_seq_length() if isinstance(past, KVCache) else past[0][0].size(0)
+            if self.transformer.pre_seq_len is not None:
+                past_length -= self.transformer.pre_seq_len
+            if seq_length - past_length > 1:
+                # continuing a cached conversation: feed its new tokens with their rows of the full mask
+                if not isinstance(attention_mask, PrefixLMMask) and \
+                        (attention_mask is None or attention_mask.dtype != torch.bool):
+                    attention_mask = self.get_compact_masks(input_ids, device=input_ids.device)
+                if position_ids is None:
+                    position_ids = self.get_prompt_position_ids(input_ids, device=input_ids.device)
+                return {
+                    "input_ids": input_ids[:, past_length:],
+                    "past_key_values": past,
+                    "position_ids": position_ids[..., past_length:],
+                    # compact masks place the queries after the cached keys by themselves
+                    "attention_mask": attention_mask if isinstance(attention_mask, PrefixLMMask)
+                    else attention_mask[:, :, past_length:],
+                    "num_logits_to_keep": num_logits_to_keep
+                }
+
             last_token = input_ids[:, -1].unsqueeze(-1)
-            if attention_mask is not None and attention_mask.dtype == torch.bool:
+            if isinstance(attention_mask, torch.Tensor) and attention_mask.dtype == torch.bool:
                 attention_mask = attention_mask[:, :, -1:]
-            else:
+            elif not isinstance(attention_mask, PrefixLMMask):
                 attention_mask = None
             if position_ids is not None:
                 position_ids = position_ids[..., -1:]
             else:
-                context_lengths = [seq.index(self.config.bos_token_id) for seq in seqs]
+                # without the state seeded by `_prepare_position_ids_for_generation`, rescan the prompt
+                mask_positions, _ = self.get_mask_positions(input_ids)
                 if self.position_encoding_2d:
-                    position_ids = torch.tensor(
-                        [[mask_position, seq_length - context_length] for mask_position, context_length in
-                         zip(mask_positions, context_lengths)], dtype=torch.long, device=input_ids.device).unsqueeze(-1)
+                    context_lengths = self.get_context_lengths(input_ids)
+                    position_ids = torch.stack((mask_positions, seq_length - context_lengths), dim=-1).unsqueeze(-1)
                 else:
-                    position_ids = torch.tensor([mask_position for mask_position in mask_positions], dtype=torch.long,
-                                                device=input_ids.device).unsqueeze(-1)
+                    position_ids = mask_positions.unsqueeze(-1)
 
-            if past is None:
-                past = past_key_values
             return {
                 "input_ids": last_token,
                 "past_key_values": past,
                 "position_ids": position_ids,
-                "attention_mask": attention_mask
+                "attention_mask": attention_mask,
+                "num_logits_to_keep": num_logits_to_keep
             }
         else:
-            if attention_mask is not None and attention_mask.dtype != torch.bool:
+            if isinstance(attention_mask, torch.Tensor) and attention_mask.dtype != torch.bool:
                 logger.warning_once(f"The dtype of attention mask ({attention_mask.dtype}) is not bool")
                 attention_mask = None
             if attention_mask is None:
-                attention_mask = self.get_masks(
+                attention_mask = self.get_compact_masks(
                     input_ids,
                     device=input_ids.device
                 )
             if position_ids is None:
-                position_ids = self.get_position_ids(
-                    input_ids,
-                    device=input_ids.device,
-                    mask_positions=mask_positions,
-                    use_gmasks=use_gmasks
-                )
+                position_ids = self.get_prompt_position_ids(input_ids, device=input_ids.device)
 
             return {
                 "input_ids": input_ids,
                 "past_key_values": past,
                 "position_ids": position_ids,
-                "attention_mask": attention_mask
+                "attention_mask": attention_mask,
+                "num_logits_to_keep": num_logits_to_keep
             }
 
     def forward(
@@ -1183,6 +1524,7 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             output_attentions: Optional[bool] = None,
             output_hidden_states: Optional[bool] = None,
             return_dict: Optional[bool] = None,
+            num_logits_to_keep: int = 0,
     ):
         use_cache = use_cache if use_cache is not None else self.config.use_cache
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
@@ -1200,6 +1542,10 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         )
 
         hidden_states = transformer_outputs[0]
+        if num_logits_to_keep and labels is None:
+            # generation only reads the logits of the last positions, [seq_len, batch, vocab_size] would be the
+            # largest tensor of a long prefill
+            hidden_states = hidden_states[-num_logits_to_keep:]
 
         lm_logits = self.lm_head(hidden_states).permute(1, 0, 2).contiguous()
 
@@ -1240,6 +1586,9 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
         Output shares the same memory storage as `past`.
         """
+        if isinstance(past, KVCache):
+            past.reorder_cache(beam_idx)
+            return past
         return tuple(
             (
                 layer_past[0].index_select(1, beam_idx.to(layer_past[0].device)),
@@ -1248,24 +1597,226 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             for layer_past in past
         )
 
+    def create_kv_cache_manager(self, max_memory: int, block_size: int = 16,
+                                kv_cache_dtype: Optional[torch.dtype] = None) -> PagedKVCacheManager:
+        """
+        Create a pool of `max_memory` bytes of KV cache blocks. Caches obtained from it with
+        `manager.get_cache(seq_ids)` can be passed as `past_key_values` to `chat`/`stream_chat`/`generate`.
+        The blocks are in the dtype of the model unless `kv_cache_dtype` is given, `torch.int8` stores them quantized
+        per token and head and fits about twice as many tokens.
+        """
+        return PagedKVCacheManager.from_config(self.config, max_memory, block_size=block_size,
+                                               dtype=kv_cache_dtype if kv_cache_dtype is not None else self.dtype,
+                                               device=self.device, compute_dtype=self.dtype)
+
+    def create_scheduler(self, max_memory: int, max_batch_size: int = 32, block_size: int = 16,
+                         kv_cache_dtype: Optional[torch.dtype] = None):
+        """
+        Create a continuous-batching scheduler that serves `chat`/`stream_chat` calls from many threads with one
+        running batch, backed by a KV cache pool of `max_memory` bytes (see `create_kv_cache_manager`).
+        """
+        from .scheduler import ContinuousBatchingScheduler
+
+        kv_cache_manager = self.create_kv_cache_manager(max_memory, block_size=block_size,
+                                                        kv_cache_dtype=kv_cache_dtype)
+        return ContinuousBatchingScheduler(self, kv_cache_manager, max_batch_size=max_batch_size)
+
+    def enable_prefix_cache(self, max_memory: int) -> PrefixCache:
+        """
+        Share the prefill of identical prompt prefixes between all requests, keeping up to `max_memory` bytes of
+        key/value states. Returns the cache, whose `stats()` report the hit rate and the prefill tokens saved.
+        """
+        self.transformer.prefix_cache = PrefixCache(max_memory, self.config.bos_token_id)
+        return self.transformer.prefix_cache
+
+    def enable_weight_cache(self, max_memory: Optional[int]):
+        """
+        Keep up to `max_memory` bytes of dequantized weights of the quantized linear layers (`None` turns it off), so
+        that the cached layers skip dequantization. The earlier layers are kept first, which a draft model of
+        `create_draft_model` also runs, and `lm_head` last; set `weight_cache_priority` of a layer to change that.
+        Returns the cache, whose `stats()` report its hits and misses.
+        """
+        from .quantization import DequantizedWeightCache, QuantizedLinear, quantized_linears
+
+        num_layers = len(self.transformer.layers)
+        linears = [(-layer_id, getattr(parent, name)) for layer_id, layer in enumerate(self.transformer.layers)
+                   for parent, name in quantized_linears(layer)] + [(-num_layers, self.lm_head)]
+        linears = [(priority, linear) for priority, linear in linears if isinstance(linear, QuantizedLinear)]
+        if not linears:
+            raise ValueError("The model has no quantized linear layers to cache")
+        cache = DequantizedWeightCache(max_memory) if max_memory is not None else None
+        for priority, linear in linears:
+            linear.weight_cache = cache
+            linear.weight_cache_priority = priority
+        return cache
+
+    def enable_chunked_prefill(self, chunk_size: Optional[int]):
+        """
+        Process long prompts `chunk_size` tokens at a time in every layer (`None` turns it off). The keys and values
+        of the whole prompt are still computed at once, since the context attends bidirectionally, but the attention
+        scores and MLP activations are bounded by `chunk_size` instead of the prompt length. Outputs are unchanged.
+        """
+        self.transformer.prefill_chunk_size = chunk_size
+
+    def trim_image_tokens(self, num_image_tokens: int = 20000):
+        """
+        Drop the rows of the first `num_image_tokens` ids, the image tokens that the text tokenizer never produces,
+        from `word_embeddings` and `lm_head`, and move the token ids of the config and generation config down by as
+        many. The model then goes with the tokenizer of `ChatGLMTokenizer.without_image_tokens`; every text id is
+        shifted by the same amount, so outputs are unchanged while the vocabulary, and the `lm_head` matmul and
+        softmax of every step, shrink by `num_image_tokens`. Only the untrimmed vocabulary of `num_image_tokens` +
+        130528 ids is accepted: checkpoints saved with `vocab_size=130528`, like BianQue-2, are already trimmed.
+        Call this before quantizing, and before creating draft models, schedulers or sessions.
+        """
+        config = self.config
+        if num_image_tokens <= 0 or config.vocab_size != num_image_tokens + _NUM_TEXT_TOKENS:
+            raise ValueError(
+                f"A vocabulary of {config.vocab_size} ids is not {num_image_tokens} image tokens followed by "
+                f"{_NUM_TEXT_TOKENS} text tokens, it may be trimmed already"
+            )
+        token_ids = {name: getattr(config, name) for name in
+                     ["bos_token_id", "eos_token_id", "mask_token_id", "gmask_token_id"]}
+        if any(token_id < num_image_tokens for token_id in token_ids.values()):
+            raise ValueError(f"The special tokens {token_ids} are not behind {num_image_tokens} image tokens")
+        if self.quantized:
+            raise ValueError("Image tokens must be trimmed before quantizing")
+
+        def shift(token_id):
+            # ids below the text tokens (such as the unused `pad_token_id=3`) are left as they are
+            if isinstance(token_id, int) and token_id >= num_image_tokens:
+                return token_id - num_image_tokens
+            if isinstance(token_id, list):
+                return [shift(x) for x in token_id]
+            return token_id
+
+        word_embeddings = self.transformer.word_embeddings
+        tied = self.lm_head.weight is word_embeddings.weight
+        word_embeddings.weight = nn.Parameter(word_embeddings.weight.data[num_image_tokens:].clone(),
+                                              requires_grad=word_embeddings.weight.requires_grad)
+        word_embeddings.num_embeddings -= num_image_tokens
+        if tied:
+            self.lm_head.weight = word_embeddings.weight
+        else:
+            self.lm_head.weight = nn.Parameter(self.lm_head.weight.data[num_image_tokens:].clone(),
+                                               requires_grad=self.lm_head.weight.requires_grad)
+        self.lm_head.out_features -= num_image_tokens
+
+        config.vocab_size -= num_image_tokens
+        self.transformer.vocab_size = config.vocab_size
+        for name in ["bos_token_id", "eos_token_id", "mask_token_id", "gmask_token_id", "pad_token_id"]:
+            setattr(config, name, shift(getattr(config, name)))
+        if self.generation_config is not None:
+            for name in ["bos_token_id", "eos_token_id", "pad_token_id", "decoder_start_token_id"]:
+                setattr(self.generation_config, name, shift(getattr(self.generation_config, name, None)))
+        prefix_cache = self.transformer.prefix_cache
+        if prefix_cache is not None:
+            # its states are keyed by the old ids
+            self.enable_prefix_cache(prefix_cache.max_memory)
+        return self
+
+    def create_draft_model(self, num_layers: int):
+        """
+        Build a draft model for speculative decoding (`draft_model=` of `chat`/`stream_chat`/`stream_generate`) from
+        the first `num_layers` layers of this model. All weights are shared, the draft costs no extra memory.
+        """
+        if self.transformer.pre_seq_len is not None:
+            raise ValueError("Draft models do not support P-tuning prefixes")
+        config = copy.deepcopy(self.config)
+        config.num_layers = num_layers
+        transformer = copy.copy(self.transformer)
+        transformer._modules = copy.copy(self.transformer._modules)
+        transformer.layers = torch.nn.ModuleList(self.transformer.layers[:num_layers])
+        transformer.num_layers = num_layers
+        transformer.prefix_cache = None
+        transformer.config = config
+        draft = copy.copy(self)
+        draft._modules = copy.copy(self._modules)
+        draft.transformer = transformer
+        draft.config = config
+        return draft
+
+    def create_session_cache(self, max_sessions: int = 64) -> ChatSessionCache:
+        """
+        Create a store of [`ChatSession`]s keyed by conversation. `sessions.get(session_id)` can be passed as
+        `session` to `chat`/`stream_chat` (of the model or a scheduler) so that every round only prefills the new
+        tokens of the conversation.
+        """
+        return ChatSessionCache(max_sessions=max_sessions)
+
     def process_response(self, response):
         response = response.strip()
-        response = response.replace("[[训练时间]]", "2023年")
-        punkts = [
-            [",", "，"],
-            ["!", "！"],
-            [":", "："],
-            [";", "；"],
-            ["\?", "？"],
-        ]
-        for item in punkts:
-            response = re.sub(r"([\u4e00-\u9fff])%s" % item[0], r"\1%s" % item[1], response)
-            response = re.sub(r"%s([\u4e00-\u9fff])" % item[0], r"%s\1" % item[1], response)
-        return response
+        response = response.replace(_TRAINING_TIME_MARKER, "2023年")
+        return normalize_punctuation(response)
+
+    def create_response_stream(self, tokenizer) -> ChatResponseStream:
+        """A [`ChatResponseStream`] that decodes and processes the ids of a response as they are generated."""
+        return ChatResponseStream(tokenizer.stream_decoder())
+
+    def build_prompt(self, query: str, history: List[Tuple[str, str]] = None):
+        if not history:
+            prompt = query
+        else:
+            prompt = ""
+            for i, (old_query, response) in enumerate(history):
+                prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
+            prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
+        return prompt
+
+    def build_sampler(self, logits_processor: LogitsProcessorList, logits_warper: LogitsProcessorList):
+        """
+        Split `logits_processor` followed by `logits_warper` into the processors that run on the whole vocabulary and
+        a [`TopKTopPSampler`] that does the rest, a trailing `InvalidScoreLogitsProcessor` included, on the top
+        candidates only. Returns `(logits_processor, None)` if the warpers cannot be fused.
+        """
+        processors = list(logits_processor)
+        invalid_score_token_id = None
+        while processors and isinstance(processors[-1], InvalidScoreLogitsProcessor):
+            invalid_score_token_id = processors.pop().token_id
+        sampler = TopKTopPSampler.from_warpers(logits_warper, invalid_score_token_id=invalid_score_token_id)
+        if sampler is None:
+            return logits_processor, None
+        return LogitsProcessorList(processors), sampler
+
+    def build_chat_logits_processor(self, logits_processor: Optional[LogitsProcessorList] = None):
+        """The logits processors of `chat`, for callers outside of this module."""
+        if logits_processor is None:
+            logits_processor = LogitsProcessorList()
+        logits_processor.append(InvalidScoreLogitsProcessor())
+        return logits_processor
+
+    def build_session_inputs(self, tokenizer, prompt: str, session: ChatSession):
+        """
+        Return the `input_ids` and `past_key_values` to generate the answer to `prompt` in `session`. When `prompt`
+        extends the text the session has already seen, only its new part is tokenized and the session's cache is
+        reused, so a new round only prefills the new tokens.
+
+        Reusing the cache is an approximation: the tokens of the new round continue the last answer causally instead
+        of joining the bidirectional context of a freshly built prompt.
+        """
+        if session.input_ids is not None and prompt.startswith(session.text):
+            input_ids = session.input_ids
+            if input_ids[0, -1].item() == self.generation_config.eos_token_id:
+                # the final EOS was never fed through the model, continue right after the answer instead
+                input_ids = input_ids[:, :-1]
+            new_ids = tokenizer.sp_tokenizer.encode(prompt[len(session.text):], add_dummy_prefix=False)
+            new_ids = torch.tensor([new_ids], dtype=torch.long, device=input_ids.device)
+            return torch.cat([input_ids, new_ids], dim=-1).to(self.device), session.past_key_values
+        session.reset()
+        return tokenizer([prompt], return_tensors="pt")["input_ids"].to(self.device), None
 
     @torch.no_grad()
     def chat(self, tokenizer, query: str, history: List[Tuple[str, str]] = None, max_length: int = 2048, num_beams=1,
-             do_sample=True, top_p=0.7, temperature=0.95, logits_processor=None, **kwargs):
+             do_sample=True, top_p=0.7, temperature=0.95, logits_processor=None, session: ChatSession = None,
+             **kwargs):
+        if session is not None or kwargs.get("draft_model") is not None or kwargs.get("prompt_lookup_num_tokens"):
+            # sessions need the cache of the final step and drafts are verified by stream_generate
+            response, new_history = "", (history or []) + [(query, "")]
+            for response, new_history in self.stream_chat(tokenizer, query, history, max_length=max_length,
+                                                          do_sample=do_sample, top_p=top_p, temperature=temperature,
+                                                          logits_processor=logits_processor, session=session,
+                                                          **kwargs):
+                pass
+            return response, new_history
         if history is None:
             history = []
         if logits_processor is None:
@@ -1273,13 +1824,7 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         logits_processor.append(InvalidScoreLogitsProcessor())
         gen_kwargs = {"max_length": max_length, "num_beams": num_beams, "do_sample": do_sample, "top_p": top_p,
                       "temperature": temperature, "logits_processor": logits_processor, **kwargs}
-        if not history:
-            prompt = query
-        else:
-            prompt = ""
-            for i, (old_query, response) in enumerate(history):
-                prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
-            prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
+        prompt = self.build_prompt(query, history)
         inputs = tokenizer([prompt], return_tensors="pt")
         inputs = inputs.to(self.device)
         outputs = self.generate(**inputs, **gen_kwargs)
@@ -1291,7 +1836,8 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
     @torch.no_grad()
     def stream_chat(self, tokenizer, query: str, history: List[Tuple[str, str]] = None, max_length: int = 2048,
-                    do_sample=True, top_p=0.7, temperature=0.95, logits_processor=None, **kwargs):
+                    do_sample=True, top_p=0.7, temperature=0.95, logits_processor=None, session: ChatSession = None,
+                    **kwargs):
         if history is None:
             history = []
         if logits_processor is None:
@@ -1299,21 +1845,50 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         logits_processor.append(InvalidScoreLogitsProcessor())
         gen_kwargs = {"max_length": max_length, "do_sample": do_sample, "top_p": top_p,
                       "temperature": temperature, "logits_processor": logits_processor, **kwargs}
-        if not history:
-            prompt = query
+        prompt = self.build_prompt(query, history)
+        if session is not None:
+            input_ids, past_key_values = self.build_session_inputs(tokenizer, prompt, session)
+            inputs = {"input_ids": input_ids, "past_key_values": past_key_values}
         else:
-            prompt = ""
-            for i, (old_query, response) in enumerate(history):
-                prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
-            prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
-        inputs = tokenizer([prompt], return_tensors="pt")
-        inputs = inputs.to(self.device)
-        for outputs in self.stream_generate(**inputs, **gen_kwargs):
-            outputs = outputs.tolist()[0][len(inputs["input_ids"][0]):]
-            response = tokenizer.decode(outputs)
-            response = self.process_response(response)
+            inputs = tokenizer([prompt], return_tensors="pt")
+            inputs = inputs.to(self.device)
+        # only the new ids of every step are decoded and processed
+        response_stream = self.create_response_stream(tokenizer)
+        response, decoded_length = "", len(inputs["input_ids"][0])
+        # with the cache, stream_generate also yields the final step, so the response ends like the one of `chat`
+        for outputs, past_key_values in self.stream_generate(**inputs, return_past_key_values=True, **gen_kwargs):
+            input_ids = outputs
+            new_ids = outputs[0, decoded_length:].tolist()
+            decoded_length = outputs.size(1)
+            if new_ids and new_ids[-1] == self.generation_config.eos_token_id:
+                new_ids = new_ids[:-1]
+            response += response_stream.put(new_ids)
+            if session is not None:
+                session.update(prompt + response, input_ids, past_key_values)
             new_history = history + [(query, response)]
             yield response, new_history
+        tail = response_stream.flush()
+        if tail:
+            response += tail
+            if session is not None:
+                session.update(prompt + response, input_ids, past_key_values)
+            yield response, history + [(query, response)]
+
+    def _prepare_position_ids_for_generation(self, input_ids, model_kwargs):
+        """
+        Compute the position ids of the prompt once, before the first step: `_update_model_kwargs_for_generation`
+        only advances them from then on, so that a decoding step does not rescan `input_ids`.
+        """
+        if model_kwargs.get("position_ids") is None:
+            model_kwargs["position_ids"] = self.get_prompt_position_ids(input_ids, device=input_ids.device)
+        return model_kwargs
+
+    @torch.no_grad()
+    def generate(self, inputs: Optional[torch.Tensor] = None, *args, **kwargs):
+        input_ids = inputs if inputs is not None else kwargs.get("input_ids")
+        if input_ids is not None and kwargs.get("inputs_embeds") is None:
+            kwargs = self._prepare_position_ids_for_generation(input_ids, kwargs)
+        return super().generate(inputs, *args, **kwargs)
 
     @torch.no_grad()
     def stream_generate(
@@ -1323,8 +1898,20 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             logits_processor: Optional[LogitsProcessorList] = None,
             stopping_criteria: Optional[StoppingCriteriaList] = None,
             prefix_allowed_tokens_fn: Optional[Callable[[int, torch.Tensor], List[int]]] = None,
+            return_past_key_values: bool = False,
+            draft_model: Optional["ChatGLMForConditionalGeneration"] = None,
+            num_speculative_tokens: int = 4,
             **kwargs,
     ):
+        """
+        Yield `input_ids` after every generated token. With `return_past_key_values`, yield `(input_ids,
+        past_key_values)` instead, including the final step, where the cache covers every token but the last one.
+
+        With a `draft_model` (see `create_draft_model`), up to `num_speculative_tokens` tokens are drafted and
+        verified per forward pass of this model. With `prompt_lookup_num_tokens`, up to that many tokens are drafted
+        by copying what followed the last n-gram of `input_ids` earlier in `input_ids`. In both modes `input_ids` may
+        grow by several tokens per step and acceptance statistics are accumulated in `self.speculative_stats`.
+        """
         batch_size, input_ids_seq_length = input_ids.shape[0], input_ids.shape[-1]
 
         if generation_config is None:
@@ -1380,6 +1967,19 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
         )
         logits_warper = self._get_logits_warper(generation_config)
 
+        if draft_model is not None or generation_config.prompt_lookup_num_tokens:
+            if draft_model is not None:
+                proposer = DraftModelProposer(draft_model, num_tokens=num_speculative_tokens)
+            else:
+                proposer = PromptLookupProposer(num_tokens=generation_config.prompt_lookup_num_tokens)
+            yield from speculative_stream(
+                self, proposer, input_ids, generation_config, logits_processor, logits_warper, stopping_criteria,
+                model_kwargs, return_past_key_values=return_past_key_values,
+            )
+            return
+
+        model_kwargs = self._prepare_position_ids_for_generation(input_ids, model_kwargs)
+        logits_processor, sampler = self.build_sampler(logits_processor, logits_warper)
         unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
         scores = None
         while True:
@@ -1396,14 +1996,17 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
 
             # pre-process distribution
             next_token_scores = logits_processor(input_ids, next_token_logits)
-            next_token_scores = logits_warper(input_ids, next_token_scores)
-
-            # sample
-            probs = nn.functional.softmax(next_token_scores, dim=-1)
-            if generation_config.do_sample:
-                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            if sampler is not None:
+                next_tokens = sampler(input_ids, next_token_scores, do_sample=generation_config.do_sample)
             else:
-                next_tokens = torch.argmax(probs, dim=-1)
+                next_token_scores = logits_warper(input_ids, next_token_scores)
+
+                # sample
+                probs = nn.functional.softmax(next_token_scores, dim=-1)
+                if generation_config.do_sample:
+                    next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+                else:
+                    next_tokens = torch.argmax(probs, dim=-1)
 
             # update generated ids, model inputs, and length for next step
             input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
@@ -1413,23 +2016,118 @@ class ChatGLMForConditionalGeneration(ChatGLMPreTrainedModel):
             unfinished_sequences = unfinished_sequences.mul((sum(next_tokens != i for i in eos_token_id)).long())
 
             # stop when each sentence is finished, or if we exceed the maximum length
-            if unfinished_sequences.max() == 0 or stopping_criteria(input_ids, scores):
+            finished = unfinished_sequences.max() == 0 or stopping_criteria(input_ids, scores)
+            if return_past_key_values:
+                yield input_ids, model_kwargs["past_key_values"]
+            if finished:
                 break
-            yield input_ids
+            if not return_past_key_values:
+                yield input_ids
+
+    def load_mmap_checkpoint(self, checkpoint_path: str):
+        """
+        Load the `pytorch_model*.bin` shards of `checkpoint_path` by memory-mapping them. The parameters keep the
+        dtype of the checkpoint and are backed by the files themselves: pages are only read on first touch (most rows
+        of `word_embeddings` never are) and every process loading the same files shares them in the page cache.
 
-    def quantize(self, bits: int, empty_init=False, **kwargs):
+        The shards must be in the zipfile format of `torch.save` (`save_pretrained(..., safe_serialization=False)`).
+        Build the model on the meta device (`with torch.device("meta"): AutoModel.from_config(...)`) so that the
+        weights replaced here are never allocated. Needs torch 2.1 or later (`mmap` and `assign`).
+        """
+        index_file = os.path.join(checkpoint_path, WEIGHTS_INDEX_NAME)
+        if os.path.isfile(index_file):
+            with open(index_file, encoding="utf-8") as f:
+                shard_files = sorted(set(json.load(f)["weight_map"].values()))
+        else:
+            shard_files = [WEIGHTS_NAME]
+
+        parameters = dict(self.named_parameters(remove_duplicate=False))
+        for shard_file in shard_files:
+            state_dict = torch.load(os.path.join(checkpoint_path, shard_file), map_location="cpu", mmap=True,
+                                    weights_only=True)
+            # assign=True makes plain tensors trainable parameters, which the int8 quantized weights cannot be
+            for name, tensor in state_dict.items():
+                if name in parameters:
+                    state_dict[name] = nn.Parameter(tensor, requires_grad=parameters[name].requires_grad)
+            self.load_state_dict(state_dict, strict=False, assign=True)
+        self.tie_weights()
+
+        missing = [name for name, tensor in itertools.chain(self.named_parameters(), self.named_buffers())
+                   if tensor.is_meta]
+        if missing:
+            raise ValueError(f"Weights missing from {checkpoint_path}: {', '.join(missing)}")
+        return self
+
+    def tie_weights(self):
+        super().tie_weights()
+        if self.lm_head.weight is self.transformer.word_embeddings.weight and hasattr(self.lm_head, "weight_scale"):
+            # a quantized lm_head shares the scales of the quantized embeddings as well
+            self.lm_head.weight_scale = self.transformer.word_embeddings.weight_scale
+
+    def plan_quantization(self, calibration_input_ids, max_memory: Optional[int] = None,
+                          max_latency: Optional[float] = None, bit_widths=(4, 8), group_size: Optional[int] = None):
+        """
+        Choose the bit width of every layer among `bit_widths` and 0 (left in floating point) for `quantize(bits,
+        plan=...)`: the layers whose output changes the most when quantized on the calibration samples (token ids,
+        one sequence each) get the most bits, while the linear layers of all blocks take at most `max_memory` bytes,
+        or at most `max_latency` seconds per decoded token. Run it on the model in full precision, in the dtype and
+        on the device it will be served with.
+        """
+        from .quantization import choose_layer_bits, layer_costs, measure_layer_sensitivity
+
+        if (max_memory is None) == (max_latency is None):
+            raise ValueError("Give exactly one of max_memory and max_latency")
+        if self.quantized:
+            raise ValueError("Quantization must be planned before quantizing")
+        sensitivity = measure_layer_sensitivity(self, calibration_input_ids, bit_widths, group_size=group_size)
+        metric = "memory" if max_memory is not None else "latency"
+        costs = layer_costs(self, (0,) + tuple(bit_widths), group_size=group_size, metric=metric)
+        plan = choose_layer_bits(sensitivity, costs, max_memory if max_memory is not None else max_latency)
+        logger.info(f"Quantization plan {plan}, layer sensitivity {sensitivity}, layer {metric} costs {costs}")
+        return plan
+
+    def quantize(self, bits: int, empty_init=False, quantize_embeddings=False, group_size: Optional[int] = None,
+                 calibration_input_ids=None, plan: Optional[List[int]] = None, **kwargs):
+        """
+        Quantize the linear layers of the transformer to `bits`, and with `quantize_embeddings=True` also
+        `word_embeddings` and `lm_head` (with row-wise scales), which otherwise stay in fp16. That saves most of the
+        memory of the vocabulary, but every token then projects through a quantized `lm_head`, which is slower than
+        a floating-point one without the CUDA kernels and less accurate.
+
+        The linear layers get one scale per `group_size` input features of a row (such as 64 or 128) instead of one
+        per row, which loses less precision at int4. `calibration_input_ids`, token ids of a sample of transcripts (one
+        sequence each), calibrates activation-aware input scales on them; run it on a model that can run forward in
+        its dtype (not fp16 on CPU). A `plan` of `plan_quantization` sets the bits of every layer instead.
+        """
         if bits == 0:
             return
 
-        from .quantization import quantize
+        from .quantization import collect_input_statistics, quantize, quantize_embedding_layers
 
         if self.quantized:
             logger.info("Already quantized.")
             return self
 
+        input_statistics = None
+        if calibration_input_ids is not None and not empty_init:
+            input_statistics = collect_input_statistics(self, calibration_input_ids)
+
         self.quantized = True
 
         self.config.quantization_bit = bits
-
-        self.transformer = quantize(self.transformer, bits, empty_init=empty_init, **kwargs)
+        self.config.quantize_embeddings = quantize_embeddings
+        self.config.quantization_group_size = group_size
+        activation_aware = input_statistics is not None or kwargs.get("activation_aware", False)
+        self.config.quantization_activation_aware = activation_aware
+        self.config.quantization_plan = list(plan) if plan is not None else None
+
+        self.transformer = quantize(self.transformer, bits, empty_init=empty_init, group_size=group_size,
+                                    input_statistics=input_statistics, plan=plan, **kwargs)
+        if quantize_embeddings:
+            if empty_init:
+                # the weights are tied after they are loaded
+                tied = self.config.tie_word_embeddings
+            else:
+                tied = self.lm_head.weight is self.transformer.word_embeddings.weight
+            quantize_embedding_layers(self, bits, empty_init=empty_init, tied=tied)
         return self
@@ -0,0 +1,176 @@
+""" Prefix cache of prompt key/value states shared by every request of a ChatGLM model. """
+
+import threading
+import torch
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+class PrefixCacheNode:
+    """Edge of a [`PrefixCache`]: a run of tokens and their key/values as `[num_layers, 2, len(tokens), np, hn]`."""
+
+    def __init__(self, tokens: Tuple[int, ...], kv: torch.Tensor, parent: Optional["PrefixCacheNode"] = None):
+        self.tokens = tokens
+        self.kv = kv
+        self.parent = parent
+        self.children: Dict[int, "PrefixCacheNode"] = {}
+        self.last_access = 0
+
+    @property
+    def nbytes(self):
+        return self.kv.numel() * self.kv.element_size()
+
+
+class PrefixCache:
+    """
+    Radix tree over prompt token ids whose edges hold the key/value states of their tokens, so that requests
+    starting with the same tokens only prefill the remainder. The least recently used leaves are evicted once the
+    cached states take more than `max_memory` bytes.
+
+    GLM attends bidirectionally inside the context (the tokens before `<sop>`), so the states of a context depend on
+    all of its tokens: the first edge of every path is a whole context and is only reused on an exact match. The
+    tokens from `<sop>` on attend causally and share any common prefix.
+    """
+
+    def __init__(self, max_memory: int, bos_token_id: int):
+        self.max_memory = max_memory
+        self.bos_token_id = bos_token_id
+        self.contexts: Dict[Tuple[int, ...], PrefixCacheNode] = {}
+        self.nbytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.queried_tokens = 0
+        self.saved_tokens = 0
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "queried_tokens": self.queried_tokens,
+            "saved_tokens": self.saved_tokens,
+            "saved_token_rate": self.saved_tokens / self.queried_tokens if self.queried_tokens else 0.0,
+            "nbytes": self.nbytes,
+            "max_memory": self.max_memory,
+        }
+
+    def lookup(self, input_ids: List[int]):
+        """
+        Return how many leading tokens of `input_ids` have cached states (at most all but the last one, whose logits
+        are still needed) and these states as one `(key, value)` pair of shape `[n, 1, np, hn]` per layer.
+        """
+        with self._lock:
+            self.lookups += 1
+            self.queried_tokens += len(input_ids)
+            path, length = self._match(input_ids)
+            length = min(length, len(input_ids) - 1)
+            if not path or length < len(path[0].tokens):
+                return 0, None
+            self.hits += 1
+            self.saved_tokens += length
+            self._clock += 1
+            for node in path:
+                node.last_access = self._clock
+            kv = torch.cat([node.kv for node in path], dim=2)[:, :, :length]
+        return length, tuple((layer[0].unsqueeze(1), layer[1].unsqueeze(1)) for layer in kv)
+
+    def insert(self, input_ids: List[int], layers: Sequence[Tuple[torch.Tensor, torch.Tensor]]):
+        """Cache the states of `input_ids`, given as one `(key, value)` pair of shape `[n, np, hn]` per layer."""
+        if self.bos_token_id not in input_ids:
+            return
+        context_length = input_ids.index(self.bos_token_id)
+        if context_length == 0:
+            return
+
+        def states(start, end):
+            return torch.stack([torch.stack((key[start:end], value[start:end])) for key, value in layers])
+
+        with self._lock:
+            self._clock += 1
+            context = tuple(input_ids[:context_length])
+            node = self.contexts.get(context)
+            if node is None:
+                node = PrefixCacheNode(context, states(0, context_length))
+                self.contexts[context] = node
+                self.nbytes += node.nbytes
+            node.last_access = self._clock
+            length = context_length
+            while length < len(input_ids):
+                child = node.children.get(input_ids[length])
+                if child is None:
+                    child = PrefixCacheNode(tuple(input_ids[length:]), states(length, len(input_ids)), node)
+                    child.last_access = self._clock
+                    node.children[input_ids[length]] = child
+                    self.nbytes += child.nbytes
+                    break
+                matched = self._common_length(child.tokens, input_ids, length)
+                if matched < len(child.tokens):
+                    child = self._split(child, matched)
+                child.last_access = self._clock
+                node = child
+                length += matched
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self.contexts.clear()
+            self.nbytes = 0
+
+    @staticmethod
+    def _common_length(tokens, input_ids, start):
+        length = 0
+        for token, input_id in zip(tokens, input_ids[start:]):
+            if token != input_id:
+                break
+            length += 1
+        return length
+
+    def _match(self, input_ids):
+        if self.bos_token_id not in input_ids:
+            return [], 0
+        context = tuple(input_ids[:input_ids.index(self.bos_token_id)])
+        node = self.contexts.get(context)
+        if node is None:
+            return [], 0
+        path, length = [node], len(context)
+        while length < len(input_ids):
+            child = node.children.get(input_ids[length])
+            if child is None:
+                break
+            matched = self._common_length(child.tokens, input_ids, length)
+            path.append(child)
+            length += matched
+            if matched < len(child.tokens):
+                break
+            node = child
+        return path, length
+
+    def _split(self, node, length):
+        """Split the edge of `node` after `length` tokens and return the new upper half."""
+        upper = PrefixCacheNode(node.tokens[:length], node.kv[:, :, :length].clone(), node.parent)
+        upper.last_access = node.last_access
+        node.parent.children[node.tokens[0]] = upper
+        node.tokens = node.tokens[length:]
+        node.kv = node.kv[:, :, length:].clone()
+        node.parent = upper
+        upper.children[node.tokens[0]] = node
+        return upper
+
+    def _leaves(self):
+        nodes = list(self.contexts.values())
+        while nodes:
+            node = nodes.pop()
+            if node.children:
+                nodes.extend(node.children.values())
+            else:
+                yield node
+
+    def _evict(self):
+        while self.nbytes > self.max_memory and self.contexts:
+            node = min(self._leaves(), key=lambda leaf: leaf.last_access)
+            if node.parent is None:
+                del self.contexts[node.tokens]
+            else:
+                del node.parent.children[node.tokens[0]]
+            self.nbytes -= node.nbytes
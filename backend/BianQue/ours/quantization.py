@@ -1,13 +1,16 @@
-from torch.nn import Linear
+from torch.nn import Embedding, Linear
 from torch.nn.parameter import Parameter
 
 import bz2
 import torch
 import base64
 import ctypes
+import threading
+import time
+from collections import OrderedDict
 from transformers.utils import logging
 
-from typing import List
+from typing import List, Optional
 from functools import partial
 
 logger = logging.get_logger(__name__)
@@ -41,6 +44,15 @@ except Exception as exception:
     logger.warning("Failed to load cpm_kernels:" + str(exception))
 
 
+# number of weight elements dequantized at a time by `dequant_matmul`
+DEQUANT_BLOCK_SIZE = 1 << 18
+
+
+def use_kernels(weight: torch.Tensor):
+    """Whether the cpm_kernels CUDA kernels can handle `weight`, otherwise the pure torch implementation is used."""
+    return kernels is not None and weight.is_cuda
+
+
 class W8A16Linear(torch.autograd.Function):
     @staticmethod
     def forward(ctx, inp: torch.Tensor, quant_w: torch.Tensor, scale_w: torch.Tensor, weight_bit_width):
@@ -48,16 +60,19 @@ class W8A16Linear(torch.autograd.Function):
         ctx.weight_bit_width = weight_bit_width
         out_features = quant_w.size(0)
         inp = inp.contiguous().view(-1, inp.size(-1))
-        weight = extract_weight_to_half(quant_w, scale_w, weight_bit_width)
-        ctx.weight_shape = weight.size()
-        output = inp.mm(weight.t())
+        ctx.weight_shape = torch.Size((out_features, quant_w.size(1) * 8 // weight_bit_width))
+        if use_kernels(quant_w) and scale_w.dim() == 1:
+            weight = extract_weight_to_half(quant_w, scale_w, weight_bit_width)
+            output = inp.mm(weight.t())
+        else:
+            output = dequant_matmul(inp, quant_w, scale_w, weight_bit_width)
         ctx.save_for_backward(inp, quant_w, scale_w)
         return output.view(*(ctx.inp_shape[:-1] + (out_features,)))
 
     @staticmethod
     def backward(ctx, grad_output: torch.Tensor):
         inp, quant_w, scale_w = ctx.saved_tensors
-        weight = extract_weight_to_half(quant_w, scale_w, ctx.weight_bit_width)
+        weight = extract_weight_to_half(quant_w, scale_w, ctx.weight_bit_width).to(grad_output.dtype)
         grad_output = grad_output.contiguous().view(-1, weight.size(0))
         grad_input = grad_output.mm(weight)
         grad_weight = grad_output.t().mm(inp)
@@ -65,6 +80,11 @@ class W8A16Linear(torch.autograd.Function):
 
 
 def compress_int4_weight(weight: torch.Tensor):  # (n, m)
+    if not use_kernels(weight):
+        # two int4 values per byte, the first one in the high nibble like the CUDA kernel
+        weight = weight.view(weight.size(0), -1, 2)
+        return (weight[..., 0] << 4) | (weight[..., 1] & 0x0F)
+
     with torch.cuda.device(weight.device):
         n, m = weight.size(0), weight.size(1)
         assert m % 2 == 0
@@ -85,7 +105,71 @@ def compress_int4_weight(weight: torch.Tensor):  # (n, m)
         return out
 
 
+def unpack_int4_weight(weight: torch.Tensor):  # (n, m) -> (n, 2m)
+    """Inverse of `compress_int4_weight`: sign-extend both nibbles of every byte."""
+    return torch.stack((weight >> 4, (weight << 4) >> 4), dim=-1).view(weight.size(0), -1)
+
+
+def scale_weight_(weight: torch.Tensor, scale_list: torch.Tensor):
+    """
+    Multiply the dequantized `weight` in place by its `[n]` row scales, or its `[n, num_groups]` scales of consecutive
+    groups of columns. The columns of a group stay consecutive among the even or odd columns that `dequant_matmul`
+    splits int4 weights into.
+    """
+    if scale_list.dim() == 1:
+        return weight.mul_(scale_list[:, None])
+    weight.view(weight.size(0), scale_list.size(1), -1).mul_(scale_list[:, :, None])
+    return weight
+
+
+def dequantize_weight(weight: torch.Tensor, scale_list: torch.Tensor, source_bit_width: int, dtype=torch.half):
+    if source_bit_width == 4:
+        weight = unpack_int4_weight(weight)
+    elif source_bit_width != 8:
+        assert False, "Unsupported bit-width"
+    return scale_weight_(weight.to(dtype), scale_list.to(dtype))
+
+
+def dequant_matmul(inp: torch.Tensor, weight: torch.Tensor, scale_list: torch.Tensor, source_bit_width: int):
+    """
+    `inp @ W.t()` for the quantized weight `W`, converted to the dtype of `inp` a block of output rows at a time so
+    that the full floating point weight is never materialized. The int4 nibbles are multiplied with the even and odd
+    input features separately instead of being interleaved, and the scales are applied to the output (to the weight
+    in fp16, where the unscaled products could overflow, and with group-wise scales).
+    """
+    if source_bit_width not in (4, 8):
+        assert False, "Unsupported bit-width"
+    out_features, in_features = weight.size(0), weight.size(1) * 8 // source_bit_width
+    scale_weight = inp.dtype == torch.half or scale_list.dim() > 1
+    scale_list = scale_list.to(inp.dtype)
+    block_size = max(1, DEQUANT_BLOCK_SIZE // in_features)
+    if source_bit_width == 4:
+        inp_high, inp_low = inp[:, 0::2], inp[:, 1::2]
+    output = inp.new_empty(inp.size(0), out_features)
+    for start in range(0, out_features, block_size):
+        end = min(start + block_size, out_features)
+        block = weight[start:end]
+        if source_bit_width == 8:
+            block = block.to(inp.dtype)
+            if scale_weight:
+                scale_weight_(block, scale_list[start:end])
+            output[:, start:end] = inp.mm(block.t())
+        else:
+            high, low = (block >> 4).to(inp.dtype), ((block << 4) >> 4).to(inp.dtype)
+            if scale_weight:
+                scale_weight_(high, scale_list[start:end])
+                scale_weight_(low, scale_list[start:end])
+            output[:, start:end] = inp_high.mm(high.t()).addmm_(inp_low, low.t())
+    if not scale_weight:
+        output.mul_(scale_list)
+    return output
+
+
 def extract_weight_to_half(weight: torch.Tensor, scale_list: torch.Tensor, source_bit_width: int):
+    # the kernels only handle one scale per row
+    if not use_kernels(weight) or scale_list.dim() > 1:
+        return dequantize_weight(weight, scale_list, source_bit_width)
+
     if source_bit_width == 8:
         func = kernels.int8WeightExtractionHalf
     elif source_bit_width == 4:
@@ -117,85 +201,488 @@ def extract_weight_to_half(weight: torch.Tensor, scale_list: torch.Tensor, sourc
         return out
 
 
+def quantize_weight(weight: torch.Tensor, weight_bit_width: int, group_size: Optional[int] = None):
+    """
+    Row-wise symmetric quantization of `weight`: the int8 values (two int4 values per byte for 4 bits) and one half
+    scale per row, or `[n, m // group_size]` scales with `group_size`, one per group of consecutive columns. Rows are
+    rounded a block at a time, so no full-size copy of `weight` is made.
+    """
+    n, m = weight.shape
+    scale = weight.view(n, -1, group_size or m).abs().amax(dim=-1) / ((2 ** (weight_bit_width - 1)) - 1)
+    scale = scale.half() if group_size else scale[:, 0].half()
+    # rows of zeros (such as unused embeddings) keep a zero scale instead of dividing by it
+    divisor = torch.where(scale == 0, torch.ones_like(scale), scale)
+    out = torch.empty(n, m * weight_bit_width // 8, dtype=torch.int8, device=weight.device)
+    block_size = max(1, DEQUANT_BLOCK_SIZE // m)
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        block = weight[start:end].view(end - start, -1, group_size or m) / divisor[start:end].view(end - start, -1, 1)
+        block = torch.round(block).view(end - start, m).to(torch.int8)
+        if weight_bit_width == 4:
+            block = compress_int4_weight(block)
+        out[start:end] = block
+    return out, scale
+
+
+class DequantizedWeightCache:
+    """
+    Dequantized weights of `QuantizedLinear` layers kept for their next forward passes, up to `max_memory` bytes, so
+    that a cached layer runs as a plain matmul instead of dequantizing its weight on every call.
+
+    Entries are evicted lowest `weight_cache_priority` of their layer first, least recently used first among equal
+    priorities. A weight is only cached when that evicts nothing of its own or a higher priority: every decoding step
+    goes through all the layers in order, and with more layers than fit, evicting the least recently used one would
+    always throw away the layer needed next. The cached layers stay the same instead, and the others are dequantized
+    a block at a time as without the cache.
+    """
+
+    def __init__(self, max_memory: int):
+        self.max_memory = max_memory
+        # module -> (weight, dtype, weight data pointer, priority), least recently used first
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "lookups": lookups,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "cached_layers": len(self.entries),
+            "nbytes": self.nbytes,
+            "max_memory": self.max_memory,
+        }
+
+    def get(self, module, dtype) -> Optional[torch.Tensor]:
+        """The dequantized weight of `module` in `dtype`, from the cache or cached now, or None if it does not fit."""
+        with self._lock:
+            entry = self.entries.get(module)
+            if entry is not None:
+                if entry[1] == dtype and entry[2] == module.weight.data_ptr():
+                    self.entries.move_to_end(module)
+                    self.hits += 1
+                    return entry[0]
+                # the weight was replaced or is used in another dtype
+                self._remove(module)
+            self.misses += 1
+            priority = module.weight_cache_priority
+            nbytes = module.weight.size(0) * module.in_features * torch.finfo(dtype).bits // 8
+            if not self._make_room(nbytes, priority):
+                return None
+        if use_kernels(module.weight) and module.weight_scale.dim() == 1:
+            weight = extract_weight_to_half(module.weight, module.weight_scale, module.weight_bit_width).to(dtype)
+        else:
+            weight = dequantize_weight(module.weight, module.weight_scale, module.weight_bit_width, dtype=dtype)
+        with self._lock:
+            if module not in self.entries and self._make_room(nbytes, priority):
+                self.entries[module] = (weight, dtype, module.weight.data_ptr(), priority)
+                self.nbytes += nbytes
+        return weight
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _remove(self, module):
+        weight = self.entries.pop(module)[0]
+        self.nbytes -= weight.numel() * weight.element_size()
+
+    def _make_room(self, nbytes, priority):
+        """Evict entries of a lower priority until `nbytes` fit, returns False (evicting nothing) if they cannot."""
+        if nbytes > self.max_memory:
+            return False
+        available = self.max_memory - self.nbytes
+        victims = []
+        if available < nbytes:
+            # least recently used first among equal priorities, the order of `entries` is kept by the stable sort
+            for module, entry in sorted(self.entries.items(), key=lambda item: item[1][3]):
+                if entry[3] >= priority or available >= nbytes:
+                    break
+                victims.append(module)
+                available += entry[0].numel() * entry[0].element_size()
+            if available < nbytes:
+                return False
+        for module in victims:
+            self._remove(module)
+            self.evictions += 1
+        return True
+
+
 class QuantizedLinear(Linear):
-    def __init__(self, weight_bit_width: int, weight_tensor=None, bias_tensor=None, empty_init=False, *args, **kwargs):
-        super(QuantizedLinear, self).__init__(*args, **kwargs)
+    """
+    `Linear` with a weight quantized to `weight_bit_width` bits, with one scale per output row or, with `group_size`,
+    one per group of `group_size` input features of a row. With `input_scale` (see `search_input_scale`), the weight
+    columns are multiplied by it before quantization and the inputs divided by it. With a `weight_cache`, the
+    dequantized weight is reused while it is cached.
+    """
+
+    def __init__(self, weight_bit_width: int, weight_tensor=None, bias_tensor=None, empty_init=False,
+                 group_size: Optional[int] = None, input_scale: Optional[torch.Tensor] = None, *args, **kwargs):
+        # the floating point weight is replaced right away, so it is neither allocated nor initialized
+        super(QuantizedLinear, self).__init__(*args, **dict(kwargs, device="meta"))
         self.weight_bit_width = weight_bit_width
 
         shape = self.weight.shape
         del self.weight
+        if group_size is not None and (shape[1] % group_size or group_size % 2):
+            raise ValueError(f"The group size must be even and divide the {shape[1]} input features, got {group_size}")
 
+        if input_scale is not None:
+            # the weight is scaled by the same rounded values that divide the inputs
+            input_scale = input_scale.to(kwargs["device"], kwargs["dtype"])
         if weight_tensor is None or empty_init:
             self.weight = torch.empty(
                 shape[0], shape[1] * weight_bit_width // 8, dtype=torch.int8, device=kwargs["device"]
             )
-            self.weight_scale = torch.empty(shape[0], dtype=kwargs["dtype"], device=kwargs["device"])
+            scale_shape = (shape[0], shape[1] // group_size) if group_size else (shape[0],)
+            self.weight_scale = torch.empty(scale_shape, dtype=kwargs["dtype"], device=kwargs["device"])
         else:
-            self.weight_scale = (weight_tensor.abs().max(dim=-1).values / ((2 ** (weight_bit_width - 1)) - 1)).half()
-            self.weight = torch.round(weight_tensor / self.weight_scale[:, None]).to(torch.int8)
-            if weight_bit_width == 4:
-                self.weight = compress_int4_weight(self.weight)
+            if input_scale is not None:
+                weight_tensor = weight_tensor * input_scale.to(weight_tensor.device, weight_tensor.dtype)
+            self.weight, self.weight_scale = quantize_weight(weight_tensor, weight_bit_width, group_size)
 
         self.weight = Parameter(self.weight.to(kwargs["device"]), requires_grad=False)
         self.weight_scale = Parameter(self.weight_scale.to(kwargs["device"]), requires_grad=False)
+        if input_scale is not None:
+            self.input_scale = Parameter(input_scale, requires_grad=False)
+        else:
+            self.input_scale = None
         if bias_tensor is not None:
             self.bias = Parameter(bias_tensor.to(kwargs["device"]), requires_grad=False)
         else:
             self.bias = None
+        self.weight_cache: Optional[DequantizedWeightCache] = None
+        self.weight_cache_priority = 0
 
     def forward(self, input):
-        output = W8A16Linear.apply(input, self.weight, self.weight_scale, self.weight_bit_width)
+        if self.input_scale is not None:
+            input = input / self.input_scale
+        weight = self.weight_cache.get(self, input.dtype) if self.weight_cache is not None else None
+        if weight is not None:
+            output = torch.nn.functional.linear(input, weight)
+        else:
+            output = W8A16Linear.apply(input, self.weight, self.weight_scale, self.weight_bit_width)
         if self.bias is not None:
             output = output + self.bias
         return output
 
 
-def quantize(model, weight_bit_width, empty_init=False, **kwargs):
-    """Replace fp16 linear with quantized linear"""
+class QuantizedEmbedding(Embedding):
+    """
+    `Embedding` with the rows quantized like the weight of `QuantizedLinear`, only the rows that are looked up are
+    dequantized. The scales stay in the dtype of the model, which is the dtype of the embeddings.
+    """
 
-    for layer in model.layers:
-        layer.attention.query_key_value = QuantizedLinear(
-            weight_bit_width=weight_bit_width,
-            weight_tensor=layer.attention.query_key_value.weight.to(torch.cuda.current_device()),
-            bias_tensor=layer.attention.query_key_value.bias,
-            in_features=layer.attention.query_key_value.in_features,
-            out_features=layer.attention.query_key_value.out_features,
-            bias=True,
-            dtype=torch.half,
-            device=layer.attention.query_key_value.weight.device,
-            empty_init=empty_init
-        )
-        layer.attention.dense = QuantizedLinear(
-            weight_bit_width=weight_bit_width,
-            weight_tensor=layer.attention.dense.weight.to(torch.cuda.current_device()),
-            bias_tensor=layer.attention.dense.bias,
-            in_features=layer.attention.dense.in_features,
-            out_features=layer.attention.dense.out_features,
-            bias=True,
-            dtype=torch.half,
-            device=layer.attention.dense.weight.device,
-            empty_init=empty_init
+    def __init__(self, weight_bit_width: int, weight_tensor=None, empty_init=False, *args, **kwargs):
+        super(QuantizedEmbedding, self).__init__(*args, **dict(kwargs, device="meta"))
+        self.weight_bit_width = weight_bit_width
+
+        shape = self.weight.shape
+        del self.weight
+
+        if weight_tensor is None or empty_init:
+            self.weight = torch.empty(
+                shape[0], shape[1] * weight_bit_width // 8, dtype=torch.int8, device=kwargs["device"]
+            )
+            self.weight_scale = torch.empty(shape[0], dtype=kwargs["dtype"], device=kwargs["device"])
+        else:
+            self.weight, self.weight_scale = quantize_weight(weight_tensor, weight_bit_width)
+
+        self.weight = Parameter(self.weight.to(kwargs["device"]), requires_grad=False)
+        self.weight_scale = Parameter(self.weight_scale.to(kwargs["device"], kwargs["dtype"]), requires_grad=False)
+
+    def forward(self, input):
+        ids = input.reshape(-1)
+        weight, scale = self.weight[ids], self.weight_scale[ids]
+        if use_kernels(weight):
+            embeddings = extract_weight_to_half(weight, scale.half(), self.weight_bit_width).to(scale.dtype)
+        else:
+            embeddings = dequantize_weight(weight, scale, self.weight_bit_width, dtype=scale.dtype)
+        return embeddings.view(*input.shape, self.embedding_dim)
+
+
+def quantization_device(weight: torch.Tensor):
+    """Quantize on the GPU when the CUDA kernels are available, otherwise where the weight already is."""
+    if kernels is not None and torch.cuda.is_available():
+        return torch.cuda.current_device()
+    return weight.device
+
+
+def quantized_linears(layer):
+    """The `(parent module, attribute name)` of the linear layers of a `GLMBlock` that `quantize` replaces."""
+    return [(layer.attention, "query_key_value"), (layer.attention, "dense"), (layer.mlp, "dense_h_to_4h"),
+            (layer.mlp, "dense_4h_to_h")]
+
+
+def collect_input_statistics(model, calibration_input_ids, num_rows: int = 256):
+    """
+    Run the transformer of `model` over the calibration samples (token ids of the tokenizer, one sequence each) and
+    return, for every linear layer that `quantize` replaces, the mean absolute value of each input feature and about
+    `num_rows` input rows drawn evenly from the samples.
+    """
+    samples = [torch.as_tensor(input_ids).view(1, -1) for input_ids in calibration_input_ids]
+    rows_per_sample = -(-num_rows // len(samples))
+    statistics = {}
+
+    def hook(module, args):
+        inputs = args[0].detach().reshape(-1, args[0].size(-1))
+        abs_sum, count, rows = statistics.setdefault(module, [0, 0, []])
+        statistics[module][0] = abs_sum + inputs.float().abs().sum(dim=0)
+        statistics[module][1] = count + inputs.size(0)
+        rows.append(inputs[torch.randperm(inputs.size(0), device=inputs.device)[:rows_per_sample]])
+
+    handles = [getattr(parent, name).register_forward_pre_hook(hook)
+               for layer in model.transformer.layers for parent, name in quantized_linears(layer)]
+    try:
+        with torch.no_grad():
+            for input_ids in samples:
+                model.transformer(input_ids=input_ids.to(model.device), use_cache=False)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return {module: (abs_sum / count, torch.cat(rows)) for module, (abs_sum, count, rows) in statistics.items()}
+
+
+def search_input_scale(weight: torch.Tensor, inputs: torch.Tensor, mean_abs: torch.Tensor, weight_bit_width: int,
+                       group_size: Optional[int] = None, dtype=torch.half, grid_size: int = 20):
+    """
+    Activation-aware scales of the input features of `weight`, as in AWQ: the weight columns are multiplied by
+    `mean_abs ** alpha` before quantization and the inputs divided by it, so the columns that see large activations
+    lose less precision. `alpha` is searched in `[0, 1)` for the smallest output error on the calibration `inputs`;
+    `alpha = 0` is plain quantization.
+    """
+    inputs, weight = inputs.float(), weight.float()
+    reference = inputs.mm(weight.t())
+    best_error, best_scale = float("inf"), None
+    for step in range(grid_size):
+        scale = mean_abs.float().pow(step / grid_size).clamp(min=1e-4)
+        scale = (scale / (scale.max() * scale.min()).sqrt()).to(dtype).float()
+        quant_w, scale_w = quantize_weight(weight * scale, weight_bit_width, group_size)
+        output = (inputs / scale).mm(dequantize_weight(quant_w, scale_w, weight_bit_width, dtype=torch.float).t())
+        error = (output - reference).pow(2).mean().item()
+        if error < best_error:
+            best_error, best_scale = error, scale
+    return best_scale
+
+
+def quantize_linear(linear, weight_bit_width, empty_init=False, group_size: Optional[int] = None, input_scale=None):
+    """The `QuantizedLinear` of a linear layer of the transformer."""
+    return QuantizedLinear(
+        weight_bit_width=weight_bit_width,
+        weight_tensor=linear.weight.to(quantization_device(linear.weight)),
+        bias_tensor=linear.bias,
+        in_features=linear.in_features,
+        out_features=linear.out_features,
+        bias=True,
+        dtype=torch.half,
+        device=linear.weight.device,
+        empty_init=empty_init,
+        group_size=group_size,
+        input_scale=input_scale
+    )
+
+
+def quantize(model, weight_bit_width, empty_init=False, group_size: Optional[int] = None, input_statistics=None,
+             activation_aware=False, plan: Optional[List[int]] = None, **kwargs):
+    """
+    Replace fp16 linear with quantized linear, with one scale per `group_size` input features if given. With
+    `input_statistics` of `collect_input_statistics`, the input scales are calibrated with `search_input_scale`;
+    `activation_aware` creates them empty, to be loaded from a calibrated checkpoint. A `plan` (see
+    `choose_layer_bits`) gives the bit width of every layer instead of `weight_bit_width`, 0 leaves a layer as it is.
+    """
+    if plan is not None and len(plan) != len(model.layers):
+        raise ValueError(f"The quantization plan has {len(plan)} layers instead of {len(model.layers)}")
+
+    for layer_id, layer in enumerate(model.layers):
+        bits = plan[layer_id] if plan is not None else weight_bit_width
+        if not bits:
+            continue
+        for parent, name in quantized_linears(layer):
+            linear = getattr(parent, name)
+            input_scale = None
+            if input_statistics is not None:
+                device = quantization_device(linear.weight)
+                mean_abs, inputs = input_statistics[linear]
+                input_scale = search_input_scale(linear.weight.to(device), inputs.to(device), mean_abs.to(device),
+                                                 bits, group_size=group_size)
+            elif activation_aware:
+                input_scale = torch.ones(linear.in_features, device=linear.weight.device)
+            setattr(parent, name, quantize_linear(linear, bits, empty_init=empty_init, group_size=group_size,
+                                                  input_scale=input_scale))
+    return model
+
+
+class _StopForward(Exception):
+    pass
+
+
+def measure_layer_sensitivity(model, calibration_input_ids, bit_widths=(4, 8), group_size: Optional[int] = None):
+    """
+    How much quantizing each `GLMBlock` of `model` on its own to each of `bit_widths` changes its output on the
+    calibration samples: the squared error of the block outputs relative to their squared norm, which is the scale of
+    the residual stream that the error is added to. Returns one `{bits: error}` dict per layer.
+
+    The blocks are measured one after the other on the inputs they get in full precision: a block is quantized once
+    per bit width and rerun on every sample, and its full-precision outputs are the inputs of the next block. Only the
+    hidden states of one block for all the samples are kept.
+    """
+    layers = model.transformer.layers
+    # the arguments of the first block for every sample, the forward pass is stopped there
+    samples = []
+
+    def capture(layer, args, kwargs):
+        samples.append((args[0], kwargs))
+        raise _StopForward
+
+    handle = layers[0].register_forward_pre_hook(capture, with_kwargs=True)
+    try:
+        with torch.no_grad():
+            for input_ids in calibration_input_ids:
+                input_ids = torch.as_tensor(input_ids).view(1, -1).to(model.device)
+                try:
+                    model.transformer(input_ids=input_ids, use_cache=False)
+                except _StopForward:
+                    pass
+    finally:
+        handle.remove()
+
+    sensitivity = []
+    with torch.no_grad():
+        for layer_id, layer in enumerate(layers):
+            samples = [(hidden_states, dict(kwargs, layer_id=torch.tensor(layer_id)))
+                       for hidden_states, kwargs in samples]
+            references = [layer(hidden_states, **kwargs)[0] for hidden_states, kwargs in samples]
+            norm = sum(reference.float().pow(2).sum().item() for reference in references)
+            errors = {}
+            linears = [(parent, name, getattr(parent, name)) for parent, name in quantized_linears(layer)]
+            try:
+                for bits in bit_widths:
+                    for parent, name, linear in linears:
+                        setattr(parent, name, quantize_linear(linear, bits, group_size=group_size))
+                    error = sum((layer(hidden_states, **kwargs)[0].float() - reference.float()).pow(2).sum().item()
+                                for (hidden_states, kwargs), reference in zip(samples, references))
+                    errors[bits] = error / norm
+            finally:
+                for parent, name, linear in linears:
+                    setattr(parent, name, linear)
+            sensitivity.append(errors)
+            samples = [(reference, kwargs) for (_, kwargs), reference in zip(samples, references)]
+    return sensitivity
+
+
+def layer_costs(model, bit_widths=(4, 8), group_size: Optional[int] = None, metric: str = "memory",
+                num_runs: int = 10):
+    """
+    The cost of a `GLMBlock` of `model` (they all have the same shapes) with its linear layers at each of
+    `bit_widths`, 0 for the layers as they are: `"memory"` in bytes of their parameters, or `"latency"` in seconds of
+    running them for one token, measured on the device and in the dtype of `model`.
+    """
+    layer = model.transformer.layers[0]
+    linears = [getattr(parent, name) for parent, name in quantized_linears(layer)]
+    costs = {}
+    for bits in bit_widths:
+        modules = [quantize_linear(linear, bits, group_size=group_size) if bits else linear for linear in linears]
+        if metric == "memory":
+            costs[bits] = sum(p.numel() * p.element_size() for module in modules for p in module.parameters())
+        elif metric == "latency":
+            inputs = [torch.randn(1, 1, linear.in_features, dtype=model.dtype, device=model.device)
+                      for linear in linears]
+            with torch.no_grad():
+                for module, inp in zip(modules, inputs):
+                    module(inp)
+                start = time.perf_counter()
+                for _ in range(num_runs):
+                    for module, inp in zip(modules, inputs):
+                        module(inp)
+                if model.device.type == "cuda":
+                    torch.cuda.synchronize(model.device)
+            costs[bits] = (time.perf_counter() - start) / num_runs
+        else:
+            raise ValueError(f"Unknown cost metric {metric}, expected 'memory' or 'latency'")
+    return costs
+
+
+def choose_layer_bits(sensitivity, costs, budget: float) -> List[int]:
+    """
+    The bit width of every layer, among the keys of `costs` (0 keeps a layer in floating point, with no error), with
+    the smallest total sensitivity (of `measure_layer_sensitivity`) whose total cost (of `layer_costs`) is within
+    `budget`. Starting from the cheapest width everywhere, the upgrade with the largest error reduction per unit of
+    extra cost is applied while one fits.
+    """
+    def error(layer_id, bits):
+        return sensitivity[layer_id][bits] if bits else 0.0
+
+    cheapest = min(costs, key=costs.get)
+    plan = [cheapest] * len(sensitivity)
+    total = costs[cheapest] * len(plan)
+    if total > budget:
+        raise ValueError(
+            f"Even the cheapest plan (int{cheapest} everywhere) costs {total:.6g}, over the budget of {budget:.6g}"
         )
-        layer.mlp.dense_h_to_4h = QuantizedLinear(
+    while True:
+        best = None
+        for layer_id, bits in enumerate(plan):
+            for option in costs:
+                extra = costs[option] - costs[bits]
+                gain = error(layer_id, bits) - error(layer_id, option)
+                if extra <= 0 or gain <= 0 or total + extra > budget:
+                    continue
+                if best is None or gain / extra > best[0]:
+                    best = (gain / extra, layer_id, option)
+        if best is None:
+            return plan
+        _, layer_id, option = best
+        total += costs[option] - costs[plan[layer_id]]
+        plan[layer_id] = option
+
+
+def quantize_embedding_layers(model, weight_bit_width, empty_init=False, tied=False):
+    """
+    Replace `word_embeddings` of the transformer of `model` and its `lm_head` with row-wise quantized ones. With
+    `tied`, `lm_head` keeps sharing the quantized weight and scales of the embeddings.
+    """
+    word_embeddings = model.transformer.word_embeddings
+    device = quantization_device(word_embeddings.weight)
+    model.transformer.word_embeddings = QuantizedEmbedding(
+        weight_bit_width=weight_bit_width,
+        weight_tensor=word_embeddings.weight.to(device),
+        num_embeddings=word_embeddings.num_embeddings,
+        embedding_dim=word_embeddings.embedding_dim,
+        dtype=word_embeddings.weight.dtype,
+        device=word_embeddings.weight.device,
+        empty_init=empty_init
+    )
+    lm_head = model.lm_head
+    if tied:
+        # nothing to quantize, the weight and scales are assigned right away
+        model.lm_head = QuantizedLinear(
             weight_bit_width=weight_bit_width,
-            weight_tensor=layer.mlp.dense_h_to_4h.weight.to(torch.cuda.current_device()),
-            bias_tensor=layer.mlp.dense_h_to_4h.bias,
-            in_features=layer.mlp.dense_h_to_4h.in_features,
-            out_features=layer.mlp.dense_h_to_4h.out_features,
-            bias=True,
+            in_features=lm_head.in_features,
+            out_features=lm_head.out_features,
+            bias=False,
             dtype=torch.half,
-            device=layer.mlp.dense_h_to_4h.weight.device,
-            empty_init=empty_init
+            device="meta",
+            empty_init=True
         )
-        layer.mlp.dense_4h_to_h = QuantizedLinear(
+        model.lm_head.weight = model.transformer.word_embeddings.weight
+        model.lm_head.weight_scale = model.transformer.word_embeddings.weight_scale
+    else:
+        model.lm_head = QuantizedLinear(
             weight_bit_width=weight_bit_width,
-            weight_tensor=layer.mlp.dense_4h_to_h.weight.to(torch.cuda.current_device()),
-            bias_tensor=layer.mlp.dense_4h_to_h.bias,
-            in_features=layer.mlp.dense_4h_to_h.in_features,
-            out_features=layer.mlp.dense_4h_to_h.out_features,
-            bias=True,
+            weight_tensor=lm_head.weight.to(device),
+            bias_tensor=None,
+            in_features=lm_head.in_features,
+            out_features=lm_head.out_features,
+            bias=False,
             dtype=torch.half,
-            device=layer.mlp.dense_4h_to_h.weight.device,
+            device=lm_head.weight.device,
             empty_init=empty_init
         )
     return model
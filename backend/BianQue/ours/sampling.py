@@ -0,0 +1,121 @@
+""" Next-token sampling that only sorts and normalizes the most likely candidates instead of the whole vocabulary. """
+
+import torch
+from torch import nn
+from typing import Optional
+
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+
+class TopKTopPSampler:
+    """
+    The tail of the logits pipeline of `stream_generate` in one pass over the top candidates: the guard against
+    invalid scores, the temperature, top-k and top-p warpers, the softmax and the draw (or the argmax).
+
+    The HF warpers mask, sort and normalize the whole vocabulary once each. Here `topk` picks the candidates first,
+    `top_k` of them, or `num_candidates` when only top-p is set. Top-p is exact on those candidates as long as they
+    hold at least `top_p` of the probability mass, which is checked. Otherwise the step falls back to the warpers.
+    The next token follows the same distribution as with the warpers, up to ties in the scores.
+
+    With `invalid_score_token_id`, a row whose candidates contain NaN or infinite scores yields that token, like
+    `InvalidScoreLogitsProcessor`. NaN and +inf scores always rank among the candidates, but the -inf scores that
+    processors give to banned tokens no longer count as invalid unless they do.
+    """
+
+    def __init__(
+            self,
+            logits_warper: LogitsProcessorList,
+            temperature: float = 1.0,
+            top_k: Optional[int] = None,
+            top_p: float = 1.0,
+            min_tokens_to_keep: int = 1,
+            invalid_score_token_id: Optional[int] = None,
+            num_candidates: int = 64,
+    ):
+        self.logits_warper = logits_warper
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_tokens_to_keep = min_tokens_to_keep
+        self.invalid_score_token_id = invalid_score_token_id
+        self.num_candidates = max(num_candidates, min_tokens_to_keep)
+
+    @classmethod
+    def from_warpers(cls, logits_warper: LogitsProcessorList, invalid_score_token_id: Optional[int] = None,
+                     num_candidates: int = 64):
+        """
+        The sampler of the warpers of `GenerationMixin._get_logits_warper`, or None unless they are only a
+        temperature, top-k and top-p (in that order) with at least one of the latter two.
+        """
+        temperature, top_k, top_p, min_tokens_to_keep = 1.0, None, 1.0, 1
+        for warper in logits_warper:
+            if isinstance(warper, TemperatureLogitsWarper) and top_k is None and top_p == 1.0:
+                temperature = warper.temperature
+            elif isinstance(warper, TopKLogitsWarper) and top_p == 1.0 and warper.filter_value == -float("inf"):
+                top_k = warper.top_k
+            elif isinstance(warper, TopPLogitsWarper) and warper.filter_value == -float("inf"):
+                top_p, min_tokens_to_keep = warper.top_p, warper.min_tokens_to_keep
+            else:
+                return None
+        if top_k is None and top_p >= 1.0:
+            return None
+        return cls(logits_warper, temperature=temperature, top_k=top_k, top_p=top_p,
+                   min_tokens_to_keep=min_tokens_to_keep, invalid_score_token_id=invalid_score_token_id,
+                   num_candidates=num_candidates)
+
+    def candidates(self, scores: torch.Tensor):
+        """
+        The `[b, k]` candidate ids in descending order of score, their probabilities after the warpers (zero for the
+        ones top-p drops, not normalized to 1), and which rows are invalid. Probabilities are None if the candidates
+        do not cover the top-p mass.
+        """
+        values, indices = scores.topk(min(self.top_k or self.num_candidates, scores.size(-1)), dim=-1)
+        invalid = None
+        if self.invalid_score_token_id is not None:
+            invalid = ~torch.isfinite(values).all(dim=-1)
+            if invalid.any():
+                values = values.masked_fill(invalid[:, None], 0.0)
+        if self.temperature != 1.0:
+            values = values / self.temperature
+        if self.top_k:
+            # the top-k warper leaves only the candidates, the softmax normalizes over them
+            log_normalizer = values.logsumexp(dim=-1, keepdim=True)
+        else:
+            log_normalizer = (scores / self.temperature if self.temperature != 1.0 else scores).logsumexp(
+                dim=-1, keepdim=True)
+        probs = (values - log_normalizer).exp_()
+        if self.top_p < 1.0:
+            if not self.top_k:
+                covered = probs.sum(dim=-1) >= self.top_p
+                if invalid is not None:
+                    covered |= invalid
+                if not covered.all():
+                    return indices, None, invalid
+            # a token is kept while the mass of the tokens before it is below top_p
+            keep = probs.cumsum(dim=-1) - probs < self.top_p
+            keep[:, :self.min_tokens_to_keep] = True
+            probs = probs * keep
+        return indices, probs, invalid
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.Tensor, do_sample: bool = True) -> torch.Tensor:
+        """The `[b]` next tokens for the processed `[b, vocab_size]` scores."""
+        indices, probs, invalid = self.candidates(scores)
+        if probs is None:
+            if invalid is not None and invalid.any():
+                scores = scores.masked_fill(invalid[:, None], 0.0)
+            probs = nn.functional.softmax(self.logits_warper(input_ids, scores), dim=-1)
+            indices = None
+        if do_sample:
+            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(probs, dim=-1)
+        if indices is not None:
+            next_tokens = indices.gather(-1, next_tokens[:, None]).squeeze(1)
+        if invalid is not None:
+            next_tokens = next_tokens.masked_fill(invalid, self.invalid_score_token_id)
+        return next_tokens
@@ -0,0 +1,379 @@
+""" Continuous-batching generation for serving many ChatGLM conversations with one model. """
+
+import copy
+import queue
+import threading
+import warnings
+from collections import OrderedDict, deque
+
+import torch
+from torch import nn
+from typing import List, Optional, Tuple
+
+from transformers.utils import logging
+from transformers.generation.utils import LogitsProcessorList
+
+logger = logging.get_logger(__name__)
+
+
+class GenerationRequest:
+    """State of one sequence served by a [`ContinuousBatchingScheduler`]."""
+
+    def __init__(self, input_ids: List[int], generation_config, logits_processor, logits_warper, eos_token_id,
+                 session=None, sampler=None):
+        self.input_ids = list(input_ids)
+        self.generation_config = generation_config
+        self.logits_processor = logits_processor
+        self.logits_warper = logits_warper
+        self.sampler = sampler
+        self.eos_token_id = eos_token_id
+        self.session = session
+        self.seq_id = None
+        self.session_epoch = None
+        self.mask_position = None
+        self.context_length = None
+        self.outputs = queue.Queue()
+
+    def __iter__(self):
+        while True:
+            output = self.outputs.get()
+            if output is None:
+                return
+            if isinstance(output, Exception):
+                raise output
+            yield output
+
+
+class ContinuousBatchingScheduler:
+    """
+    Keeps one running batch of sequences on `model` and decodes all of them with a single forward pass per step.
+
+    New requests are prefilled on their own and join the batch at the next step boundary; finished sequences
+    (EOS or `max_length`) leave it immediately and return their KV cache blocks to `kv_cache_manager`, unless they
+    belong to a `ChatSession` that keeps them for its next round. Every request gets its own iterator that yields the
+    generated ids after every step, the final one included.
+
+    A request is admitted once its prompt fits, with a block of headroom for every running sequence; blocks for the
+    generated tokens are taken as the sequences grow. When the pool runs dry, the most recently admitted sequences
+    are preempted: their blocks are freed and they are prefilled again, prompt and generated tokens, once there is
+    room, before any new request. The blocks kept by idle sessions count as free: when a request does not fit, the
+    least recently used idle sessions are reset (their next round is prefilled from scratch) first.
+    """
+
+    def __init__(self, model, kv_cache_manager, max_batch_size: int = 32):
+        self.model = model
+        self.kv_cache_manager = kv_cache_manager
+        self.max_batch_size = max_batch_size
+        self.waiting = queue.Queue()
+        self.running: List[GenerationRequest] = []
+        self._pending: Optional[GenerationRequest] = None
+        # requests preempted from the running batch, they are admitted again before any waiting one
+        self.preempted: "deque[GenerationRequest]" = deque()
+        self.num_preemptions = 0
+        # seq_id -> (session, epoch) of the sessions whose blocks are kept between rounds, least recently used first
+        self.idle_sessions: "OrderedDict[int, tuple]" = OrderedDict()
+        kv_cache_manager.reclaim = self._make_room
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, input_ids, generation_config=None, logits_processor: Optional[LogitsProcessorList] = None,
+               session=None, **kwargs) -> GenerationRequest:
+        """
+        Queue `input_ids` (a single sequence) for generation and return the request, an iterator of outputs. With a
+        `session` whose cache lives in `kv_cache_manager`, only the tokens it has not seen yet are prefilled.
+        """
+        model = self.model
+        if isinstance(input_ids, torch.Tensor):
+            input_ids = input_ids.view(-1).tolist()
+        if generation_config is None:
+            generation_config = model.generation_config
+        generation_config = copy.deepcopy(generation_config)
+        model_kwargs = generation_config.update(**kwargs)
+        if model_kwargs:
+            warnings.warn(f"Ignoring unsupported generation arguments: {list(model_kwargs)}", UserWarning)
+        if generation_config.max_new_tokens is not None:
+            generation_config.max_length = generation_config.max_new_tokens + len(input_ids)
+        eos_token_id = generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+
+        input_tensor = torch.tensor([input_ids], dtype=torch.long)
+        logits_processor = model._get_logits_processor(
+            generation_config=generation_config,
+            input_ids_seq_length=len(input_ids),
+            encoder_input_ids=input_tensor,
+            prefix_allowed_tokens_fn=None,
+            logits_processor=logits_processor if logits_processor is not None else LogitsProcessorList(),
+        )
+        logits_warper = model._get_logits_warper(generation_config)
+        logits_processor, sampler = model.build_sampler(logits_processor, logits_warper)
+
+        request = GenerationRequest(input_ids, generation_config, logits_processor, logits_warper, eos_token_id,
+                                    session=session, sampler=sampler)
+        self.waiting.put(request)
+        return request
+
+    def stream_chat(self, tokenizer, query: str, history: List[Tuple[str, str]] = None, max_length: int = 2048,
+                    do_sample=True, top_p=0.7, temperature=0.95, logits_processor=None, session=None, **kwargs):
+        """Same as `ChatGLMForConditionalGeneration.stream_chat`, served from the running batch."""
+        if history is None:
+            history = []
+        logits_processor = self.model.build_chat_logits_processor(logits_processor)
+        prompt = self.model.build_prompt(query, history)
+        if session is not None:
+            input_ids, _ = self.model.build_session_inputs(tokenizer, prompt, session)
+        else:
+            input_ids = tokenizer([prompt], return_tensors="pt")["input_ids"]
+        request = self.submit(input_ids, max_length=max_length, do_sample=do_sample, top_p=top_p,
+                              temperature=temperature, logits_processor=logits_processor, session=session, **kwargs)
+        response_stream = self.model.create_response_stream(tokenizer)
+        response, decoded_length = "", len(input_ids[0])
+        for outputs in request:
+            new_ids = outputs[0, decoded_length:].tolist()
+            decoded_length = outputs.size(1)
+            if new_ids and new_ids[-1] in request.eos_token_id:
+                new_ids = new_ids[:-1]
+            response += response_stream.put(new_ids)
+            if session is not None:
+                session.text = prompt + response
+            yield response, history + [(query, response)]
+        tail = response_stream.flush()
+        if tail:
+            response += tail
+            if session is not None:
+                session.text = prompt + response
+            yield response, history + [(query, response)]
+
+    def chat(self, tokenizer, query: str, history: List[Tuple[str, str]] = None, **kwargs):
+        """Same as `ChatGLMForConditionalGeneration.chat`, served from the running batch."""
+        if history is None:
+            history = []
+        response, new_history = "", history + [(query, "")]
+        for response, new_history in self.stream_chat(tokenizer, query, history, **kwargs):
+            pass
+        return response, new_history
+
+    def shutdown(self):
+        """Stop the generation thread once the running batch is done."""
+        self.waiting.put(None)
+        self._thread.join()
+
+    def _loop(self):
+        with torch.no_grad():
+            while True:
+                try:
+                    if not self._admit():
+                        return
+                    if self.running:
+                        self._step()
+                except Exception as exception:
+                    logger.error(f"Generation step failed: {exception}")
+                    for request in self.running:
+                        self._finish(request, exception)
+                    self.running = []
+
+    def _blocks_short(self, request):
+        # blocks missing for the next step, which feeds the last sampled token through the model
+        block_size = self.kv_cache_manager.block_size
+        return -(-len(request.input_ids) // block_size) - len(self.kv_cache_manager.block_tables[request.seq_id])
+
+    def _session_seq_id(self, request):
+        past_key_values = request.session.past_key_values if request.session is not None else None
+        if getattr(past_key_values, "manager", None) is self.kv_cache_manager:
+            return past_key_values.seq_ids[0]
+        return None
+
+    def _idle_blocks(self, keep_seq_id=None):
+        block_tables = self.kv_cache_manager.block_tables
+        return sum(len(block_tables.get(seq_id, ())) for seq_id in self.idle_sessions if seq_id != keep_seq_id)
+
+    def _make_room(self, num_blocks, keep_seq_id=None):
+        """
+        Reset the least recently used idle sessions (but the one of `keep_seq_id`) until `num_blocks` blocks are free.
+        Nothing is reset if that is not enough, returns whether the blocks are free.
+        """
+        manager = self.kv_cache_manager
+        for seq_id in [seq_id for seq_id in self.idle_sessions if seq_id not in manager.block_tables]:
+            # freed by a reset of its session on another thread
+            del self.idle_sessions[seq_id]
+        if num_blocks > manager.num_free_blocks + self._idle_blocks(keep_seq_id):
+            return False
+        for seq_id in list(self.idle_sessions):
+            if manager.num_free_blocks >= num_blocks:
+                break
+            if seq_id == keep_seq_id:
+                continue
+            session, epoch = self.idle_sessions.pop(seq_id)
+            # a session reset meanwhile has freed its blocks already and may be running a new round
+            session.reset(epoch)
+        return manager.num_free_blocks >= num_blocks
+
+    def _admit(self):
+        """Move preempted and waiting requests into the running batch, returns False once `shutdown` is done."""
+        block_size = self.kv_cache_manager.block_size
+        while len(self.running) < self.max_batch_size:
+            if self.preempted:
+                request = self.preempted[0]
+            else:
+                if self._pending is None:
+                    if self._stopping:
+                        break
+                    try:
+                        # block while idle, otherwise only take what is already waiting
+                        self._pending = self.waiting.get(block=not self.running)
+                    except queue.Empty:
+                        break
+                    if self._pending is None:
+                        self._stopping = True
+                        continue
+                request = self._pending
+            seq_id = self._session_seq_id(request)
+            held = len(self.kv_cache_manager.block_tables.get(seq_id, ())) if seq_id is not None else 0
+            # the prompt and the first generated token, plus a block of headroom for every running sequence
+            needed = -(-(len(request.input_ids) + 1) // block_size) - held + len(self.running)
+            # with nothing running there is nothing to wait for, the request runs on what can be freed
+            if not self._make_room(needed, keep_seq_id=seq_id) and self.running:
+                break
+            if self.preempted:
+                self.preempted.popleft()
+            else:
+                self._pending = None
+            try:
+                self._prefill(request)
+            except Exception as exception:
+                self._finish(request, exception)
+        return not (self._stopping and self._pending is None and not self.preempted and not self.running)
+
+    def _reserve_step(self):
+        """
+        Reserve the blocks of the next step of the running batch. While the pool cannot provide them, the most
+        recently admitted sequence is preempted; the last one left raises when even it does not fit.
+        """
+        manager = self.kv_cache_manager
+        while len(self.running) > 1 and not self._make_room(sum(map(self._blocks_short, self.running))):
+            self._preempt(self.running.pop())
+        for request in self.running:
+            manager.reserve(request.seq_id, len(request.input_ids))
+
+    def _preempt(self, request):
+        """Free the blocks of a running request and queue it to be prefilled again, generated tokens included."""
+        manager, seq_id = self.kv_cache_manager, request.seq_id
+        if request.session is not None:
+            # the session's cache is this sequence, its next round starts from scratch
+            request.session.reset(request.session_epoch)
+        if manager.release(seq_id):
+            manager.free_sequence(seq_id)
+        request.seq_id = None
+        self.preempted.appendleft(request)
+        self.num_preemptions += 1
+        logger.info(f"Preempted a sequence of {len(request.input_ids)} tokens, the KV cache pool is full")
+
+    def _prefill(self, request):
+        model = self.model
+        manager = self.kv_cache_manager
+        session = request.session
+        if session is not None:
+            # read before the cache: a reset in between moves the epoch, so that the round is not kept
+            request.session_epoch = session.epoch
+        seq_id = self._session_seq_id(request)
+        if seq_id is not None and manager.acquire(seq_id):
+            # continue the session's sequence, its cached tokens are skipped by prepare_inputs_for_generation
+            self.idle_sessions.pop(seq_id, None)
+            request.seq_id = seq_id
+        else:
+            if session is not None and session.past_key_values is not None:
+                session.reset()
+                request.session_epoch = session.epoch
+            request.seq_id = manager.add_sequence()
+            manager.acquire(request.seq_id)
+        input_ids = torch.tensor([request.input_ids], dtype=torch.long, device=model.device)
+        seq = request.input_ids
+        mask_token = model.config.gmask_token_id if model.config.gmask_token_id in seq else model.config.mask_token_id
+        request.mask_position = seq.index(mask_token)
+        request.context_length = seq.index(model.config.bos_token_id)
+
+        model_inputs = model.prepare_inputs_for_generation(
+            input_ids, past_key_values=self.kv_cache_manager.get_cache([request.seq_id])
+        )
+        outputs = model(**model_inputs, return_dict=True, output_attentions=False, output_hidden_states=False)
+        # joins the batch only once its first token is out, a failure is finished by `_admit` alone
+        if not self._sample([request], outputs.logits[:, -1, :]):
+            self.running.append(request)
+
+    def _step(self):
+        model = self.model
+        device = model.device
+        self._reserve_step()
+        requests = list(self.running)
+        # the last sampled token of every sequence has not been fed through the model yet
+        lengths = torch.tensor([len(request.input_ids) for request in requests], device=device)
+        input_ids = torch.tensor([[request.input_ids[-1]] for request in requests], dtype=torch.long, device=device)
+        if model.position_encoding_2d:
+            position_ids = torch.tensor(
+                [[request.mask_position, len(request.input_ids) - request.context_length] for request in requests],
+                dtype=torch.long, device=device).unsqueeze(-1)
+        else:
+            position_ids = torch.tensor([[request.mask_position] for request in requests], dtype=torch.long,
+                                        device=device)
+        # keys are right-padded to the longest sequence, mask out the padding of the shorter ones: [b, 1, 1, sk]
+        attention_mask = torch.arange(lengths.max().item(), device=device) >= lengths[:, None]
+        attention_mask = attention_mask[:, None, None, :]
+
+        outputs = model(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+            past_key_values=self.kv_cache_manager.get_cache([request.seq_id for request in requests]),
+            return_dict=True,
+            output_attentions=False,
+            output_hidden_states=False,
+        )
+        finished = self._sample(requests, outputs.logits[:, -1, :])
+        self.running = [request for request in self.running if request not in finished]
+
+    def _sample(self, requests, next_token_logits):
+        """Append the next token of every request, finish the ones that are done and return them."""
+        finished = []
+        for request, logits in zip(requests, next_token_logits.split(1)):
+            input_ids = torch.tensor([request.input_ids], dtype=torch.long, device=logits.device)
+            next_token_scores = request.logits_processor(input_ids, logits)
+            if request.sampler is not None:
+                next_token = request.sampler(input_ids, next_token_scores,
+                                             do_sample=request.generation_config.do_sample).item()
+            else:
+                next_token_scores = request.logits_warper(input_ids, next_token_scores)
+                probs = nn.functional.softmax(next_token_scores, dim=-1)
+                if request.generation_config.do_sample:
+                    next_token = torch.multinomial(probs, num_samples=1).item()
+                else:
+                    next_token = torch.argmax(probs, dim=-1).item()
+            request.input_ids.append(next_token)
+            request.outputs.put(torch.tensor([request.input_ids], dtype=torch.long))
+
+            if next_token in request.eos_token_id or len(request.input_ids) >= request.generation_config.max_length:
+                self._finish(request)
+                finished.append(request)
+        return finished
+
+    def _finish(self, request, exception=None):
+        session = request.session
+        seq_id, manager = request.seq_id, self.kv_cache_manager
+        # false if the session was reset while the request was running, its blocks are gone
+        if seq_id is not None and manager.release(seq_id):
+            kept = False
+            if session is not None:
+                if exception is None:
+                    # keep the blocks for the next round, the last token has not been fed through the model yet
+                    input_ids = torch.tensor([request.input_ids], dtype=torch.long, device=self.model.device)
+                    kept = session.set_cache(input_ids, manager.get_cache([seq_id]), request.session_epoch)
+                else:
+                    session.set_cache(None, None, request.session_epoch)
+            if kept:
+                self.idle_sessions[seq_id] = (session, request.session_epoch)
+            else:
+                manager.free_sequence(seq_id)
+        request.seq_id = None
+        if exception is not None:
+            request.outputs.put(exception)
+        request.outputs.put(None)
@@ -0,0 +1,247 @@
+""" Speculative decoding: tokens drafted cheaply (by a small model or from the prompt) are verified by ChatGLM in a
+single forward pass. """
+
+import time
+
+import torch
+from torch import nn
+
+from transformers.utils import logging
+
+from .kv_cache import KVCache
+
+logger = logging.get_logger(__name__)
+
+
+class SpeculativeStats:
+    """Counters of speculative decoding, accumulated over every call of a model (`seconds` drafting and verifying)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+        self.target_forwards = 0
+        self.seconds = 0.0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted_tokens / self.draft_tokens if self.draft_tokens else 0.0
+
+    @property
+    def tokens_per_second(self):
+        return self.generated_tokens / self.seconds if self.seconds else 0.0
+
+    def add(self, other: "SpeculativeStats"):
+        self.draft_tokens += other.draft_tokens
+        self.accepted_tokens += other.accepted_tokens
+        self.generated_tokens += other.generated_tokens
+        self.target_forwards += other.target_forwards
+        self.seconds += other.seconds
+
+    def as_dict(self):
+        return {
+            "draft_tokens": self.draft_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.acceptance_rate,
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_forward": self.generated_tokens / self.target_forwards if self.target_forwards else 0.0,
+            "tokens_per_second": self.tokens_per_second,
+        }
+
+
+def crop_past_key_values(past_key_values, length: int):
+    """Drop everything but the first `length` tokens from a cache, to roll back rejected draft tokens."""
+    if isinstance(past_key_values, KVCache):
+        past_key_values.crop(length)
+        return past_key_values
+    # [sk, b, np, hn]
+    return tuple((key[:length], value[:length]) for key, value in past_key_values)
+
+
+def _cache_length(past_key_values):
+    if isinstance(past_key_values, KVCache):
+        return past_key_values.get_seq_length()
+    return past_key_values[0][0].size(0)
+
+
+def _next_token_probs(input_ids, logits, logits_processor, logits_warper):
+    next_token_scores = logits_processor(input_ids, logits)
+    next_token_scores = logits_warper(input_ids, next_token_scores)
+    return nn.functional.softmax(next_token_scores, dim=-1)
+
+
+def _pick(probs, do_sample):
+    if do_sample:
+        return torch.multinomial(probs, num_samples=1).squeeze(1)
+    return torch.argmax(probs, dim=-1)
+
+
+def _verify(probs, draft_probs, draft_token, do_sample):
+    """
+    Return `draft_token` if it is accepted, otherwise the token to emit in its place. `draft_probs` is None for
+    drafts that are not sampled, which propose their token with probability 1.
+    """
+    if not do_sample:
+        return torch.argmax(probs, dim=-1)
+    if draft_probs is None:
+        draft_probs = torch.zeros_like(probs).scatter_(-1, draft_token[:, None], 1.0)
+    p, q = probs.gather(-1, draft_token[:, None]), draft_probs.gather(-1, draft_token[:, None])
+    if (torch.rand_like(p) * q <= p).item():
+        return draft_token
+    residual = (probs - draft_probs).clamp_(min=0)
+    if residual.sum() > 0:
+        probs = residual / residual.sum(dim=-1, keepdim=True)
+    return _pick(probs, do_sample)
+
+
+class DraftModelProposer:
+    """Drafts tokens by decoding with a smaller model, see `ChatGLMForConditionalGeneration.create_draft_model`."""
+
+    def __init__(self, draft_model, num_tokens: int = 4):
+        self.draft_model = draft_model
+        self.num_tokens = num_tokens
+        self.past_key_values = None
+
+    def propose(self, input_ids, num_tokens, logits_processor, logits_warper, do_sample):
+        """Return `input_ids` extended with up to `num_tokens` drafted tokens and their draft distributions."""
+        draft_ids, draft_probs = input_ids, []
+        for _ in range(num_tokens):
+            model_inputs = self.draft_model.prepare_inputs_for_generation(
+                draft_ids, past_key_values=self.past_key_values
+            )
+            outputs = self.draft_model(**model_inputs, return_dict=True, output_attentions=False,
+                                       output_hidden_states=False)
+            self.past_key_values = outputs.past_key_values
+            probs = _next_token_probs(draft_ids, outputs.logits[:, -1, :], logits_processor, logits_warper)
+            draft_probs.append(probs)
+            draft_ids = torch.cat([draft_ids, _pick(probs, do_sample)[:, None]], dim=-1)
+        return draft_ids, draft_probs
+
+    def rollback(self, length):
+        """Forget every draft token past the first `length` tokens."""
+        if self.past_key_values is not None and _cache_length(self.past_key_values) > length:
+            self.past_key_values = crop_past_key_values(self.past_key_values, length)
+
+
+class PromptLookupProposer:
+    """
+    Drafts the tokens that followed an earlier occurrence of the last n-gram of `input_ids` (the latest one with
+    enough tokens after it), trying the longest n-gram first. Answers that repeat symptoms, drug names or
+    boilerplate of the conversation are copied span by span without any draft model.
+    """
+
+    def __init__(self, num_tokens: int = 10, max_ngram_size: int = 3):
+        self.num_tokens = num_tokens
+        self.max_ngram_size = max_ngram_size
+
+    def propose(self, input_ids, num_tokens, logits_processor, logits_warper, do_sample):
+        ids = input_ids[0]
+        for ngram_size in range(min(self.max_ngram_size, ids.size(0) - 1), 0, -1):
+            # every earlier n-gram that is followed by at least one token
+            windows = ids[:-1].unfold(0, ngram_size, 1)
+            starts = (windows == ids[-ngram_size:]).all(dim=-1).nonzero().view(-1) + ngram_size
+            if starts.numel():
+                # the latest match with a full continuation, or the one with the longest continuation
+                full = starts[starts + num_tokens <= ids.size(0)]
+                start = full[-1].item() if full.numel() else starts[0].item()
+                draft = ids[start:start + num_tokens]
+                return torch.cat([input_ids, draft[None]], dim=-1), [None] * draft.size(0)
+        return input_ids, []
+
+    def rollback(self, length):
+        pass
+
+
+def speculative_stream(model, proposer, input_ids, generation_config, logits_processor, logits_warper,
+                       stopping_criteria, model_kwargs, return_past_key_values=False):
+    """
+    Body of `stream_generate` in speculative mode. Every step `proposer` drafts up to `proposer.num_tokens` tokens,
+    `model` scores all of them in one forward pass and keeps the longest accepted run plus one token of its own,
+    so the output follows the distribution of `model` alone:
+
+    - greedy: a draft token is accepted when it is the argmax of `model`;
+    - sampling: a draft token `x` is accepted with probability `min(1, p(x) / q(x))`, otherwise the step ends with a
+      token sampled from `max(0, p - q)`, where `p`/`q` are the processed and warped distributions of `model` and
+      the draft.
+
+    The cache of `model` is rolled back to the accepted tokens after every step. The statistics of the stream are
+    added to `model.speculative_stats` when it ends, or is closed early; their time is the one spent drafting and
+    verifying, without the time the caller spends between two steps.
+    """
+    if input_ids.size(0) != 1:
+        raise ValueError("Speculative decoding only supports a batch size of 1")
+    do_sample = generation_config.do_sample
+    eos_token_id = generation_config.eos_token_id
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    pre_seq_len = model.transformer.pre_seq_len or 0
+    stats = SpeculativeStats()
+
+    # masks and position ids are rebuilt from input_ids, which grow by several tokens per step
+    past_key_values = model_kwargs.get("past_key_values")
+    use_static_cache = model_kwargs.get("use_static_cache", False)
+    use_quantized_cache = model_kwargs.get("use_quantized_cache", False)
+    finished = False
+    try:
+        while not finished:
+            # only drafting and verifying is timed, not the consumer between two yields
+            step_start = time.perf_counter()
+            seq_length = input_ids.size(1)
+            draft_ids, draft_probs = input_ids, []
+            num_draft_tokens = min(proposer.num_tokens, generation_config.max_length - seq_length - 1)
+            # the first step only prefills the prompt
+            if past_key_values is not None and num_draft_tokens > 0:
+                draft_ids, draft_probs = proposer.propose(
+                    input_ids, num_draft_tokens, logits_processor, logits_warper, do_sample
+                )
+
+            model_inputs = model.prepare_inputs_for_generation(
+                draft_ids, past_key_values=past_key_values, use_static_cache=use_static_cache,
+                use_quantized_cache=use_quantized_cache, num_logits_to_keep=len(draft_probs) + 1
+            )
+            outputs = model(**model_inputs, return_dict=True, output_attentions=False, output_hidden_states=False)
+            past_key_values = outputs.past_key_values
+            stats.target_forwards += 1
+            # logits of the last token before the drafts and of every draft token
+            logits = outputs.logits[:, -len(draft_probs) - 1:, :]
+
+            new_tokens = []
+            for i in range(len(draft_probs) + 1):
+                probs = _next_token_probs(draft_ids[:, :seq_length + i], logits[:, i, :], logits_processor,
+                                          logits_warper)
+                if i == len(draft_probs):
+                    new_tokens.append(_pick(probs, do_sample))
+                    break
+                next_tokens = _verify(probs, draft_probs[i], draft_ids[:, seq_length + i], do_sample)
+                new_tokens.append(next_tokens)
+                if not torch.equal(next_tokens, draft_ids[:, seq_length + i]):
+                    break
+            stats.draft_tokens += len(draft_probs)
+            stats.accepted_tokens += len(new_tokens) - 1
+
+            for next_tokens in new_tokens:
+                input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+                stats.generated_tokens += 1
+                if next_tokens.item() in eos_token_id or stopping_criteria(input_ids, None):
+                    finished = True
+                    break
+
+            # roll back to every token but the last one, which has not been fed through the models yet
+            past_key_values = crop_past_key_values(past_key_values, input_ids.size(1) - 1 + pre_seq_len)
+            proposer.rollback(input_ids.size(1) - 1)
+            stats.seconds += time.perf_counter() - step_start
+
+            if return_past_key_values:
+                yield input_ids, past_key_values
+            elif not finished:
+                yield input_ids
+            elif input_ids.size(1) - 1 > seq_length:
+                # like stream_generate, the final token is not yielded
+                yield input_ids[:, :-1]
+    finally:
+        # also when the consumer stops early (GeneratorExit at a yield)
+        model.speculative_stats.add(stats)
+        logger.info(f"Speculative decoding: {stats.as_dict()}")
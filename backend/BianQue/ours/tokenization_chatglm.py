@@ -1,9 +1,11 @@
 """Tokenization classes for ChatGLM."""
+from functools import lru_cache
 from typing import List, Optional, Union
 import os
+import re
 
 from transformers.tokenization_utils import PreTrainedTokenizer
-from transformers.utils import logging, PaddingStrategy
+from transformers.utils import logging, PaddingStrategy, to_py_obj
 from transformers.tokenization_utils_base import EncodedInput, BatchEncoding
 from typing import Dict
 import sentencepiece as spm
@@ -28,6 +30,12 @@ class TextTokenizer:
     def decode(self, ids: List[int]):
         return self.sp.DecodeIds(ids)
 
+    def encode_batch(self, texts: List[str], num_threads: int = -1):
+        return self.sp.Encode(texts, out_type=int, num_threads=num_threads)
+
+    def decode_batch(self, ids: List[List[int]], num_threads: int = -1):
+        return self.sp.Decode(ids, num_threads=num_threads)
+
     def tokenize(self, text):
         return self.sp.EncodeAsPieces(text)
 
@@ -44,6 +52,15 @@ class TextTokenizer:
         return self.num_tokens
 
 
+@lru_cache()
+def _blank_pattern(max_len: int):
+    return re.compile(" {2,%d}" % max_len)
+
+
+# pieces that `SPTokenizer.decode` turns back into whitespace
+_WHITESPACE_PIECE_PATTERN = re.compile(r"<n>|<\|tab\|>|<\|blank_([1-9][0-9]*)\|>")
+
+
 class SPTokenizer:
     def __init__(
             self,
@@ -83,9 +100,17 @@ class SPTokenizer:
     @staticmethod
     def _encode_whitespaces(text: str, max_len: int = 80):
         text = text.replace("\t", SPTokenizer.get_tab_token())
-        for i in range(max_len, 1, -1):
-            text = text.replace(" " * i, SPTokenizer.get_blank_token(i))
-        return text
+        # a run of more than `max_len` spaces becomes blanks of `max_len` followed by the rest
+        return _blank_pattern(max_len).sub(lambda match: SPTokenizer.get_blank_token(len(match.group())), text)
+
+    def _decode_whitespaces(self, text: str):
+        def replace(match):
+            if match.group(1) is None:
+                return "\n" if match.group() == "<n>" else "\t"
+            length = int(match.group(1))
+            return " " * length if 2 <= length <= self.max_blank_length else match.group()
+
+        return _WHITESPACE_PIECE_PATTERN.sub(replace, text)
 
     def _preprocess(self, text: str, linebreak=True, whitespaces=True):
         if linebreak:
@@ -111,15 +136,26 @@ class SPTokenizer:
         tokens = [x + self.num_image_tokens for x in tmp]
         return tokens if add_dummy_prefix else tokens[2:]
 
-    def decode(self, text_ids: List[int]) -> str:
+    def encode_batch(self, texts: List[str], num_threads: int = -1) -> List[List[int]]:
+        """`encode` of every text, by SentencePiece on `num_threads` threads (-1 for all cores)."""
+        texts = [self._preprocess(text) for text in texts]
+        ids = self._get_text_tokenizer().encode_batch(texts, num_threads=num_threads)
+        return [[x + self.num_image_tokens for x in text_ids] for text_ids in ids]
+
+    def _text_ids(self, text_ids: List[int]):
         ids = [int(_id) - self.num_image_tokens for _id in text_ids]
-        ids = [_id for _id in ids if _id >= 0]
-        text = self._get_text_tokenizer().decode(ids)
-        text = text.replace("<n>", "\n")
-        text = text.replace(SPTokenizer.get_tab_token(), "\t")
-        for i in range(2, self.max_blank_length + 1):
-            text = text.replace(self.get_blank_token(i), " " * i)
-        return text
+        return [_id for _id in ids if _id >= 0]
+
+    def decode(self, text_ids: List[int]) -> str:
+        text = self._get_text_tokenizer().decode(self._text_ids(text_ids))
+        return self._decode_whitespaces(text)
+
+    def decode_batch(self, batch_text_ids: List[List[int]], num_threads: int = -1) -> List[str]:
+        """`decode` of every sequence, by SentencePiece on `num_threads` threads (-1 for all cores)."""
+        texts = self._get_text_tokenizer().decode_batch(
+            [self._text_ids(text_ids) for text_ids in batch_text_ids], num_threads=num_threads
+        )
+        return [self._decode_whitespaces(text) for text in texts]
 
     def tokenize(
             self, text: str, linebreak=True, whitespaces=True, add_dummy_prefix=True
@@ -152,6 +188,43 @@ class SPTokenizer:
             raise ValueError("The key should be str or int.")
 
 
+class StreamDecoder:
+    """
+    Decodes the ids of a sequence that grows token by token into text deltas. Only the ids since the last emitted text
+    are decoded, after the ids of the step before for context (SentencePiece drops the leading space of the first
+    piece, and the same space is dropped from the text both decodes start with), so a step costs the same however
+    long the sequence already is. Text ending in an incomplete UTF-8 character (byte fallback pieces) is held back
+    until the character is complete.
+    """
+
+    def __init__(self, sp_tokenizer: SPTokenizer, pad_token_id: Optional[int] = None):
+        self.sp_tokenizer = sp_tokenizer
+        self.pad_token_id = pad_token_id
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _delta(self):
+        prefix_text = self.sp_tokenizer.decode(self.token_ids[self.prefix_offset:self.read_offset])
+        text = self.sp_tokenizer.decode(self.token_ids[self.prefix_offset:])
+        return text[len(prefix_text):]
+
+    def put(self, token_ids: List[int]) -> str:
+        """Append `token_ids` and return the text they complete."""
+        self.token_ids.extend(token_id for token_id in token_ids if token_id != self.pad_token_id)
+        delta = self._delta()
+        if not delta or delta.endswith("\ufffd"):
+            return ""
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.token_ids)
+        return delta
+
+    def flush(self) -> str:
+        """Return the text that is still held back, incomplete characters included."""
+        delta = self._delta()
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.token_ids)
+        return delta
+
+
 class ChatGLMTokenizer(PreTrainedTokenizer):
     """
     Construct a ChatGLM tokenizer. Based on byte-level Byte-Pair-Encoding.
@@ -179,7 +252,7 @@ class ChatGLMTokenizer(PreTrainedTokenizer):
             pad_token="<pad>",
             unk_token="<unk>",
             num_image_tokens=20000,
-            
+            compact_attention_mask=False,
             
             **kwargs
     ) -> None:
@@ -197,6 +270,7 @@ class ChatGLMTokenizer(PreTrainedTokenizer):
             pad_token=pad_token,
             unk_token=unk_token,
             num_image_tokens=num_image_tokens,
+            compact_attention_mask=compact_attention_mask,
             **kwargs
         )
 
@@ -209,6 +283,8 @@ class ChatGLMTokenizer(PreTrainedTokenizer):
         self.end_token = end_token
         self.mask_token = mask_token
         self.gmask_token = gmask_token
+        # `_pad` returns `[1, 2]` masks of (context length, padding length) instead of `[1, seq_len, seq_len]` ones
+        self.compact_attention_mask = compact_attention_mask
 
         
         """ Initialisation """
@@ -259,6 +335,43 @@ class ChatGLMTokenizer(PreTrainedTokenizer):
 
         return seq
 
+    def _encode_texts(self, texts):
+        """
+        `texts` with the plain texts replaced by their ids, encoded in one multi-threaded SentencePiece batch instead
+        of going through `tokenize` and `convert_tokens_to_ids` piece by piece. Texts that contain added tokens, which
+        `tokenize` splits around, are left as they are.
+        """
+        added_tokens = self._added_tokens_encoder
+        pattern = re.compile("|".join(map(re.escape, added_tokens))) if added_tokens else None
+        indices = [
+            i for i, text in enumerate(texts)
+            if isinstance(text, str) and text and not (pattern is not None and pattern.search(text))
+        ]
+        if not indices:
+            return list(texts)
+        ids = self.sp_tokenizer.encode_batch([self.preprocess_text(texts[i]) for i in indices])
+        texts = list(texts)
+        for i, text_ids in zip(indices, ids):
+            # the ids of a text that is only whitespace may be empty, which the regular path handles
+            if text_ids:
+                texts[i] = text_ids
+        return texts
+
+    def _encode_plus(self, text, text_pair=None, **kwargs):
+        if not kwargs.get("is_split_into_words", False):
+            text, text_pair = self._encode_texts([text, text_pair])
+        return super()._encode_plus(text, text_pair=text_pair, **kwargs)
+
+    def _batch_encode_plus(self, batch_text_or_text_pairs, **kwargs):
+        if not kwargs.get("is_split_into_words", False):
+            ids = self._encode_texts(batch_text_or_text_pairs)
+            # a list of ids would be taken for a pair of texts
+            batch_text_or_text_pairs = [
+                (text_ids, None) if isinstance(text_ids, list) and not isinstance(text, (list, tuple)) else text
+                for text, text_ids in zip(batch_text_or_text_pairs, ids)
+            ]
+        return super()._batch_encode_plus(batch_text_or_text_pairs, **kwargs)
+
     def _decode(
             self,
             token_ids: Union[int, List[int]],
@@ -274,6 +387,32 @@ class ChatGLMTokenizer(PreTrainedTokenizer):
             token_ids = list(filter((self.pad_token_id).__ne__, token_ids))
         return self.sp_tokenizer.decode(token_ids)
 
+    def batch_decode(self, sequences, skip_special_tokens: bool = False, clean_up_tokenization_spaces: bool = None,
+                     **kwargs) -> List[str]:
+        """Same as `decode` of every sequence, decoded in one multi-threaded SentencePiece batch."""
+        if not isinstance(sequences, (list, tuple)):
+            sequences = to_py_obj(sequences)
+        pad_token_id = self.pad_token_id
+        batch_token_ids = []
+        for token_ids in sequences:
+            if isinstance(token_ids, int):
+                token_ids = [token_ids]
+            elif not isinstance(token_ids, list):
+                token_ids = to_py_obj(token_ids)
+            batch_token_ids.append([token_id for token_id in token_ids if token_id != pad_token_id])
+        return self.sp_tokenizer.decode_batch(batch_token_ids)
+
+    def stream_decoder(self) -> StreamDecoder:
+        """A [`StreamDecoder`] that decodes generated ids step by step, like `decode` over all of them."""
+        return StreamDecoder(self.sp_tokenizer, pad_token_id=self.pad_token_id)
+
+    def without_image_tokens(self) -> "ChatGLMTokenizer":
+        """The tokenizer of a model converted by `trim_image_tokens`, whose text ids start at 0."""
+        init_kwargs = dict(self.init_kwargs)
+        init_kwargs["num_image_tokens"] = 0
+        init_kwargs["compact_attention_mask"] = self.compact_attention_mask
+        return self.__class__(self.vocab_file, **init_kwargs)
+
     def _convert_token_to_id(self, token):
         """ Converts a token (str) in an id using the vocab. """
         return self.sp_tokenizer[token]
@@ -391,10 +530,13 @@ class ChatGLMTokenizer(PreTrainedTokenizer):
                     context_length = required_input.index(bos_token_id)
                 else:
                     context_length = seq_length
-                attention_mask = np.ones((1, seq_length, seq_length))
-                attention_mask = np.tril(attention_mask)
-                attention_mask[:, :, :context_length] = 1
-                attention_mask = np.bool_(attention_mask < 0.5)
+                if self.compact_attention_mask:
+                    attention_mask = np.array([[context_length, 0]], dtype=np.int64)
+                else:
+                    attention_mask = np.ones((1, seq_length, seq_length))
+                    attention_mask = np.tril(attention_mask)
+                    attention_mask[:, :, :context_length] = 1
+                    attention_mask = np.bool_(attention_mask < 0.5)
                 encoded_inputs["attention_mask"] = attention_mask
 
             if "position_ids" not in encoded_inputs:
@@ -416,9 +558,14 @@ class ChatGLMTokenizer(PreTrainedTokenizer):
             difference = max_length - len(required_input)
 
             if "attention_mask" in encoded_inputs:
-                encoded_inputs["attention_mask"] = np.pad(encoded_inputs["attention_mask"],
-                                                          pad_width=[(0, 0), (difference, 0), (difference, 0)],
-                                                          mode='constant', constant_values=True)
+                attention_mask = np.asarray(encoded_inputs["attention_mask"])
+                if attention_mask.ndim == 2:
+                    # compact mask: the context ends `difference` tokens later, behind as many padding tokens
+                    encoded_inputs["attention_mask"] = attention_mask + difference
+                else:
+                    encoded_inputs["attention_mask"] = np.pad(attention_mask,
+                                                              pad_width=[(0, 0), (difference, 0), (difference, 0)],
+                                                              mode='constant', constant_values=True)
             if "token_type_ids" in encoded_inputs:
                 encoded_inputs["token_type_ids"] = [self.pad_token_type_id] * difference + encoded_inputs[
                     "token_type_ids"
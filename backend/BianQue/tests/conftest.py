@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the model code in ours/ is imported as the `ours` package, like transformers does with trust_remote_code
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,145 @@
+""" The sdpa attention backend against the eager one, and the paged KV cache, on a small random-weight model. """
+
+import pytest
+import torch
+
+from ours.configuration_chatglm import ChatGLMConfig
+from ours.masks import PrefixLMMask
+from ours.modeling_chatglm import ChatGLMForConditionalGeneration
+
+MASK, GMASK, BOS, EOS, PAD = 130000, 130001, 130004, 130005, 3
+
+
+def make_model(attn_implementation):
+    config = ChatGLMConfig(vocab_size=130528, hidden_size=64, num_layers=2, num_attention_heads=4,
+                           inner_hidden_size=128, max_sequence_length=256, bos_token_id=BOS, eos_token_id=EOS,
+                           mask_token_id=MASK, gmask_token_id=GMASK, pad_token_id=PAD, use_cache=True,
+                           attn_implementation=attn_implementation)
+    model = ChatGLMForConditionalGeneration(config, empty_init=False).float().eval()
+    torch.manual_seed(0)
+    for param in model.parameters():
+        torch.nn.init.normal_(param, std=0.05)
+    return model
+
+
+@pytest.fixture(scope="module")
+def models():
+    eager, sdpa = make_model("eager"), make_model("sdpa")
+    assert [layer.attention.attention_backend for layer in eager.transformer.layers] == ["eager", "eager"]
+    assert [layer.attention.attention_backend for layer in sdpa.transformer.layers] == ["sdpa", "sdpa"]
+    return eager, sdpa
+
+
+def make_prompts(lengths, answer_length=0):
+    """Left-padded prompts ending in `[gMASK]<sop>` plus `answer_length` tokens after it."""
+    generator = torch.Generator().manual_seed(1)
+    seq_length = max(lengths) + 2 + answer_length
+    input_ids = torch.full((len(lengths), seq_length), PAD)
+    for i, length in enumerate(lengths):
+        row = torch.cat((torch.randint(20005, 30000, (length,), generator=generator), torch.tensor([GMASK, BOS]),
+                         torch.randint(20005, 30000, (answer_length,), generator=generator)))
+        input_ids[i, seq_length - row.size(0):] = row
+    padding_lengths = torch.tensor([max(lengths) - length for length in lengths])
+    return input_ids, padding_lengths
+
+
+def padded_inputs(model, input_ids, padding_lengths):
+    """The dense mask and position ids of `ChatGLMTokenizer._pad`: padding is neither attended nor attends."""
+    attention_mask = model.get_masks(input_ids, input_ids.device)
+    for i, padding_length in enumerate(padding_lengths.tolist()):
+        attention_mask[i, :, :, :padding_length] = True
+        attention_mask[i, :, :padding_length] = True
+    position_ids = model.get_prompt_position_ids(input_ids, input_ids.device)
+    return attention_mask, position_ids
+
+
+def assert_logits_close(expected, actual):
+    assert not torch.isnan(actual).any()
+    torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+@torch.no_grad()
+def test_prefill_logits(models):
+    eager, sdpa = models
+    input_ids, _ = make_prompts([40])
+    assert_logits_close(eager(input_ids).logits, sdpa(input_ids).logits)
+
+
+@torch.no_grad()
+def test_prefix_lm_mask_logits(models):
+    # tokens after <sop> attend causally, the context bidirectionally
+    eager, sdpa = models
+    input_ids, _ = make_prompts([30, 30], answer_length=12)
+    expected = eager(input_ids).logits
+    dense = eager.get_masks(input_ids, input_ids.device)
+    compact = eager.get_compact_masks(input_ids, input_ids.device)
+    assert isinstance(compact, PrefixLMMask)
+    for model in models:
+        assert_logits_close(expected, model(input_ids, attention_mask=dense).logits)
+        assert_logits_close(expected, model(input_ids, attention_mask=compact).logits)
+
+
+@torch.no_grad()
+def test_padded_batch_logits(models):
+    eager, sdpa = models
+    input_ids, padding_lengths = make_prompts([8, 30, 21], answer_length=5)
+    attention_mask, position_ids = padded_inputs(eager, input_ids, padding_lengths)
+    expected = eager(input_ids, attention_mask=attention_mask, position_ids=position_ids).logits
+    context_lengths = eager.get_context_lengths(input_ids)
+    # the [b, 1, 2] rows of ChatGLMTokenizer with compact_attention_mask=True
+    compact = torch.stack((context_lengths, padding_lengths), dim=-1)[:, None]
+    for attention_mask in (attention_mask, compact):
+        actual = sdpa(input_ids, attention_mask=attention_mask, position_ids=position_ids).logits
+        for i, padding_length in enumerate(padding_lengths.tolist()):
+            # the rows of padding tokens are not used
+            assert_logits_close(expected[i, padding_length:], actual[i, padding_length:])
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("cache_kwargs", [{}, {"use_static_cache": True}])
+def test_greedy_generate(models, cache_kwargs):
+    eager, sdpa = models
+    input_ids, _ = make_prompts([40])
+    kwargs = dict(max_length=input_ids.size(1) + 24, do_sample=False, **cache_kwargs)
+    assert torch.equal(eager.generate(input_ids, **kwargs), sdpa.generate(input_ids, **kwargs))
+
+
+@torch.no_grad()
+def test_padded_batch_generate(models):
+    eager, sdpa = models
+    input_ids, padding_lengths = make_prompts([8, 30, 21])
+    attention_mask, position_ids = padded_inputs(eager, input_ids, padding_lengths)
+    kwargs = dict(attention_mask=attention_mask, position_ids=position_ids, max_length=input_ids.size(1) + 16,
+                  do_sample=False)
+    assert torch.equal(eager.generate(input_ids, **kwargs), sdpa.generate(input_ids, **kwargs))
+
+
+@torch.no_grad()
+def test_output_attentions_falls_back_to_eager(models):
+    eager, sdpa = models
+    input_ids, _ = make_prompts([20])
+    expected, actual = eager(input_ids, output_attentions=True), sdpa(input_ids, output_attentions=True)
+    assert_logits_close(expected.logits, actual.logits)
+    for expected_attentions, actual_attentions in zip(expected.attentions, actual.attentions):
+        torch.testing.assert_close(actual_attentions, expected_attentions)
+
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("backend", ["eager", "sdpa"])
+def test_paged_cache_generate(models, backend):
+    model = models[["eager", "sdpa"].index(backend)]
+    input_ids, _ = make_prompts([20, 20])
+    # 16 blocks of 4 tokens (fp32 keys and values), just enough for both sequences: the second one takes two runs
+    config = model.config
+    manager = model.create_kv_cache_manager(16 * 2 * config.num_layers * config.hidden_size * 4 * 4, block_size=4)
+    seq_ids = [manager.add_sequence(), manager.add_sequence()]
+    kwargs = dict(max_length=input_ids.size(1) + 10, do_sample=False, output_scores=True,
+                  return_dict_in_generate=True)
+    actual = model.generate(input_ids, past_key_values=manager.get_cache(seq_ids), **kwargs)
+    assert manager.num_free_blocks == 0
+    block_table = manager.block_tables[seq_ids[1]]
+    assert block_table != list(range(block_table[0], block_table[0] + len(block_table)))
+    expected = model.generate(input_ids, **kwargs)
+    assert torch.equal(expected.sequences, actual.sequences)
+    assert_logits_close(torch.stack(expected.scores), torch.stack(actual.scores))
@@ -0,0 +1,101 @@
+""" `trim_image_tokens` with `ChatGLMTokenizer.without_image_tokens` against the untrimmed model and tokenizer. """
+
+import pytest
+import sentencepiece as spm
+import torch
+from transformers.generation.logits_process import LogitsProcessor, LogitsProcessorList
+
+from ours.configuration_chatglm import ChatGLMConfig
+from ours.modeling_chatglm import ChatGLMForConditionalGeneration
+from ours.tokenization_chatglm import ChatGLMTokenizer
+
+NUM_TEXT_TOKENS = 130528
+
+CORPUS = [
+    "病人：我最近总是头疼，晚上也睡不好，应该怎么办？",
+    "医生：头疼和失眠可能与压力、作息不规律有关，建议保持规律作息，睡前避免使用手机。",
+    "病人：发烧三天了，还有咳嗽和喉咙痛。",
+    "医生：建议多喝水，注意休息，如果体温超过三十八度五或者持续不退，请及时到医院就诊。",
+    "病人：胃痛，吃完饭以后更明显。",
+    "医生：饮食要清淡，少吃辛辣油腻的食物，必要时可以做胃镜检查。",
+]
+
+
+class TextTokensOnly(LogitsProcessor):
+    """Never picks an id the tokenizer cannot decode, as a trained model never predicts the unused ids."""
+
+    def __init__(self, tokenizer):
+        self.start = tokenizer.sp_tokenizer.num_image_tokens
+        self.end = tokenizer.vocab_size
+
+    def __call__(self, input_ids, scores):
+        # not -inf, which `InvalidScoreLogitsProcessor` takes for invalid scores
+        scores[:, :self.start] = torch.finfo(scores.dtype).min
+        scores[:, self.end:] = torch.finfo(scores.dtype).min
+        return scores
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    """A ChatGLM tokenizer of a small SentencePiece model with the pieces of ice_text.model it relies on."""
+    prefix = str(tmp_path_factory.mktemp("sp") / "sp")
+    specials = ["[MASK]", "[gMASK]", "[sMASK]", "<unused_0>", "<sop>", "<eop>", "<ENC>", "<dBLOCK>", "<n>",
+                "<|tab|>"] + [f"<|blank_{i}|>" for i in range(2, 81)]
+    spm.SentencePieceTrainer.train(sentence_iterator=iter(CORPUS * 20), model_prefix=prefix, vocab_size=400,
+                                   hard_vocab_limit=False, user_defined_symbols=specials, pad_id=3, unk_id=0,
+                                   bos_id=1, eos_id=2, character_coverage=1.0, minloglevel=2)
+    return ChatGLMTokenizer(prefix + ".model")
+
+
+def make_model(tokenizer):
+    num_image_tokens = tokenizer.sp_tokenizer.num_image_tokens
+    # the vocabulary of ChatGLM-6B, of which the tokenizer only uses its first text ids
+    config = ChatGLMConfig(vocab_size=num_image_tokens + NUM_TEXT_TOKENS, hidden_size=64, num_layers=2,
+                           num_attention_heads=4, inner_hidden_size=128, max_sequence_length=256,
+                           bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                           mask_token_id=tokenizer.convert_tokens_to_ids("[MASK]"),
+                           gmask_token_id=tokenizer.gmask_token_id, pad_token_id=tokenizer.pad_token_id,
+                           use_cache=True)
+    model = ChatGLMForConditionalGeneration(config, empty_init=False).float().eval()
+    model.tie_weights()
+    torch.manual_seed(0)
+    for param in model.parameters():
+        torch.nn.init.normal_(param, std=0.3)
+    return model
+
+
+def chat_rounds(model, tokenizer, queries):
+    """Greedy answers of a conversation of `queries`, every round with the history of the previous ones."""
+    history = []
+    for query in queries:
+        max_length = len(tokenizer(model.build_prompt(query, history))["input_ids"]) + 24
+        _, history = model.chat(tokenizer, query, history, max_length=max_length, do_sample=False,
+                                logits_processor=LogitsProcessorList([TextTokensOnly(tokenizer)]))
+    return history
+
+
+def test_trim_image_tokens_chat(tokenizer):
+    model = make_model(tokenizer)
+    num_image_tokens = tokenizer.sp_tokenizer.num_image_tokens
+    queries = ["我头疼，晚上睡不好", "发烧  咳嗽\n喉咙痛", "胃痛怎么办"]
+    expected = chat_rounds(model, tokenizer, queries)
+    assert all(response for _, response in expected)
+    prompt = model.build_prompt(queries[-1], expected[:-1])
+    with torch.no_grad():
+        expected_logits = model(**tokenizer([prompt], return_tensors="pt")).logits
+
+    model.trim_image_tokens(num_image_tokens)
+    trimmed_tokenizer = tokenizer.without_image_tokens()
+    assert model.config.vocab_size == NUM_TEXT_TOKENS
+    assert model.lm_head.weight.size(0) == NUM_TEXT_TOKENS
+    assert model.lm_head.weight is model.transformer.word_embeddings.weight
+    assert model.config.bos_token_id == trimmed_tokenizer.bos_token_id == tokenizer.bos_token_id - num_image_tokens
+    assert model.config.gmask_token_id == trimmed_tokenizer.gmask_token_id
+    assert model.generation_config.eos_token_id == trimmed_tokenizer.eos_token_id
+    assert chat_rounds(model, trimmed_tokenizer, queries) == expected
+    with torch.no_grad():
+        logits = model(**trimmed_tokenizer([prompt], return_tensors="pt")).logits
+    torch.testing.assert_close(logits, expected_logits[..., num_image_tokens:])
+
+    with pytest.raises(ValueError):
+        model.trim_image_tokens(num_image_tokens)